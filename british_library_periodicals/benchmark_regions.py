@@ -0,0 +1,96 @@
+from __future__ import division
+from segment_periodicals import read_image, get_image_files, label_regions, get_region_boxes
+from skimage.measure import regionprops
+import numpy as np
+import argparse, json, time
+
+'''
+Time the two ways of getting the bounding boxes of the large regions on
+a labeled page: building regionprops for every region and reading their
+area and bbox, or counting areas with bincount and finding boxes with
+find_objects (get_region_boxes). Both must return the same boxes.
+--speckle adds single pixel specks of ink to each page, to mimic the
+tens of thousands of noise regions on a newspaper scan. Usage:
+
+python benchmark_regions.py periodical_images/ --repeat 5 --speckle 0.005
+'''
+
+def get_regionprops_boxes(labeled, min_area=2000):
+  '''
+  Read in an array of region labels and return the bounding box of each
+  region with at least min_area pixels, using regionprops
+  '''
+  return [region.bbox for region in regionprops(labeled) if region.area >= min_area]
+
+
+def add_speckle(im, fraction, seed=0):
+  '''
+  Read in a page image and return a copy with fraction of its pixels,
+  chosen at random, set to black
+  '''
+  rng = np.random.RandomState(seed)
+  im = im.copy()
+  im.ravel()[rng.randint(0, im.size, int(im.size * fraction))] = 0
+  return im
+
+
+def time_function(fn, args, repeat):
+  '''
+  Call fn(*args) repeat times and return the fastest time in seconds
+  along with the result of the last call
+  '''
+  best = None
+  for _ in range(repeat):
+    start = time.time()
+    result = fn(*args)
+    elapsed = time.time() - start
+    best = elapsed if best is None else min(best, elapsed)
+  return best, result
+
+
+def benchmark_page(image_file, min_area, repeat, speckle=0):
+  '''
+  Read in the path to a page image, label the page, and return a dict
+  with the number of regions and boxes and the time each method takes
+  '''
+  im = read_image(image_file)
+  if speckle:
+    im = add_speckle(im, speckle)
+  labeled = label_regions(im)
+  regionprops_seconds, regionprops_boxes = time_function(get_regionprops_boxes,
+    (labeled, min_area), repeat)
+  fast_seconds, fast_boxes = time_function(get_region_boxes, (labeled, min_area), repeat)
+
+  if fast_boxes != regionprops_boxes:
+    raise ValueError('get_region_boxes and regionprops disagree on ' + image_file)
+
+  return {
+    'image_file': image_file,
+    'regions': int(labeled.max()),
+    'boxes': len(fast_boxes),
+    'regionprops_seconds': round(regionprops_seconds, 4),
+    'fast_seconds': round(fast_seconds, 4),
+    'speedup': round(regionprops_seconds / max(fast_seconds, 1e-9), 1)
+  }
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark regionprops against get_region_boxes')
+  parser.add_argument('paths', nargs='+', help='page images or directories of page images')
+  parser.add_argument('--pattern', default='*.jp2', help='pattern of page images in directories')
+  parser.add_argument('--min-area', type=int, default=2000, help='minimum clipping area in pixels')
+  parser.add_argument('--repeat', type=int, default=3, help='time each method this many times')
+  parser.add_argument('--speckle', type=float, default=0, help='fraction of pixels to set to ink')
+  parser.add_argument('--json', help='also write the results to this file')
+  args = parser.parse_args()
+
+  results = []
+  for image_file in get_image_files(args.paths, args.pattern):
+    result = benchmark_page(image_file, args.min_area, args.repeat, args.speckle)
+    results.append(result)
+    print '{image_file} {regions:>7} regions {boxes:>5} boxes'.format(**result),
+    print '{regionprops_seconds:>8} s regionprops {fast_seconds:>8} s fast {speedup:>6}x'.format(**result)
+
+  if args.json:
+    with open(args.json, 'w') as out:
+      json.dump(results, out, indent=2)
@@ -1,104 +1,1224 @@
+from __future__ import division
 from skimage import filters, segmentation, io
-from skimage.measure import label, regionprops
+from skimage.measure import label
 from skimage.color import label2rgb
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+from collections import defaultdict, deque
 from scipy import ndimage
-import matplotlib.pyplot as plt
-import matplotlib.patches as mpatches
-import sys, os
+from shutil import rmtree
+import numpy as np
+import argparse, glob, json, os, re, struct, sys, Queue
 
-image_file = sys.argv[1]
-file_extension = image_file.split(".")[-1]
-plots_to_show = []
+'''
+Segment scans of periodical clippings on a white background into one
+image per clipping. segment_page(image) can be imported and returns the
+bounding box and crop of each clipping, found either by labeling the
+connected regions of ink ('otsu' engine, or 'tiled' to label the page in
+strips of rows for large pages) or by recursive XY-cuts along the gaps
+in the page's ink ('xycut' engine); run as a script, every page
+given on the command line (or every *.jp2 page in the given directories)
+is segmented in a process pool and each clipping is written to
+{{out dir}}/{{page name}}_{{clipping index}}.png. Usage:
 
+python segment_periodicals.py periodical_images/ --processes 8
+python segment_periodicals.py periodical_images/ --engine xycut
+python segment_periodicals.py periodical_images/ --engine tiled --strip-rows 512
+python segment_periodicals.py periodical_images/ --threshold volume --threshold-window 2
+python segment_periodicals.py periodical_images/ --scale 4 --refine --compare
+python segment_periodicals.py periodical_images/lsidyv3f9b93cd_0031.jp2 --visualize
+python segment_periodicals.py periodical_images/ --processes 16 --memory-budget 4000 --dry-run
+'''
 
-if file_extension in ["jpg", "jpeg"]:
-  im = ndimage.imread(image_file)
+##############
+# Read pages #
+##############
 
-elif file_extension in ["jp2"]:
-  im = io.imread(image_file, plugin='freeimage')
+def read_image(image_file):
+  '''
+  Read in the path to a jpg, png, tif or jp2 image and return that
+  image as a numpy array. Raise a ValueError for other file types
+  '''
+  file_extension = image_file.split(".")[-1].lower()
 
-else:
-  print "your input file isn't jpg or jp2"
-  sys.exit()
+  if file_extension in ["jpg", "jpeg", "png", "tif", "tiff"]:
+    return io.imread(image_file)
 
-############################
-# X-Y axis pixel dilations #
-############################
+  elif file_extension in ["jp2"]:
+    return io.imread(image_file, plugin='freeimage')
 
-# plot the amount of white ink across the columns & rows
-row_vals = list([sum(r) for r in im  ])
-col_vals = list([sum(c) for c in im.T])
+  raise ValueError("input file isn't jpg, png, tif or jp2: " + image_file)
 
-if "col_sums" in plots_to_show:
-  plt.plot(col_vals)
-  plt.show()
 
-if "row_sums" in plots_to_show:
-  plt.plot(row_vals)
-  plt.show()
+def get_image_files(paths, pattern='*.jp2'):
+  '''
+  Read in a list of paths to image files and directories, and return
+  the image files along with the files in each directory that match
+  pattern, sorted by name
+  '''
+  image_files = []
+  for path in paths:
+    if os.path.isdir(path):
+      image_files += sorted(glob.glob(os.path.join(path, pattern)))
+    else:
+      image_files.append(path)
+  return image_files
 
-#########################################
-# Otsu method of boolean classification #
-#########################################
+#########################
+# Page sizes and memory #
+#########################
 
-val = filters.threshold_otsu(im)
-mask = im < val
+# decoding a jp2 takes about this many times the bytes of the decoded page
+decode_memory_factor = 6
 
-clean_border = segmentation.clear_border(mask)
+# the bytes of working memory per pixel each engine needs beyond the page
+engine_bytes_per_pixel = {'otsu': 17, 'tiled': 2, 'xycut': 8}
 
-plt.imshow(clean_border, cmap='gray')
-plt.show()
+def read_image_size(image_file):
+  '''
+  Read in the path to a jp2 or png image and return its (height, width,
+  channels, bytes per sample) from the jp2 ihdr box or png IHDR chunk,
+  without decoding any pixels. Raise a ValueError for other files
+  '''
+  with open(image_file, 'rb') as f:
+    start = f.read(24)
 
-#######################
-# Label image regions #
-#######################
+    if start.startswith(b'\x89PNG\r\n\x1a\n') and start[12:16] == b'IHDR':
+      width, height = struct.unpack('>II', start[16:24])
+      bits, color_type = struct.unpack('>BB', f.read(2))
+      channels = {0: 1, 2: 3, 3: 3, 4: 2, 6: 4}.get(color_type, 1)
+      return height, width, channels, 1 if bits <= 8 else 2
 
-labeled = label(clean_border)
-image_label_overlay = label2rgb(labeled, image=im)
+    if start[4:8] == b'jP  ':
+      for box_type, box_start, box_end in iter_jp2_boxes(f, 0):
+        if box_type == b'jp2h':
+          for sub_type, sub_start, sub_end in iter_jp2_boxes(f, box_start, box_end):
+            if sub_type == b'ihdr':
+              f.seek(sub_start)
+              height, width, channels, bits = struct.unpack('>IIHB', f.read(11))
+              bits = (bits & 0x7f) + 1
+              return height, width, channels, 1 if bits <= 8 else 2 if bits <= 16 else 4
 
-fig, ax = plt.subplots(ncols=1, nrows=1, figsize=(6, 6))
-ax.imshow(image_label_overlay)
-#plt.show()
+  raise ValueError("can't read the size of " + image_file)
 
-#########################################
-# Draw bounding box around each article #
-#########################################
 
-# create array in which to store cropped articles
-cropped_images = []
+def iter_jp2_boxes(f, position, end=None):
+  '''
+  Read in an open jp2 file, the position of a box and the position at
+  which the boxes end (None for the end of the file), and yield a (box
+  type, start of box contents, end of box) tuple for each box
+  '''
+  while end is None or position < end:
+    f.seek(position)
+    header = f.read(8)
+    if len(header) < 8:
+      return
 
-# define amount of padding to add to cropped image
-pad = 20
+    length, box_type = struct.unpack('>I4s', header)
+    content_start = position + 8
+    if length == 1:
+      length, = struct.unpack('>Q', f.read(8))
+      content_start += 8
+    elif length == 0:
+      f.seek(0, 2)
+      length = f.tell() - position
 
-for region_index, region in enumerate(regionprops(labeled)):
-  if region.area < 2000:
-    continue
+    if length < content_start - position:
+      raise ValueError('corrupt jp2 box')
 
-  # draw a rectangle around the segmented articles
-  # bbox describes: min_row, min_col, max_row, max_col
-  minr, minc, maxr, maxc = region.bbox
-  
-  # use those bounding box coordinates to crop the image
-  cropped_images.append(im[minr-pad:maxr+pad, minc-pad:maxc+pad])
-  
-  print "region", region_index, "bounding box:", minr, minc, maxr, maxc
+    yield box_type, content_start, position + length
+    position += length
+
+
+def estimate_page_memory(image_file, options):
+  '''
+  Read in the path to a page image and the command line options, and
+  return the estimated peak memory in bytes of segmenting the page:
+  decoding it, plus the working memory of the engine on the page (or on
+  the downsampled page, if options.scale > 1). Return 0 for pages whose
+  size can't be read from their header
+  '''
+  try:
+    height, width, channels, sample_bytes = read_image_size(image_file)
+  except Exception:
+    return 0
+
+  pixels = height * width
+  engine_bytes = engine_bytes_per_pixel.get(options.engine, 17) * pixels // max(options.scale, 1) ** 2
+  return pixels * channels * sample_bytes * decode_memory_factor + engine_bytes
+
+
+def imap_within_budget(pool, function, jobs, memories, memory_budget, max_running):
+  '''
+  Read in a process pool, a function, a list of jobs, the estimated peak
+  memory in bytes of each job, the memory budget in bytes and the most
+  jobs to run at once, and yield function(job) for each job as it
+  finishes. A job only starts while the estimated memory of the running
+  jobs plus its own fits in the budget. Jobs start in order, except
+  that while the first pending job doesn't fit, a later job that fits
+  may start ahead of it, at most max_running times in a row; after
+  that, the first job waits for room. A job larger than the whole
+  budget runs by itself. If a job raises an exception, terminate the
+  pool and raise it
+  '''
+  # the indices of the pending jobs in order, and in buckets of jobs with
+  # the same bit length of their estimate, so a job that fits can be
+  # found without scanning every pending job. Started jobs are dropped
+  # from the fronts of these queues as they're reached
+  pending = deque(range(len(jobs)))
+  buckets = defaultdict(deque)
+  for index, memory in enumerate(memories):
+    buckets[int(memory).bit_length()].append(index)
+  started = [False] * len(jobs)
+
+  finished = Queue.Queue()
+  running_memory = 0
+  n_running = 0
+  n_started = 0
+
+  # the number of jobs started ahead of the first pending job
+  n_skipped = 0
+
+  while n_started < len(jobs) or n_running:
+    while n_started < len(jobs) and n_running < max_running:
+      while started[pending[0]]:
+        pending.popleft()
+
+      index = pending[0]
+      if not n_running or running_memory + memories[index] <= memory_budget:
+        n_skipped = 0
+      elif n_skipped < max_running:
+        index = find_job_within(memory_budget - running_memory, buckets, memories, started)
+        if index is None:
+          break
+        n_skipped += 1
+      else:
+        break
+
+      started[index] = True
+      n_started += 1
+      running_memory += memories[index]
+      n_running += 1
+      pool.apply_async(call_job, ((function, jobs[index]),),
+        callback=lambda result, memory=memories[index]: finished.put((result, memory)))
+
+    (succeeded, result), memory = finished.get()
+    running_memory -= memory
+    n_running -= 1
+
+    # stop the jobs that are still running or queued
+    if not succeeded:
+      pool.terminate()
+      raise result
+    yield result
+
+
+def find_job_within(free_memory, buckets, memories, started):
+  '''
+  Read in the free memory in bytes, the buckets of pending job indices
+  by bit length of their estimate, the estimate of each job and whether
+  each job has started, and return the index of the earliest pending
+  job in the largest bucket whose first job fits in the free memory, or
+  None if no bucket's first job fits
+  '''
+  for bit_length in sorted(buckets, reverse=True):
+    bucket = buckets[bit_length]
+    while bucket and started[bucket[0]]:
+      bucket.popleft()
+    if bucket and memories[bucket[0]] <= free_memory:
+      return bucket[0]
+  return None
+
+
+def call_job(task):
+  '''
+  Read in a (function, job) tuple and return (True, function(job)), or
+  (False, exception) if the call raised an exception, so that
+  imap_within_budget hears about every job that finishes
+  '''
+  function, job = task
+  try:
+    return True, function(job)
+  except Exception as exc:
+    return False, exc
+
+
+def print_cost_estimate(image_files, options):
+  '''
+  Read in a list of page images and the command line options, and print
+  the number of pages and pixels and the estimated peak memory of each
+  volume, and of the whole run with options.processes processes
+  '''
+  volumes = {}
+  memories = []
+  for image_file in image_files:
+    try:
+      height, width, channels, sample_bytes = read_image_size(image_file)
+    except Exception:
+      height = width = 0
+    memory = estimate_page_memory(image_file, options)
+    memories.append(memory)
+
+    volume = volumes.setdefault(get_volume_name(image_file), [0, 0, 0])
+    volume[0] += 1
+    volume[1] += height * width
+    volume[2] = max(volume[2], memory)
+
+  for name, (n_pages, pixels, peak_memory) in sorted(volumes.iteritems()):
+    print name, n_pages, "pages", pixels, "pixels", round(peak_memory / 2 ** 20, 1), "MB peak per page"
+
+  # the largest pages that could run at once
+  memories.sort(reverse=True)
+  peak_memory = sum(memories[:options.processes])
+  if options.memory_budget and memories:
+    peak_memory = min(peak_memory, max(options.memory_budget * 2 ** 20, memories[0]))
+  print len(image_files), "pages,", round(peak_memory / 2 ** 20, 1), "MB estimated peak memory"
+
+#################
+# Segment pages #
+#################
+
+def get_ink_mask(im, threshold=None):
+  '''
+  Read in a page image and return a boolean array that is True for
+  the pixels of dark ink, i.e. darker than threshold. If no threshold
+  is given, the Otsu method is used to split the ink from the background
+  '''
+  if threshold is None:
+    threshold = filters.threshold_otsu(im)
+  return im < threshold
+
+
+def label_regions(im, threshold=None):
+  '''
+  Read in a page image and return an array in which the pixels of each
+  region of dark ink have their region's label. Regions that touch the
+  border of the page are dropped
+  '''
+  clean_border = segmentation.clear_border(get_ink_mask(im, threshold))
+  return label(clean_border)
+
+
+def segment_page(im, min_area=2000, pad=20, engine='otsu', min_gap=20, max_gap_ink=0,
+    scale=1, refine=False, strip_rows=1024, threshold=None):
+  '''
+  Read in a page image, the minimum area in pixels of a clipping, the
+  padding to add around each clipping and the engine that finds the
+  clippings ('otsu', 'tiled', which uses strip_rows, or 'xycut', which
+  uses min_gap and max_gap_ink), and return a list of (bbox, cropped)
+  tuples, one per clipping, where bbox is the clipping's (min_row,
+  min_col, max_row, max_col) and cropped is the padded crop. If scale > 1,
+  find the clippings on a copy of the page downsampled by that factor
+  (see find_clippings_at_scale). If threshold is None, the page's own
+  Otsu threshold splits the ink from the background
+  '''
+  if scale > 1:
+    boxes, labeled = find_clippings_at_scale(im, scale, refine, engine,
+      min_area, min_gap, max_gap_ink, strip_rows, threshold)
+  else:
+    boxes, labeled = find_clippings(im, engine, min_area, min_gap, max_gap_ink,
+      strip_rows, threshold)
+  return [(bbox, crop_region(im, bbox, pad)) for bbox in boxes]
+
+
+def find_clippings(im, engine='otsu', min_area=2000, min_gap=20, max_gap_ink=0,
+    strip_rows=1024, threshold=None):
+  '''
+  Read in a page image, the engine with which to segment it, that
+  engine's options and the ink threshold (None to use the page's Otsu
+  threshold), and return the bounding boxes of the clippings on
+  the page along with an array of labels for plotting: the region labels
+  for the 'otsu' engine, the ink mask for the 'xycut' engine, or None for
+  the 'tiled' engine, which never holds the labels of the whole page
+  '''
+  if engine == 'xycut':
+    mask = get_ink_mask(im, threshold)
+    return xy_cut(mask, min_area, min_gap, max_gap_ink), mask
+
+  elif engine == 'otsu':
+    labeled = label_regions(im, threshold)
+    return get_region_boxes(labeled, min_area), labeled
+
+  elif engine == 'tiled':
+    regions = label_regions_in_strips(im, strip_rows, threshold)
+    return [bbox for area, bbox in regions if area >= min_area], None
+
+  raise ValueError('unknown segmentation engine: ' + str(engine))
+
+
+def get_region_boxes(labeled, min_area=2000):
+  '''
+  Read in an array of region labels and return the bounding box
+  (min_row, min_col, max_row, max_col) of each region with at least
+  min_area pixels, in label order. Pages have thousands of specks of
+  noise, so areas are counted and small regions dropped before any
+  boxes are built, rather than building regionprops for every region
+  '''
+  areas = np.bincount(labeled.ravel())
+  objects = ndimage.find_objects(labeled)
+  return [(rows.start, cols.start, rows.stop, cols.stop)
+    for rows, cols in (objects[i - 1] for i in np.flatnonzero(areas >= min_area) if i)]
+
+
+def crop_region(im, bbox, pad=20):
+  '''
+  Read in a page image and a bounding box, and return the part of the
+  image in the box plus pad pixels on each side (within the page)
+  '''
+  minr, minc, maxr, maxc = bbox
+  return im[max(minr - pad, 0):maxr + pad, max(minc - pad, 0):maxc + pad]
+
+###################################
+# Projection profiles and XY-cuts #
+###################################
+
+def get_projection_profiles(im):
+  '''
+  Read in a page image (or ink mask) and return the sum of the pixel
+  values in each row and in each column of the page
+  '''
+  return im.sum(axis=1, dtype=np.int64), im.sum(axis=0, dtype=np.int64)
+
+
+def find_gaps(profile, min_gap, max_gap_ink=0):
+  '''
+  Read in a projection profile of an ink mask, and return the (start, stop)
+  positions of each run of at least min_gap rows (or columns) with no more
+  than max_gap_ink pixels of ink
+  '''
+  is_gap = (profile <= max_gap_ink).astype(np.int8)
+  edges = np.diff(np.concatenate(([0], is_gap, [0])))
+  starts = np.flatnonzero(edges == 1)
+  stops = np.flatnonzero(edges == -1)
+  keep = (stops - starts) >= min_gap
+  return list(zip(starts[keep], stops[keep]))
+
+
+def xy_cut(mask, min_area=2000, min_gap=20, max_gap_ink=0):
+  '''
+  Read in an ink mask and return the bounding boxes (min_row, min_col,
+  max_row, max_col) of the blocks found by recursive XY-cuts: each block
+  is trimmed to its ink and split along every gap of at least min_gap
+  empty rows, or else empty columns, until no gaps are left. Blocks with
+  fewer than min_area pixels of ink and blocks that touch the border of
+  the page are dropped. Boxes are returned in reading order
+  '''
+  boxes = []
+  height, width = mask.shape
+
+  def cut(min_row, max_row, min_col, max_col, cut_rows_first):
+    row_profile, col_profile = get_projection_profiles(mask[min_row:max_row, min_col:max_col])
+
+    # trim the block to the rows and columns with ink
+    ink_rows = np.flatnonzero(row_profile > max_gap_ink)
+    ink_cols = np.flatnonzero(col_profile > max_gap_ink)
+    if not len(ink_rows) or not len(ink_cols):
+      return
+
+    row_profile = row_profile[ink_rows[0]:ink_rows[-1] + 1]
+    col_profile = col_profile[ink_cols[0]:ink_cols[-1] + 1]
+    max_row = min_row + ink_rows[-1] + 1
+    min_row = min_row + ink_rows[0]
+    max_col = min_col + ink_cols[-1] + 1
+    min_col = min_col + ink_cols[0]
+
+    for cut_rows in [cut_rows_first, not cut_rows_first]:
+      profile = row_profile if cut_rows else col_profile
+      gaps = find_gaps(profile, min_gap, max_gap_ink)
+      if not gaps:
+        continue
+
+      # split the block into the runs between the gaps
+      bounds = [0] + [i for gap in gaps for i in gap] + [len(profile)]
+      for start, stop in zip(bounds[::2], bounds[1::2]):
+        if cut_rows:
+          cut(min_row + start, min_row + stop, min_col, max_col, False)
+        else:
+          cut(min_row, max_row, min_col + start, min_col + stop, True)
+      return
+
+    if min_row == 0 or min_col == 0 or max_row == height or max_col == width:
+      return
+
+    if row_profile.sum() >= min_area:
+      boxes.append((int(min_row), int(min_col), int(max_row), int(max_col)))
+
+  cut(0, height, 0, width, True)
+  return boxes
+
+#########################
+# Label pages in strips #
+#########################
+
+def label_regions_in_strips(im, strip_rows=1024, threshold=None):
+  '''
+  Read in a page image, and return an (area, bbox) tuple for each region
+  of dark ink that doesn't touch the border of the page, in the order in
+  which label_regions would label them. The page is thresholded and
+  labeled strip_rows rows at a time, and regions that cross the seams
+  between strips are joined with a union-find, so only one strip of
+  labels is held at once rather than a label for every pixel of the page
+  '''
+  if threshold is None:
+    threshold = threshold_otsu_in_strips(im, strip_rows)
+
+  height, width = im.shape[:2]
+  regions = RegionTable()
+  previous_row = None
+
+  for min_row in range(0, height, strip_rows):
+    max_row = min(min_row + strip_rows, height)
+    labels, n_labels = ndimage.label(im[min_row:max_row] < threshold,
+      structure=np.ones((3, 3)), output=np.int32)
+    if not n_labels:
+      previous_row = None
+      continue
+
+    # number the strip's regions after those of the strips above it
+    offset = regions.add_strip(labels, n_labels, min_row, min_row == 0, max_row == height)
+    labels[labels > 0] += offset
+
+    # join the regions that touch across the seam (8-connectivity)
+    if previous_row is not None:
+      for shift in [-1, 0, 1]:
+        above = previous_row[max(shift, 0):width + min(shift, 0)]
+        below = labels[0, max(-shift, 0):width + min(-shift, 0)]
+        touching = (above > 0) & (below > 0)
+        if touching.any():
+          pairs = np.unique(np.stack([above[touching], below[touching]], axis=1), axis=0)
+          for a, b in pairs:
+            regions.union(a, b)
+
+    previous_row = labels[-1].copy()
+
+  return regions.get_regions()
+
+
+def threshold_otsu_in_strips(im, strip_rows=1024):
+  '''
+  Read in a page image and return the same threshold as
+  filters.threshold_otsu(im). For images of unsigned integers the
+  histogram is counted strip_rows rows at a time, as bincount would
+  otherwise copy the whole page to 64 bit integers
+  '''
+  if im.dtype.kind != 'u':
+    return filters.threshold_otsu(im)
+  return threshold_otsu_from_histogram(get_histogram_in_strips(im, strip_rows))
+
+
+def get_histogram_in_strips(im, strip_rows=1024):
+  '''
+  Read in a page image of unsigned integers and return the number of
+  pixels with each value (256 bins for 8 bit pages), counted strip_rows
+  rows at a time
+  '''
+  hist = np.zeros(np.iinfo(im.dtype).max + 1, np.int64)
+  for min_row in range(0, im.shape[0], strip_rows):
+    strip_hist = np.bincount(im[min_row:min_row + strip_rows].ravel())
+    hist[:len(strip_hist)] += strip_hist
+  return hist
+
+
+def threshold_otsu_from_histogram(hist):
+  '''
+  Read in a histogram with one bin per pixel value, starting at 0, and
+  return the Otsu threshold of the pixels it counts
+  '''
+  values = np.flatnonzero(hist)
+  if len(values) < 2:
+    raise ValueError('the Otsu threshold needs pixels of more than one value')
+
+  bin_centers = np.arange(values[0], values[-1] + 1)
+  hist = hist[values[0]:values[-1] + 1].astype(float)
+
+  # class probabilities and means for all possible thresholds
+  weight1 = np.cumsum(hist)
+  weight2 = np.cumsum(hist[::-1])[::-1]
+  mean1 = np.cumsum(hist * bin_centers) / weight1
+  mean2 = (np.cumsum((hist * bin_centers)[::-1]) / weight2[::-1])[::-1]
+
+  variance12 = weight1[:-1] * weight2[1:] * (mean1[:-1] - mean2[1:]) ** 2
+  return bin_centers[:-1][np.argmax(variance12)]
+
+
+class RegionTable(object):
+
+  def __init__(self):
+    '''
+    Keep the area, bounding box and border contact of each region found
+    in the strips of a page, along with a union-find forest that joins
+    the regions that cross the seams between strips. Region 0 is the
+    background
+    '''
+    self.parent = np.zeros(1, np.int64)
+    self.area = np.zeros(1, np.int64)
+    self.bbox = np.zeros((1, 4), np.int64)
+    self.on_border = np.zeros(1, bool)
+
+
+  def add_strip(self, labels, n_labels, min_row, is_top, is_bottom):
+    '''
+    Read in the labels of one strip of a page, the number of regions in
+    the strip, the page row at which the strip starts, and whether the
+    strip is the top or bottom of the page, and add the strip's regions
+    to the table. Return the offset that maps the strip's labels onto
+    the table's
+    '''
+    offset = len(self.parent) - 1
+    height, width = labels.shape
+
+    area = np.bincount(labels.ravel(), minlength=n_labels + 1)[1:]
+    bbox = np.array([(rows.start + min_row, cols.start, rows.stop + min_row, cols.stop)
+      for rows, cols in ndimage.find_objects(labels)], np.int64)
+
+    # regions with pixels on the edge of the page
+    edges = [labels[:, 0], labels[:, -1]]
+    if is_top:
+      edges.append(labels[0])
+    if is_bottom:
+      edges.append(labels[-1])
+    on_border = np.zeros(n_labels + 1, bool)
+    on_border[np.concatenate(edges)] = True
+
+    self.parent = np.concatenate([self.parent, np.arange(offset + 1, offset + n_labels + 1)])
+    self.area = np.concatenate([self.area, area])
+    self.bbox = np.concatenate([self.bbox, bbox])
+    self.on_border = np.concatenate([self.on_border, on_border[1:]])
+    return offset
+
+
+  def find(self, label):
+    '''
+    Return the root of the tree that holds label, compressing the path
+    from label to the root as we go
+    '''
+    root = label
+    while self.parent[root] != root:
+      root = self.parent[root]
+    while self.parent[label] != root:
+      self.parent[label], label = root, self.parent[label]
+    return root
+
+
+  def union(self, a, b):
+    '''
+    Join the trees that hold labels a and b. The smaller root becomes
+    the root of both, so each region keeps the label of its first pixel
+    '''
+    a = self.find(a)
+    b = self.find(b)
+    if a != b:
+      self.parent[max(a, b)] = min(a, b)
+
+
+  def get_regions(self):
+    '''
+    Return an (area, bbox) tuple for each joined region that doesn't
+    touch the border of the page, in the order of their root labels
+    '''
+    # point every label straight at its root
+    roots = self.parent
+    while True:
+      next_roots = roots[roots]
+      if np.array_equal(next_roots, roots):
+        break
+      roots = next_roots
+
+    n = len(roots)
+    area = np.bincount(roots, weights=self.area, minlength=n).astype(np.int64)
+    on_border = np.bincount(roots, weights=self.on_border, minlength=n) > 0
+    bbox = self.bbox.copy()
+    np.minimum.at(bbox[:, 0], roots, self.bbox[:, 0])
+    np.minimum.at(bbox[:, 1], roots, self.bbox[:, 1])
+    np.maximum.at(bbox[:, 2], roots, self.bbox[:, 2])
+    np.maximum.at(bbox[:, 3], roots, self.bbox[:, 3])
+
+    return [(int(area[i]), tuple(int(j) for j in bbox[i]))
+      for i in range(1, n) if roots[i] == i and not on_border[i]]
+
+#####################
+# Volume thresholds #
+#####################
 
-  rect = mpatches.Rectangle((minc, minr), maxc - minc, maxr - minr,
-                              fill=False, edgecolor='red', linewidth=2)
+def get_volume_name(image_file):
+  '''
+  Read in the path to a page image and return the name of the volume
+  the page belongs to, i.e. the page name without its trailing page
+  number: lsidyv3f9b93cd_0031.jp2 belongs to lsidyv3f9b93cd
+  '''
+  page_name = os.path.splitext(os.path.basename(image_file))[0]
+  return re.sub(r'_\d+$', '', page_name)
 
-  ax.add_patch(rect)
 
-plt.show()
+def get_page_histogram(job):
+  '''
+  Read in an (image_file, decoded_dir) tuple and return an (image_file,
+  histogram) tuple, or (image_file, None) if the page can't be read or
+  isn't a page of unsigned integers. If decoded_dir is given, also save
+  the decoded page there, so segmenting the page doesn't decode it again
+  '''
+  image_file, decoded_dir = job
+  try:
+    im = read_image(image_file)
+    if im.dtype.kind != 'u':
+      return image_file, None
+    if decoded_dir:
+      save_decoded_page(im, image_file, decoded_dir)
+    return image_file, get_histogram_in_strips(im).tolist()
+  except Exception:
+    return image_file, None
+
+
+def get_decoded_page_path(image_file, decoded_dir):
+  '''
+  Read in the path to a page image and the directory of decoded pages,
+  and return the path to the npy file that holds the decoded page
+  '''
+  page_name = os.path.splitext(os.path.basename(image_file))[0]
+  return os.path.join(decoded_dir, page_name + '.npy')
+
+
+def save_decoded_page(im, image_file, decoded_dir):
+  '''
+  Read in a decoded page, the path to its page image and the directory
+  of decoded pages, and save the page to its npy file. The file is
+  written under a temporary name and then renamed, so a crash never
+  leaves a partial page behind
+  '''
+  if not os.path.exists(decoded_dir):
+    try:
+      os.makedirs(decoded_dir)
+    except OSError:
+      # another process made it first
+      pass
+
+  out_path = get_decoded_page_path(image_file, decoded_dir)
+  tmp_path = out_path + '.' + str(os.getpid()) + '.tmp'
+  with open(tmp_path, 'wb') as out:
+    np.save(out, im)
+  os.rename(tmp_path, out_path)
+
+
+def read_decoded_page(image_file, decoded_dir):
+  '''
+  Read in the path to a page image and the directory of decoded pages,
+  and return the page saved by the histogram pass, then remove its npy
+  file. If there is no saved page, or the page image changed after it
+  was saved, decode the page image instead
+  '''
+  if decoded_dir:
+    decoded_path = get_decoded_page_path(image_file, decoded_dir)
+    try:
+      if os.stat(decoded_path).st_mtime >= os.stat(image_file).st_mtime:
+        return np.load(decoded_path)
+    except (IOError, OSError, ValueError):
+      pass
+    finally:
+      if os.path.exists(decoded_path):
+        os.remove(decoded_path)
+
+  return read_image(image_file)
+
+
+def get_page_histograms(image_files, processes=1, histogram_path=None, decoded_dir=None):
+  '''
+  Read in a list of page images and return a dict that maps each page
+  to its histogram, counting the pages in a pool of processes. If
+  histogram_path is given, histograms are kept there between runs and
+  only recounted for pages whose size or mtime changed. If decoded_dir
+  is given, the pages that are recounted are saved there once decoded,
+  unless their decoded size is more than the free disk space. Pages that
+  can't be stat'ed get no histogram
+  '''
+  cached = {}
+  if histogram_path and os.path.exists(histogram_path):
+    with open(histogram_path) as f:
+      cached = json.load(f)
+
+  histograms = {}
+  stats = {}
+  missing = []
+  for image_file in image_files:
+    try:
+      stat = os.stat(image_file)
+    except OSError as exc:
+      print "could not read", image_file, exc
+      histograms[image_file] = None
+      continue
+
+    stats[image_file] = [stat.st_size, stat.st_mtime]
+    entry = cached.get(image_file)
+    if entry and entry['stat'] == stats[image_file]:
+      histograms[image_file] = entry['histogram']
+    else:
+      missing.append(image_file)
+
+  # every recounted page stays on disk until it's segmented
+  if decoded_dir and not decoded_pages_fit(missing, decoded_dir):
+    print "not saving decoded pages, as they need more than the free space in", decoded_dir
+    decoded_dir = None
+  missing = [(image_file, decoded_dir) for image_file in missing]
+
+  if processes > 1 and len(missing) > 1:
+    pool = Pool(processes)
+    results = pool.map(get_page_histogram, missing)
+    pool.close()
+    pool.join()
+  else:
+    results = [get_page_histogram(i) for i in missing]
+
+  for image_file, histogram in results:
+    histograms[image_file] = histogram
+
+  if histogram_path:
+    with open(histogram_path, 'w') as out:
+      json.dump({k: {'stat': stats[k], 'histogram': v}
+        for k, v in histograms.iteritems() if v is not None}, out)
+
+  return histograms
+
+
+def decoded_pages_fit(image_files, decoded_dir):
+  '''
+  Read in a list of page images and the directory of decoded pages, and
+  return True if the decoded pages, as sized from their headers, fit in
+  the free disk space of the file system that holds the directory
+  '''
+  decoded_bytes = 0
+  for image_file in image_files:
+    try:
+      height, width, channels, sample_bytes = read_image_size(image_file)
+    except Exception:
+      continue
+    decoded_bytes += height * width * channels * sample_bytes
+
+  directory = os.path.abspath(decoded_dir)
+  while not os.path.exists(directory):
+    directory = os.path.dirname(directory)
+  stat = os.statvfs(directory)
+  return decoded_bytes <= stat.f_bavail * stat.f_frsize
+
+
+def get_volume_thresholds(histograms, window=0):
+  '''
+  Read in a dict that maps page images to their histograms, and return
+  a dict that maps each page image to an ink threshold shared across its
+  volume. If window is 0, each page gets the Otsu threshold of the sum of
+  the histograms of all the pages in its volume; otherwise each page gets
+  the Otsu threshold of the pages up to window pages before and after it,
+  so the threshold can drift slowly through a volume. Pages without
+  a histogram get None, i.e. their own threshold
+  '''
+  volumes = {}
+  for image_file in sorted(histograms):
+    if histograms[image_file] is not None:
+      volumes.setdefault(get_volume_name(image_file), []).append(image_file)
+
+  thresholds = {i: None for i in histograms}
+  for volume, image_files in volumes.iteritems():
+    n_bins = max(len(histograms[i]) for i in image_files)
+    hists = np.zeros((len(image_files), n_bins), np.int64)
+    for page_index, image_file in enumerate(image_files):
+      hists[page_index, :len(histograms[image_file])] = histograms[image_file]
+
+    # window_hists[i] = sum of hists[i - window:i + window + 1]
+    if window:
+      cumulative = np.vstack([np.zeros((1, n_bins), np.int64), np.cumsum(hists, axis=0)])
+      page_indices = np.arange(len(image_files))
+      starts = np.maximum(page_indices - window, 0)
+      stops = np.minimum(page_indices + window + 1, len(image_files))
+      window_hists = cumulative[stops] - cumulative[starts]
+    else:
+      window_hists = np.tile(hists.sum(axis=0), (len(image_files), 1))
+
+    for image_file, hist in zip(image_files, window_hists):
+      try:
+        thresholds[image_file] = threshold_otsu_from_histogram(hist)
+      except ValueError:
+        pass
+
+  return thresholds
+
+##########################
+# Multi-resolution pages #
+##########################
+
+def downsample(im, factor):
+  '''
+  Read in a page image and an integer factor, and return a copy of the
+  image with each factor x factor block of pixels replaced by its mean.
+  Rows and columns past the last full block are dropped
+  '''
+  if factor <= 1:
+    return im
+
+  height = im.shape[0] // factor * factor
+  width = im.shape[1] // factor * factor
+  blocks = im[:height, :width].reshape(
+    (height // factor, factor, width // factor, factor) + im.shape[2:])
+  return blocks.mean(axis=(1, 3)).astype(im.dtype)
+
+
+def find_clippings_at_scale(im, scale, refine=False, engine='otsu', min_area=2000,
+    min_gap=20, max_gap_ink=0, strip_rows=1024, threshold=None):
+  '''
+  Read in a page image and a downsampling factor, find the clippings on
+  the downsampled page with the given engine, and return their bounding
+  boxes in full resolution pixels along with the downsampled labels.
+  Areas, gaps and gap ink are scaled down to match the downsampled page.
+  Mapped boxes are only accurate to scale pixels; if refine is True, each
+  edge is moved to the outermost ink within scale pixels of it at full
+  resolution
+  '''
+  small = downsample(im, scale)
+  boxes, labeled = find_clippings(small, engine, max(min_area // scale ** 2, 1),
+    max(min_gap // scale, 1), max_gap_ink // scale, strip_rows, threshold)
+
+  height, width = im.shape[:2]
+  boxes = [(minr * scale, minc * scale, min(maxr * scale, height), min(maxc * scale, width))
+    for minr, minc, maxr, maxc in boxes]
+
+  if refine:
+    if threshold is None:
+      threshold = filters.threshold_otsu(small)
+    boxes = [refine_box(im, bbox, threshold, scale) for bbox in boxes]
+
+  return boxes, labeled
+
+
+def refine_box(im, bbox, threshold, margin):
+  '''
+  Read in a full resolution page image, a bounding box found at lower
+  resolution, the ink threshold and the number of pixels by which the
+  box's edges may be off, and return the box with each edge moved to the
+  outermost row or column of ink within margin pixels of it. Only the
+  bands of the page along the edges are read
+  '''
+  minr, minc, maxr, maxc = bbox
+  height, width = im.shape[:2]
+
+  # the range in which each edge may lie
+  top = max(minr - margin, 0), min(minr + margin, maxr)
+  bottom = max(maxr - margin, minr), min(maxr + margin, height)
+  left = max(minc - margin, 0), min(minc + margin, maxc)
+  right = max(maxc - margin, minc), min(maxc + margin, width)
+
+  rows = np.flatnonzero((im[top[0]:top[1], left[0]:right[1]] < threshold).any(axis=1))
+  if len(rows):
+    minr = top[0] + rows[0]
+
+  rows = np.flatnonzero((im[bottom[0]:bottom[1], left[0]:right[1]] < threshold).any(axis=1))
+  if len(rows):
+    maxr = bottom[0] + rows[-1] + 1
+
+  cols = np.flatnonzero((im[top[0]:bottom[1], left[0]:left[1]] < threshold).any(axis=0))
+  if len(cols):
+    minc = left[0] + cols[0]
+
+  cols = np.flatnonzero((im[top[0]:bottom[1], right[0]:right[1]] < threshold).any(axis=0))
+  if len(cols):
+    maxc = right[0] + cols[-1] + 1
+
+  return int(minr), int(minc), int(maxr), int(maxc)
+
+
+def compare_boxes(boxes, reference_boxes, min_iou=0.9):
+  '''
+  Read in two lists of bounding boxes, pair each reference box with the
+  box that overlaps it most (each box is used once), and return the
+  number of boxes in each list, the mean intersection over union of the
+  reference boxes (0 for those without a pair) and the number of
+  reference boxes with a pair whose intersection over union is at
+  least min_iou
+  '''
+  comparison = {
+    'boxes': len(boxes),
+    'reference_boxes': len(reference_boxes),
+    'mean_iou': 1.0 if not reference_boxes and not boxes else 0.0,
+    'matched': 0
+  }
+  if not len(boxes) or not len(reference_boxes):
+    return comparison
+
+  a = np.array(boxes, np.float64)[:, None, :]
+  b = np.array(reference_boxes, np.float64)[None, :, :]
+
+  heights = np.clip(np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0]), 0, None)
+  widths = np.clip(np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1]), 0, None)
+  intersections = heights * widths
+  areas_a = (a[..., 2] - a[..., 0]) * (a[..., 3] - a[..., 1])
+  areas_b = (b[..., 2] - b[..., 0]) * (b[..., 3] - b[..., 1])
+  iou = intersections / np.maximum(areas_a + areas_b - intersections, 1)
+
+  # pair boxes greedily, starting with the pair that overlaps most
+  ious = []
+  for _ in range(min(iou.shape)):
+    i, j = np.unravel_index(np.argmax(iou), iou.shape)
+    if iou[i, j] <= 0:
+      break
+    ious.append(iou[i, j])
+    iou[i, :] = -1
+    iou[:, j] = -1
+
+  comparison['mean_iou'] = round(sum(ious) / len(reference_boxes), 4)
+  comparison['matched'] = sum(1 for i in ious if i >= min_iou)
+  return comparison
+
+#################
+# Visualization #
+#################
+
+def save_visualization(im, labeled, boxes, out_path):
+  '''
+  Read in a page image, its region labels and clipping boxes, and
+  write a plot of the labeled regions with a red rectangle around
+  each clipping to out_path, next to plots of the amount of ink across
+  the page's rows and columns. matplotlib is imported here, with a
+  backend that doesn't need a display, as it's only used for plots
+  '''
+  import matplotlib
+  matplotlib.use('Agg')
+  import matplotlib.pyplot as plt
+  import matplotlib.patches as mpatches
+
+  image_label_overlay = label2rgb(labeled, image=im)
+  row_vals, col_vals = get_projection_profiles(labeled > 0)
+
+  fig, (ax, row_ax, col_ax) = plt.subplots(ncols=3, nrows=1, figsize=(18, 6))
+  row_ax.plot(row_vals)
+  row_ax.set_title('ink per row')
+  col_ax.plot(col_vals)
+  col_ax.set_title('ink per column')
+  ax.imshow(image_label_overlay)
+
+  # bbox describes: min_row, min_col, max_row, max_col
+  for minr, minc, maxr, maxc in boxes:
+    rect = mpatches.Rectangle((minc, minr), maxc - minc, maxr - minr,
+                                fill=False, edgecolor='red', linewidth=2)
+    ax.add_patch(rect)
+
+  fig.savefig(out_path)
+  plt.close(fig)
 
 ###############
 # Crop images #
 ###############
 
-out_dir = "segmented_articles/"
-if not os.path.exists(out_dir):
-  os.makedirs(out_dir)
+def write_cropped_image(job):
+  '''
+  Read in an (out_path, image) tuple and write the image to out_path.
+  Return the path and error if the image could not be written
+  '''
+  out_path, cropped_image = job
+  try:
+    io.imsave(out_path, cropped_image)
+  except Exception as exc:
+    return out_path, repr(exc)
+
+
+def segment_file(job):
+  '''
+  Read in an (image_file, options, threshold) tuple, segment that page
+  (with its own Otsu threshold if threshold is None), and write
+  each clipping to options.out_dir as {{page name}}_{{index}}.png.
+  Pages the histogram pass decoded are read from its saved copy.
+  Return the image file, the number of clippings, a list of errors, and
+  if options.compare is set, the comparison of the boxes with the boxes
+  found at full resolution
+  '''
+  image_file, options, threshold = job
+  page_name = os.path.splitext(os.path.basename(image_file))[0]
+  comparison = None
+
+  try:
+    im = read_decoded_page(image_file, get_decoded_dir(options))
+    if options.scale > 1:
+      boxes, labeled = find_clippings_at_scale(im, options.scale, options.refine,
+        options.engine, options.min_area, options.min_gap, options.max_gap_ink,
+        options.strip_rows, threshold)
+    else:
+      boxes, labeled = find_clippings(im, options.engine, options.min_area,
+        options.min_gap, options.max_gap_ink, options.strip_rows, threshold)
+
+    if options.compare:
+      reference_boxes, reference_labels = find_clippings(im, options.engine,
+        options.min_area, options.min_gap, options.max_gap_ink, options.strip_rows,
+        threshold)
+      comparison = compare_boxes(boxes, reference_boxes)
+
+  except Exception as exc:
+    return image_file, 0, [(image_file, repr(exc))], comparison
+
+  if options.verbose:
+    for region_index, (minr, minc, maxr, maxc) in enumerate(boxes):
+      print page_name, "region", region_index, "bounding box:", minr, minc, maxr, maxc
+
+  jobs = [(os.path.join(options.out_dir, page_name + "_" + str(c) + ".png"), crop_region(im, bbox, options.pad))
+    for c, bbox in enumerate(boxes)]
+
+  # write the crops from a pool of threads, so PNG encoding and disk writes overlap
+  writer_pool = ThreadPool(options.writer_threads)
+  errors = [i for i in writer_pool.imap_unordered(write_cropped_image, jobs) if i]
+  writer_pool.close()
+  writer_pool.join()
+
+  if options.visualize:
+    try:
+      # plot the labels at the resolution at which they were found
+      plot_im = downsample(im, options.scale)
+      plot_boxes = [tuple(i // options.scale for i in bbox) for bbox in boxes]
+      if labeled is None:
+        labeled = get_ink_mask(plot_im, threshold)
+      save_visualization(plot_im, labeled, plot_boxes,
+        os.path.join(options.out_dir, page_name + "_regions.png"))
+    except Exception as exc:
+      errors.append((image_file, repr(exc)))
+
+  return image_file, len(jobs), errors, comparison
+
+
+def segment_files(image_files, options):
+  '''
+  Read in a list of page images and the command line options, and
+  segment each page in a pool of options.processes processes. Pages
+  that fail are logged to unprocessable-images.txt and skipped. With
+  options.threshold == 'volume', the histograms of all the pages are
+  counted first, and each page is split into ink and background with
+  a threshold shared across its volume. With options.memory_budget,
+  pages only start while their estimated memory fits in the budget
+  '''
+  if not os.path.exists(options.out_dir):
+    os.makedirs(options.out_dir)
+
+  thresholds = {}
+  if options.threshold == 'volume':
+    histogram_path = os.path.join(options.out_dir, 'page_histograms.json')
+    histograms = get_page_histograms(image_files, options.processes, histogram_path,
+      get_decoded_dir(options))
+    thresholds = get_volume_thresholds(histograms, options.threshold_window)
+    print_volume_thresholds(histograms, thresholds)
+
+  jobs = [(image_file, options, thresholds.get(image_file)) for image_file in image_files]
+
+  if options.processes > 1 and options.memory_budget:
+    pool = Pool(options.processes)
+    memories = [estimate_page_memory(image_file, options) for image_file in image_files]
+    results = imap_within_budget(pool, segment_file, jobs, memories,
+      options.memory_budget * 2 ** 20, options.processes)
+  elif options.processes > 1:
+    pool = Pool(options.processes)
+    results = pool.imap_unordered(segment_file, jobs)
+  else:
+    results = (segment_file(i) for i in jobs)
+
+  ious = []
+  for n_done, (image_file, n_clippings, errors, comparison) in enumerate(results, 1):
+    print n_done, "of", len(jobs), image_file, n_clippings, "clippings"
+
+    if comparison:
+      ious.append(comparison['mean_iou'])
+      print "  compared with full resolution:", comparison['matched'], "of",
+      print comparison['reference_boxes'], "boxes matched, mean IoU", comparison['mean_iou']
+
+    if errors:
+      with open('unprocessable-images.txt', 'a') as out:
+        for path, error in errors:
+          print "could not process", path, error
+          out.write(path + ' ' + error + '\n')
+
+  if options.processes > 1:
+    pool.close()
+    pool.join()
+
+  # each saved page is removed once it's read, so anything left here
+  # belongs to pages that weren't segmented in this run
+  decoded_dir = get_decoded_dir(options)
+  if decoded_dir and os.path.isdir(decoded_dir):
+    rmtree(decoded_dir, ignore_errors=True)
+
+  if ious:
+    print "mean IoU with full resolution boxes over", len(ious), "pages:", round(sum(ious) / len(ious), 4)
+
+
+def get_decoded_dir(options):
+  '''
+  Read in the command line options and return the directory in which
+  the histogram pass saves decoded pages, or None if there's no
+  histogram pass
+  '''
+  if options.threshold == 'volume':
+    return os.path.join(options.out_dir, 'decoded_pages')
+  return None
+
+
+def print_volume_thresholds(histograms, thresholds):
+  '''
+  Read in the histograms and volume thresholds of each page, and print
+  the range of the volume thresholds of each volume next to the range
+  of the thresholds the pages would get on their own
+  '''
+  volumes = {}
+  for image_file, threshold in thresholds.iteritems():
+    if threshold is None:
+      continue
+    try:
+      page_threshold = threshold_otsu_from_histogram(np.array(histograms[image_file]))
+    except ValueError:
+      page_threshold = threshold
+    volumes.setdefault(get_volume_name(image_file), []).append((threshold, page_threshold))
+
+  for volume, pairs in sorted(volumes.iteritems()):
+    volume_thresholds, page_thresholds = zip(*pairs)
+    print volume, len(pairs), "pages, volume thresholds", min(volume_thresholds), "-",
+    print max(volume_thresholds), "(page thresholds", min(page_thresholds), "-", str(max(page_thresholds)) + ")"
+
+
+def parse_args(argv=None):
+  '''
+  Parse the command line arguments
+  '''
+  parser = argparse.ArgumentParser(description='Segment periodical pages into clippings')
+  parser.add_argument('paths', nargs='+', help='page images or directories of page images')
+  parser.add_argument('--pattern', default='*.jp2', help='pattern of page images in directories')
+  parser.add_argument('--out-dir', default='segmented_articles')
+  parser.add_argument('--processes', type=int, default=cpu_count())
+  parser.add_argument('--writer-threads', type=int, default=4)
+  parser.add_argument('--engine', choices=['otsu', 'tiled', 'xycut'], default='otsu',
+    help='label connected regions of ink (otsu, or tiled to label in strips) '
+      'or cut the page along gaps in the ink (xycut)')
+  parser.add_argument('--min-area', type=int, default=2000, help='minimum clipping area in pixels')
+  parser.add_argument('--min-gap', type=int, default=20,
+    help='xycut: minimum width in pixels of a gap between clippings')
+  parser.add_argument('--max-gap-ink', type=int, default=0,
+    help='xycut: maximum pixels of ink in a row or column of a gap (to ignore specks)')
+  parser.add_argument('--strip-rows', type=int, default=1024,
+    help='tiled: rows of the page to label at once')
+  parser.add_argument('--threshold', choices=['page', 'volume'], default='page',
+    help="split ink from background with each page's own threshold, or one shared by its volume")
+  parser.add_argument('--threshold-window', type=int, default=0,
+    help='volume: share thresholds between pages at most this many pages apart (0 for the whole volume)')
+  parser.add_argument('--pad', type=int, default=20, help='padding around each clipping in pixels')
+  parser.add_argument('--scale', type=int, default=1,
+    help='find clippings on the page downsampled by this factor, then crop at full resolution')
+  parser.add_argument('--refine', action='store_true',
+    help='with --scale, fit the edges of each box to the ink at full resolution')
+  parser.add_argument('--compare', action='store_true',
+    help='also segment each page at full resolution and report how well the boxes match')
+  parser.add_argument('--memory-budget', type=int,
+    help='only start pages while their estimated memory fits in this many MB')
+  parser.add_argument('--dry-run', action='store_true',
+    help='only print the pages, pixels and estimated peak memory of each volume')
+  parser.add_argument('--visualize', action='store_true',
+    help='also write a plot of the regions of each page to {{page name}}_regions.png')
+  parser.add_argument('--verbose', action='store_true', help='print the bounding box of each clipping')
+  return parser.parse_args(argv)
+
 
-# can crop using: cropped = image_array[x1:x2,y1:y2]
+if __name__ == '__main__':
+  options = parse_args()
+  image_files = get_image_files(options.paths, options.pattern)
 
-for c, cropped_image in enumerate(cropped_images):
-  io.imsave( out_dir + str(c) + ".png", cropped_image)
+  if options.dry_run:
+    print_cost_estimate(image_files, options)
+  else:
+    segment_files(image_files, options)
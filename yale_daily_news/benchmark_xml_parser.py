@@ -0,0 +1,170 @@
+from __future__ import division
+from segment_ydn_images import iter_clip_coords
+import glob, os, codecs, sys, time
+
+'''
+Compare the streaming articles.xml parser in segment_ydn_images.py
+with the string splitting helpers it replaced. Usage:
+
+python benchmark_xml_parser.py {{path to directory with issue subdirectories}}
+'''
+
+#################################
+# Legacy string split XML parse #
+#################################
+
+def read_xml_file(xml_file_path):
+  '''
+  Read in the path to an xml file and return that
+  xml file content in string form
+  '''
+  with codecs.open(xml_file_path, 'r', 'utf-8') as f:
+    return f.read()
+
+
+def get_xml_articles(xml_content):
+  '''
+  Read in a string containing XML content and return an array
+  of the articles in that XML document
+  '''
+  articles = []
+
+  for i in xml_content.split('<article')[1:]:
+    article_start = '>'.join(i.split('>')[1:])
+    article_content = article_start.split('</article')[0]
+    articles.append(article_content)
+
+  return articles
+
+
+def get_article_clips(article, restrict_to_uc=1):
+  '''
+  Read in the xml content from an article and return an array of
+  the clips in that article. If restrict_to_uc == 1, only return
+  clips if they have type 'uc'
+  '''
+
+  article_clips = []
+
+  for i in article.split('<clip')[1:]:
+
+    if restrict_to_uc == 1:
+      if 'type="uc"' not in i:
+        continue
+
+    clip_start = '>'.join(i.split('>')[1:])
+    clip_content = clip_start.split('</clip')[0]
+    article_clips.append(clip_content)
+
+  return article_clips
+
+
+def get_clip_coords(article_clip):
+  '''
+  Read in the clip content of a jp2 xml file and return an array of the
+  coord elements within that clip element
+  '''
+
+  clip_coords = []
+
+  for i in article_clip.split('\n')[1:-1]:
+    clip_coords.append(i.replace('\r',''))
+
+  return clip_coords
+
+
+def get_coordinate_array(coord_element):
+  '''
+  Read in a string denoting one <coord>...</coord>
+  element in the current jp2's associated xml file, and return
+  an array of integers that denote the element's x offset
+  y offset, width, and height (in that order), as well as
+  an integer that indicates the page in which that rectangle
+  is present
+  '''
+
+  page_with_rectangle = coord_element.split('inpage="')[1].split('"')[0]
+
+  coordinates_start = coord_element.split('<coord')[1]
+  coordinates_clean_start = '>'.join(coordinates_start.split('>')[1:])
+  clean_coordinates = coordinates_clean_start.split('</coord>')[0]
+
+  return [int(i) for i in clean_coordinates.split(':')], page_with_rectangle
+
+
+def legacy_clip_coords(xml_file_path):
+  '''
+  Read in the path to an articles.xml file and return a list of
+  (article_index, clip_index, coord_index, inpage, coords) tuples
+  parsed with the legacy string split helpers
+  '''
+  records = []
+  xml_content = read_xml_file(xml_file_path)
+  for article_index, xml_article in enumerate(get_xml_articles(xml_content)):
+    for clip_index, xml_clip in enumerate(get_article_clips(xml_article)):
+      for coord_index, xml_coord in enumerate(get_clip_coords(xml_clip)):
+        coords, inpage = get_coordinate_array(xml_coord)
+        records.append((article_index, clip_index, coord_index, int(inpage), coords))
+  return records
+
+
+def streaming_clip_coords(xml_file_path):
+  '''
+  Read in the path to an articles.xml file and return a list of
+  (article_index, clip_index, coord_index, inpage, coords) tuples
+  parsed with the streaming parser
+  '''
+  return [tuple(i) for i in iter_clip_coords(xml_file_path)]
+
+
+#############
+# Benchmark #
+#############
+
+def time_parser(parser, xml_files, n_repeats=3):
+  '''
+  Read in a parser function and a list of xml files, parse each file
+  n_repeats times, and return the fastest total time in seconds
+  along with the number of coords that parser found
+  '''
+  best = None
+  for _ in range(n_repeats):
+    n_coords = 0
+    start = time.time()
+    for xml_file in xml_files:
+      n_coords += len(parser(xml_file))
+    elapsed = time.time() - start
+    if best is None or elapsed < best:
+      best = elapsed
+  return best, n_coords
+
+
+def count_mismatches(xml_files):
+  '''
+  Return the number of xml files for which the two parsers disagree.
+  The legacy helpers misread coords that don't sit on their own line
+  and clips that follow a 'uc' clip in the same article
+  '''
+  mismatches = 0
+  for xml_file in xml_files:
+    try:
+      if legacy_clip_coords(xml_file) != streaming_clip_coords(xml_file):
+        mismatches += 1
+    except (ValueError, IndexError):
+      mismatches += 1
+  return mismatches
+
+
+if __name__ == '__main__':
+  root_data_directory = sys.argv[1]
+  xml_files = sorted(glob.glob(os.path.join(root_data_directory, '*', '*.articles.xml')))
+
+  for label, parser in [
+    ('legacy', legacy_clip_coords),
+    ('streaming', streaming_clip_coords)
+  ]:
+    elapsed, n_coords = time_parser(parser, xml_files)
+    print label, len(xml_files), 'files', n_coords, 'coords',
+    print round(elapsed, 4), 'seconds', round(len(xml_files) / max(elapsed, 1e-9), 1), 'files/sec'
+
+  print 'files where the parsers disagree:', count_mismatches(xml_files)
@@ -0,0 +1,199 @@
+from __future__ import division
+from synthetic_corpus import write_synthetic_corpus
+from multiprocessing import Pipe, Process
+from shutil import rmtree
+import segment_ydn_images as ydn
+import argparse, json, os, resource, tempfile, time
+
+'''
+Time each stage of segment_ydn_images.py on a synthetic corpus and
+report pages/sec, rects/sec, peak memory and bytes written per stage.
+Stages run one after another in a scratch directory, with the same
+module settings the script's main block uses. Each stage runs in its own
+child process, so its peak memory isn't hidden by an earlier stage's. Usage:
+
+python benchmark_ydn.py --issues 20 --pages 8 --multiprocess
+'''
+
+def configure(args):
+  '''
+  Read in the parsed command line arguments and set the module level
+  settings of segment_ydn_images to match
+  '''
+  settings = {
+    'verbosity_level': 0,
+    'n_processes': args.processes,
+    'max_files_to_process': 10 ** 9,
+    'multiprocess': args.multiprocess,
+    'order_by_cost': True,
+    'n_writer_threads': args.writer_threads,
+    'max_queued_writes': 64,
+    'padding': 5,
+    'npy_cache_budget': None,
+    'page_store': args.page_store,
+    'tile_size': 512,
+    'decode_mode': args.decode_mode,
+    'resolution_level': 0,
+    'incremental': False,
+    'selected_issues': None,
+    'fused': False,
+    'output_backend': args.output_backend,
+    'metrics_path': args.metrics,
+    'catalog_path': None,
+    'memory_budget': args.memory_budget and args.memory_budget * 2 ** 20,
+    'decode_memory_factor': 6,
+    'dry_run': False,
+    'shard': None,
+    'shard_directory': 'shard_outputs',
+    'journal_path': None
+  }
+  for name, value in settings.iteritems():
+    setattr(ydn, name, value)
+
+
+def get_directory_size(path):
+  '''
+  Read in the path to a directory and return the total size in bytes
+  of the files beneath it
+  '''
+  size = 0
+  for directory, subdirectories, files in os.walk(path):
+    for i in files:
+      try:
+        size += os.path.getsize(os.path.join(directory, i))
+      except OSError:
+        pass
+  return size
+
+
+def get_peak_rss():
+  '''
+  Return the peak resident set size in megabytes of this process and
+  of its largest finished child process (ru_maxrss is in kB on Linux).
+  Both are peaks over the lifetime of the process
+  '''
+  own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+  return round(own / 1024, 1), round(children / 1024, 1)
+
+
+def run_stage_in_child(stage):
+  '''
+  Run one pipeline stage in a forked child process and return the peak
+  resident set size in megabytes of that process (which starts from the
+  size of this process) and of its largest worker process
+  '''
+  parent_end, child_end = Pipe(duplex=False)
+  child = Process(target=measure_stage, args=(stage, child_end))
+  child.start()
+  child_end.close()
+
+  try:
+    peak_rss = parent_end.recv()
+  except EOFError:
+    peak_rss = None
+  child.join()
+
+  if peak_rss is None or child.exitcode:
+    raise RuntimeError('stage failed with exit code ' + str(child.exitcode))
+  return peak_rss
+
+
+def measure_stage(stage, connection):
+  '''
+  Run one pipeline stage, write the stage's queued images and metrics,
+  and send the peak memory of this process and its workers to connection
+  '''
+  stage()
+  ydn.close_image_writer()
+  ydn.get_metrics().close()
+  connection.send(get_peak_rss())
+
+
+def time_stage(name, stage, n_pages, n_rects, work_directory):
+  '''
+  Run one pipeline stage in a child process and return a dict with its
+  wall time, page and rect throughput, peak memory, and the growth in
+  bytes of the work directory (stages that only move files write 0 bytes)
+  '''
+  size_before = get_directory_size(work_directory)
+  start = time.time()
+  own_rss, children_rss = run_stage_in_child(stage)
+  elapsed = max(time.time() - start, 1e-9)
+
+  return {
+    'stage': name,
+    'seconds': round(elapsed, 3),
+    'pages_per_second': round(n_pages / elapsed, 2),
+    'rects_per_second': round(n_rects / elapsed, 2),
+    'peak_rss_mb': own_rss,
+    'peak_child_rss_mb': children_rss,
+    'bytes_written': max(get_directory_size(work_directory) - size_before, 0)
+  }
+
+
+def get_stages(root_data_directory):
+  '''
+  Read in the path to the corpus and return a list of (name, function)
+  tuples for each stage of the pipeline, in the order they run
+  '''
+  return [
+    ('convert', lambda: ydn.convert_jp2_images_to_numpy_arrays(root_data_directory)),
+    ('mapping', lambda: ydn.generate_issue_page_rectangle_mapping(root_data_directory)),
+    ('segment', ydn.segment_images),
+    ('sort', ydn.sort_segmented_images),
+    ('stack', ydn.stack_segmented_images)
+  ]
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark each stage of the YDN pipeline')
+  parser.add_argument('--issues', type=int, default=10)
+  parser.add_argument('--pages', type=int, default=8, help='pages per issue')
+  parser.add_argument('--articles', type=int, default=10, help='articles per page')
+  parser.add_argument('--height', type=int, default=3000, help='page height in pixels')
+  parser.add_argument('--width', type=int, default=2200, help='page width in pixels')
+  parser.add_argument('--processes', type=int, default=4)
+  parser.add_argument('--multiprocess', action='store_true')
+  parser.add_argument('--writer-threads', type=int, default=4)
+  parser.add_argument('--decode-mode', choices=['full', 'region'], default='full')
+  parser.add_argument('--output-backend', choices=['files', 'shards'], default='files')
+  parser.add_argument('--page-store', choices=['npy', 'tiles'], default='npy')
+  parser.add_argument('--memory-budget', type=int, help='memory budget for decodes and crops in MB')
+  parser.add_argument('--work-dir', help='directory for the corpus and outputs (default: a temp dir)')
+  parser.add_argument('--json', help='also write the results to this file')
+  parser.add_argument('--metrics', help='append the pipeline metrics log to this file')
+  args = parser.parse_args()
+
+  work_directory = os.path.abspath(args.work_dir or tempfile.mkdtemp(prefix='ydn-benchmark-'))
+  root_data_directory = os.path.join(work_directory, 'corpus')
+  output_directory = os.path.join(work_directory, 'output')
+  for i in [root_data_directory, output_directory]:
+    if os.path.exists(i):
+      rmtree(i)
+  os.makedirs(output_directory)
+
+  n_pages, n_rects = write_synthetic_corpus(root_data_directory, args.issues,
+    args.pages, args.articles, (args.height, args.width))
+  print 'corpus:', args.issues, 'issues', n_pages, 'pages', n_rects, 'rects'
+
+  configure(args)
+  os.chdir(output_directory)
+  if args.output_backend == 'shards':
+    os.makedirs('shards')
+
+  results = []
+  for name, stage in get_stages(root_data_directory):
+    if name == 'convert' and args.decode_mode == 'region':
+      continue
+    result = time_stage(name, stage, n_pages, n_rects, output_directory)
+    results.append(result)
+    print '{stage:8} {seconds:>9} s {pages_per_second:>9} pages/s {rects_per_second:>10} rects/s'.format(**result),
+    print '{peak_rss_mb:>8} MB {peak_child_rss_mb:>8} MB children {bytes_written:>12} bytes'.format(**result)
+
+  ydn.close_image_writer()
+  ydn.get_metrics().close()
+
+  if args.json:
+    with open(args.json, 'w') as out:
+      json.dump(results, out, indent=2)
@@ -0,0 +1,120 @@
+from multiprocessing import current_process
+from collections import defaultdict
+import json, os, time
+
+# fcntl is only available on unix; elsewhere, records rely on O_APPEND alone
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+'''
+Record each unit of work that fails as one JSON line in a journal: the
+stage that was running, the kind of failure, the issue, page and rect
+it concerns, the exception type and message, and when it happened and
+how long the unit ran before it failed. The processes of a pool share
+the journal: each record is one write to a file opened with O_APPEND,
+made while holding an exclusive flock on the file, so records from
+different processes (or nodes sharing a working directory over a file
+system that supports locks) never interleave. The plain text error
+files a run has always written (e.g. unprocessable-images.txt) are
+appended to the same way, so they keep working for existing scripts.
+'''
+
+class FailureJournal(object):
+
+  def __init__(self, path):
+    '''
+    Start a journal that appends failures to path. If path is None,
+    failures are only written to their plain text error files
+    '''
+    self.path = path
+
+
+  def record(self, stage, kind, issue=None, page=None, rect_id=None,
+      exc=None, seconds=None, text_path=None, text=None, **fields):
+    '''
+    Append one failure to the journal, with the time, process id and
+    worker name of the process that hit it. If exc is given, record its
+    type and message. If text_path is given, also append text (one line)
+    to that plain text error file
+    '''
+    if text_path is not None:
+      append_locked(text_path, text + '\n')
+
+    if self.path is None:
+      return
+
+    record = {
+      'stage': stage,
+      'kind': kind,
+      'issue': issue,
+      'page': page,
+      'rect_id': rect_id,
+      'error': type(exc).__name__ if exc is not None else None,
+      'message': str(exc) if exc is not None else None,
+      'seconds': round(seconds, 6) if seconds is not None else None,
+      'time': round(time.time(), 6),
+      'pid': os.getpid(),
+      'worker': current_process().name
+    }
+    record.update(fields)
+    append_locked(self.path, json.dumps(record, sort_keys=True) + '\n')
+
+
+def append_locked(path, data):
+  '''
+  Append data to the file at path in a single write, holding an
+  exclusive lock on the file while writing
+  '''
+  fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+  try:
+    if fcntl is not None:
+      fcntl.flock(fd, fcntl.LOCK_EX)
+    os.write(fd, data)
+  finally:
+    # closing the file releases the lock
+    os.close(fd)
+
+
+def read_failures(path):
+  '''
+  Read in the path to a failure journal and return a list of its
+  records (an empty list if there is no journal). A line cut short by
+  a crash mid-write is skipped
+  '''
+  if not os.path.exists(path):
+    return []
+
+  failures = []
+  with open(path) as f:
+    for line in f:
+      try:
+        failures.append(json.loads(line))
+      except ValueError:
+        pass
+  return failures
+
+
+def summarize_failures(failures):
+  '''
+  Read in a list of failure records and return a dict that maps each
+  (stage, kind) pair to the number of failures and the issues they hit
+  '''
+  summary = defaultdict(lambda: {'count': 0, 'issues': set()})
+  for failure in failures:
+    totals = summary[(failure['stage'], failure['kind'])]
+    totals['count'] += 1
+    if failure.get('issue'):
+      totals['issues'].add(failure['issue'])
+  return dict(summary)
+
+
+if __name__ == '__main__':
+  import sys
+
+  # print the number of failures of each kind in each stage, and the
+  # number of issues they hit. Usage:
+  # python failure_journal.py failures.jsonl
+  for (stage, kind), totals in sorted(summarize_failures(read_failures(sys.argv[1])).iteritems()):
+    print stage, kind, totals['count'], 'failures in', len(totals['issues']), 'issues'
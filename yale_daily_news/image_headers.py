@@ -0,0 +1,136 @@
+from collections import namedtuple
+import struct
+
+'''
+Read the dimensions of jp2 and png page images from their headers,
+without decoding any pixels. A jp2 file keeps its size in the ihdr box
+inside the jp2h box near the start of the file (a bare j2k codestream
+keeps it in the SIZ marker segment), and a png file keeps it in the
+IHDR chunk that follows the png signature, so only the first few
+hundred bytes of each file are read.
+'''
+
+# the size of a page image: the number of rows, columns and channels,
+# and the number of bits per sample
+ImageSize = namedtuple('ImageSize', ['height', 'width', 'channels', 'bits'])
+
+jp2_signature = b'\x00\x00\x00\x0cjP  \r\n\x87\n'
+j2k_signature = b'\xff\x4f\xff\x51'
+png_signature = b'\x89PNG\r\n\x1a\n'
+
+# the number of channels of each png color type once decoded
+# (palette images decode to rgb)
+png_channels = {0: 1, 2: 3, 3: 3, 4: 2, 6: 4}
+
+
+def read_image_size(path):
+  '''
+  Read in the path to a jp2, j2k or png image and return its ImageSize.
+  Raise a ValueError if the file isn't one of those types or its header
+  is incomplete
+  '''
+  with open(path, 'rb') as f:
+    start = f.read(12)
+    f.seek(0)
+
+    if start == jp2_signature:
+      return read_jp2_size(f)
+    if start.startswith(j2k_signature):
+      return read_j2k_size(f)
+    if start.startswith(png_signature):
+      return read_png_size(f)
+
+  raise ValueError('not a jp2 or png file: ' + path)
+
+
+def get_decoded_bytes(image_size):
+  '''
+  Read in an ImageSize and return the number of bytes in the array the
+  image decodes to
+  '''
+  sample_bytes = 1 if image_size.bits <= 8 else 2 if image_size.bits <= 16 else 4
+  return image_size.height * image_size.width * image_size.channels * sample_bytes
+
+
+def iter_boxes(f, end=None):
+  '''
+  Read in a jp2 file positioned at the start of a box and the position
+  at which the boxes end (None for the end of the file), and yield a
+  (box type, start of box contents, end of box) tuple for each box
+  '''
+  position = f.tell()
+  while end is None or position < end:
+    f.seek(position)
+    header = f.read(8)
+    if len(header) < 8:
+      return
+
+    length, box_type = struct.unpack('>I4s', header)
+    content_start = position + 8
+    if length == 1:
+      length, = struct.unpack('>Q', f.read(8))
+      content_start += 8
+    elif length == 0:
+      f.seek(0, 2)
+      length = f.tell() - position
+
+    if length < content_start - position:
+      raise ValueError('corrupt jp2 box')
+
+    yield box_type, content_start, position + length
+    position += length
+
+
+def read_jp2_size(f):
+  '''
+  Read in an open jp2 file and return its ImageSize from the ihdr box
+  '''
+  for box_type, start, end in iter_boxes(f):
+    if box_type != b'jp2h':
+      continue
+
+    f.seek(start)
+    for sub_box_type, sub_start, sub_end in iter_boxes(f, end):
+      if sub_box_type == b'ihdr':
+        f.seek(sub_start)
+        data = f.read(11)
+        if len(data) < 11:
+          raise ValueError('truncated jp2 ihdr box')
+        height, width, channels, bits = struct.unpack('>IIHB', data)
+        return ImageSize(height, width, channels, (bits & 0x7f) + 1)
+
+  raise ValueError('jp2 file has no ihdr box')
+
+
+def read_j2k_size(f):
+  '''
+  Read in an open j2k codestream and return its ImageSize from the SIZ
+  marker segment that follows the start of codestream marker
+  '''
+  f.seek(4)
+  data = f.read(38)
+  if len(data) < 38:
+    raise ValueError('truncated j2k SIZ marker')
+
+  # Lsiz, Rsiz, Xsiz, Ysiz, XOsiz, YOsiz, XTsiz, YTsiz, XTOsiz, YTOsiz, Csiz
+  fields = struct.unpack('>HHIIIIIIIIH', data)
+  width = fields[2] - fields[4]
+  height = fields[3] - fields[5]
+  channels = fields[10]
+
+  # the sample precision of the first component
+  bits, = struct.unpack('>B', f.read(1))
+  return ImageSize(height, width, channels, (bits & 0x7f) + 1)
+
+
+def read_png_size(f):
+  '''
+  Read in an open png file and return its ImageSize from the IHDR chunk
+  '''
+  f.seek(len(png_signature))
+  data = f.read(18)
+  if len(data) < 18 or data[4:8] != b'IHDR':
+    raise ValueError('png file has no IHDR chunk')
+
+  width, height, bits, color_type = struct.unpack('>IIBB', data[8:18])
+  return ImageSize(height, width, png_channels.get(color_type, 1), bits)
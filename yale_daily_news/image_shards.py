@@ -0,0 +1,141 @@
+from PIL import Image
+from io import BytesIO
+import numpy as np
+import fcntl, json, os
+
+'''
+Pack many small images into one shard file instead of writing one PNG
+file per image. Each image is PNG encoded and appended to <shard>.bin,
+and its key, byte offset and length are appended to the sidecar index
+<shard>.idx as one JSON line. Any image can then be read by key with a
+single seek, without unpacking the shard. Appends hold an exclusive lock
+on the shard, so several processes can write to the same shard.
+'''
+
+def encode_png(image):
+  '''
+  Read in an image array and return the bytes of that image in PNG format
+  '''
+  buffer = BytesIO()
+  Image.fromarray(np.ascontiguousarray(image)).save(buffer, format='PNG')
+  return buffer.getvalue()
+
+
+def append_to_shard(shard_path, key, image):
+  '''
+  Read in the path to a shard (without extension), a key and an image
+  array, append the image to the shard under that key, and return the
+  number of bytes appended
+  '''
+  data = encode_png(image)
+
+  with open(shard_path + '.bin', 'ab') as blob:
+    fcntl.flock(blob, fcntl.LOCK_EX)
+    try:
+      blob.seek(0, 2)
+      offset = blob.tell()
+      blob.write(data)
+      blob.flush()
+      append_index_entries(shard_path, [(key, offset, len(data))])
+    finally:
+      fcntl.flock(blob, fcntl.LOCK_UN)
+
+  return len(data)
+
+
+def append_index_entries(shard_path, entries):
+  '''
+  Read in the path to a shard and a list of (key, offset, length)
+  tuples, and append those entries to the shard's index
+  '''
+  with open(shard_path + '.idx', 'a') as index:
+    for key, offset, length in entries:
+      index.write(json.dumps([key, offset, length]) + '\n')
+
+
+def read_shard_index(shard_path):
+  '''
+  Read in the path to a shard and return a mapping from each key in
+  the shard to the (offset, length) of its image. If a key was written
+  more than once, the last entry wins. A shard that doesn't
+  exist yet has no keys
+  '''
+  shard_index = {}
+  if not os.path.exists(shard_path + '.idx'):
+    return shard_index
+
+  with open(shard_path + '.idx') as index:
+    for line in index:
+      key, offset, length = json.loads(line)
+      shard_index[key] = (offset, length)
+  return shard_index
+
+
+def read_shard_image(shard_path, key, shard_index=None):
+  '''
+  Read in the path to a shard and a key, and return the image stored
+  under that key. Pass the shard's index to avoid reading it again.
+  Raise a KeyError if the shard has no image with that key
+  '''
+  if shard_index is None:
+    shard_index = read_shard_index(shard_path)
+
+  offset, length = shard_index[key]
+
+  with open(shard_path + '.bin', 'rb') as blob:
+    blob.seek(offset)
+    data = blob.read(length)
+
+  return np.array(Image.open(BytesIO(data)))
+
+
+def link_shard_images(shard_path, key_pairs):
+  '''
+  Read in the path to a shard and a list of (key, new_key) tuples, and
+  store each image under its new key as well, without copying its bytes.
+  Return the list of keys that aren't in the shard
+  '''
+  with open(shard_path + '.bin', 'ab') as blob:
+    fcntl.flock(blob, fcntl.LOCK_EX)
+    try:
+      shard_index = read_shard_index(shard_path)
+
+      entries = []
+      missing_keys = []
+      for key, new_key in key_pairs:
+        if key not in shard_index:
+          missing_keys.append(key)
+          continue
+
+        offset, length = shard_index[key]
+        entries.append((new_key, offset, length))
+
+      append_index_entries(shard_path, entries)
+    finally:
+      fcntl.flock(blob, fcntl.LOCK_UN)
+
+  return missing_keys
+
+
+def rename_shard_keys(shard_path, rename_key):
+  '''
+  Read in the path to a shard and a function that maps a key to its new
+  key, and rewrite the shard's index with each key renamed, without
+  touching the images themselves
+  '''
+  if not os.path.exists(shard_path + '.idx'):
+    return
+
+  with open(shard_path + '.bin', 'ab') as blob:
+    fcntl.flock(blob, fcntl.LOCK_EX)
+    try:
+      with open(shard_path + '.idx') as index:
+        entries = [json.loads(line) for line in index]
+
+      tmp_path = shard_path + '.idx.tmp'
+      with open(tmp_path, 'w') as index:
+        for key, offset, length in entries:
+          index.write(json.dumps([rename_key(key), offset, length]) + '\n')
+      os.rename(tmp_path, shard_path + '.idx')
+    finally:
+      fcntl.flock(blob, fcntl.LOCK_UN)
@@ -0,0 +1,94 @@
+from threading import Thread, Lock, current_thread
+from skimage import io
+import os
+
+try:
+  from Queue import Queue
+except ImportError:
+  from queue import Queue
+
+'''
+A pool of threads that write images to disk in the background, so the
+process that produces the images can keep cropping while earlier images
+are PNG encoded and written. Images are handed to the writers through a
+bounded queue: once max_queued images are waiting, submit() blocks until
+a writer takes the next one, which caps the memory held by pending writes.
+'''
+
+class ImageWriterPool(object):
+
+  def __init__(self, n_writers=4, max_queued=64, save_image=None):
+    '''
+    Start n_writers threads that save the images submitted to the pool
+    with save_image(path, image), which defaults to skimage's imsave
+    '''
+    self.pid = os.getpid()
+    self.queue = Queue(max_queued)
+    self.save_image = save_image or io.imsave
+    self.errors = []
+    self.errors_lock = Lock()
+    self.writers = []
+
+    for writer_id in range(n_writers):
+      writer = Thread(target=self.write_images, name='writer-' + str(writer_id))
+      writer.daemon = True
+      writer.start()
+      self.writers.append(writer)
+
+
+  def write_images(self):
+    '''
+    Save images from the queue until the pool is closed, recording
+    the writer, path, exception and context of each write that fails
+    '''
+    while True:
+      path, image, context = self.queue.get()
+      try:
+        if path is None:
+          return
+
+        self.save_image(path, image)
+
+      except Exception as exc:
+        with self.errors_lock:
+          self.errors.append((current_thread().name, path, exc, context))
+
+      finally:
+        self.queue.task_done()
+
+
+  def submit(self, path, image, context=None):
+    '''
+    Queue an image to be saved at path (or any other destination that
+    the pool's save_image accepts), blocking while the queue is full.
+    context (e.g. where the image came from) is returned with the error
+    if the write fails. The image must not be modified until the pool
+    has been flushed
+    '''
+    self.queue.put((path, image, context))
+
+
+  def flush(self):
+    '''
+    Wait until every queued image has been written, then return and
+    clear the list of (writer, path, exception, context) tuples for failed writes
+    '''
+    self.queue.join()
+    with self.errors_lock:
+      errors = self.errors
+      self.errors = []
+    return errors
+
+
+  def close(self):
+    '''
+    Flush the pool, stop its writer threads, and return the list of
+    (writer, path, exception, context) tuples for failed writes
+    '''
+    errors = self.flush()
+    for writer in self.writers:
+      self.queue.put((None, None, None))
+    for writer in self.writers:
+      writer.join()
+    return errors
+
@@ -0,0 +1,135 @@
+from multiprocessing import current_process
+from contextlib import contextmanager
+from collections import defaultdict
+from threading import Lock
+import json, os, time
+
+'''
+Record where a run spends its time as JSON lines, one event per stage,
+issue, page or worker. Within a unit of work, the process only adds to
+in-memory counters (seconds spent decoding, cropping and writing, bytes
+read and written, npy cache hits and misses), and the counters are written
+as a single event when the unit is done, so the log is cheap enough to
+leave on. Work that finishes after its unit has been emitted (images
+written by background writer threads) goes to separate background
+counters, which are emitted when that work has been waited for. Each event is one write to a file opened with O_APPEND, so the
+processes of a pool can share the log without interleaving lines.
+'''
+
+class MetricsLog(object):
+
+  def __init__(self, path):
+    '''
+    Start a log that appends events to path. If path is None, the
+    counters are still kept but no events are written
+    '''
+    self.path = path
+    self.pid = os.getpid()
+    self.counters = defaultdict(float)
+    self.background_counters = defaultdict(float)
+    self.lock = Lock()
+    self.fd = None
+
+
+  def count(self, name, value=1, background=False):
+    '''
+    Add value to the counter called name (a background counter if
+    background is True). Safe to call from any thread
+    '''
+    with self.lock:
+      if background:
+        self.background_counters[name] += value
+      else:
+        self.counters[name] += value
+
+
+  @contextmanager
+  def timer(self, name, background=False):
+    '''
+    Add the number of seconds spent in the with block to the counter
+    called name (a background counter if background is True)
+    '''
+    start = time.time()
+    try:
+      yield
+    finally:
+      self.count(name, time.time() - start, background)
+
+
+  def take_counters(self, background=False):
+    '''
+    Return the counters (or the background counters, if background is
+    True) as a dict and reset them all to 0
+    '''
+    with self.lock:
+      if background:
+        counters = self.background_counters
+        self.background_counters = defaultdict(float)
+      else:
+        counters = self.counters
+        self.counters = defaultdict(float)
+    return {k: round(v, 6) for k, v in counters.iteritems()}
+
+
+  def emit(self, event, **fields):
+    '''
+    Append one event to the log, with the time, process id and
+    worker name of the process that emitted it
+    '''
+    if self.path is None:
+      return
+
+    record = {
+      'event': event,
+      'time': round(time.time(), 6),
+      'pid': os.getpid(),
+      'worker': current_process().name
+    }
+    record.update(fields)
+
+    if self.fd is None:
+      self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    os.write(self.fd, json.dumps(record, sort_keys=True) + '\n')
+
+
+  def close(self):
+    '''
+    Close the log file
+    '''
+    if self.fd is not None:
+      os.close(self.fd)
+      self.fd = None
+
+
+def read_metrics(path):
+  '''
+  Read in the path to a metrics log and return a list of its events
+  '''
+  with open(path) as f:
+    return [json.loads(line) for line in f if line.strip()]
+
+
+def summarize_metrics(events):
+  '''
+  Read in a list of events and return a dict that maps each event
+  type to the sum of each numeric field over the events of that type
+  '''
+  summary = defaultdict(lambda: defaultdict(float))
+  for event in events:
+    totals = summary[event['event']]
+    totals['count'] += 1
+    for key, value in event.iteritems():
+      if key in ('time', 'pid'):
+        continue
+      if isinstance(value, (int, long, float)) and not isinstance(value, bool):
+        totals[key] += value
+  return {k: dict(v) for k, v in summary.iteritems()}
+
+
+if __name__ == '__main__':
+  import sys
+
+  # print the totals of each event type in a metrics log. Usage:
+  # python pipeline_metrics.py metrics.jsonl
+  for event, totals in sorted(summarize_metrics(read_metrics(sys.argv[1])).iteritems()):
+    print event, json.dumps({k: round(v, 3) for k, v in totals.iteritems()}, sort_keys=True)
@@ -1,11 +1,40 @@
 from __future__ import division
-from multiprocessing import Pool
-from collections import defaultdict
+from multiprocessing import Pool, current_process
+from multiprocessing.util import Finalize
+from collections import defaultdict, deque, namedtuple
 from skimage import io
 from scipy import ndimage
 from shutil import Error, move, rmtree
+from image_writers import ImageWriterPool
+from pipeline_metrics import MetricsLog
+from failure_journal import FailureJournal, append_locked, read_failures
+from tiled_store import TiledPage, read_tiled_page_header, write_tiled_page
+from image_shards import append_to_shard, link_shard_images, read_shard_index, read_shard_image, \
+  rename_shard_keys
+from image_headers import read_image_size, get_decoded_bytes
 import numpy as np
-import glob, os, codecs, sys, json
+import os, sys, json, argparse, hashlib, resource, time, Queue
+
+try:
+  from xml.etree.cElementTree import iterparse
+except ImportError:
+  from xml.etree.ElementTree import iterparse
+
+# scandir returns file types with the directory listing; it's built into
+# python 3.5+ and available as the scandir package for older pythons
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = None
+
+# glymur is optional; it's only needed to decode regions of jp2 files
+try:
+  import glymur
+except ImportError:
+  glymur = None
 
 '''
 ## Processing notes
@@ -28,27 +57,63 @@ def convert_jp2_images_to_numpy_arrays(root_data_directory):
   '''
   Read in the path to a directory that contains subdirectories
   for each newspaper issue, iterate over the jp2 files 
-  in those directories and write each to disk as a numpy array
+  in those directories and write each to disk as a numpy array.
+  The pages of all issues are converted by one process pool, largest
+  files first, and pages with an up to date npy file are skipped
   '''
-  
+  global cached_page_bytes
+
   # each image file in the issue_directory contains a single page of the newspaper
   issue_directories = get_issue_directories(root_data_directory)
 
-  # iterate over each issue directory
+  # find the pages that haven't been cached since their jp2 file last changed
+  page_sizes = {}
+  n_cached = 0
+
   for issue_directory in issue_directories:
+    files = get_catalog_issue(issue_directory)['files']
 
-    # find all jp2 images within the current issue directory
-    issue_images = get_images_in_directory(issue_directory)
+    for jp2_path in get_images_in_directory(issue_directory):
+      if is_cached_array_current(jp2_path):
+        n_cached += 1
+      else:
+        page_sizes[jp2_path] = files[os.path.basename(jp2_path)][0]
 
-    # create process pool using all available cpu processors
-    pool_one = Pool(n_processes)
+  # start the largest pages first, so no worker is left decoding
+  # a large page while the others sit idle at the end
+  issue_images = sorted(page_sizes, key=lambda i: (-page_sizes[i], i))
 
-    # use the process pool to convert each jp2 image to a numpy array
-    for result in pool_one.imap(image_path_to_npy, issue_images):
-      pass
+  if verbosity_level > 0:
+    print 'converting', len(issue_images), 'pages,', n_cached, 'pages already cached'
+
+  if not issue_images:
+    return
+
+  # create process pool using all available cpu processors
+  pool_one = Pool(n_processes)
+
+  start = time.time()
+  bytes_converted = 0
 
-    pool_one.close()
-    pool_one.join()
+  # workers take the next page as soon as they finish one (and, with a
+  # memory budget, once there's room for the page's decode)
+  results = imap_within_budget(pool_one, image_path_to_npy, issue_images,
+    estimate_decode_memory, memory_budget, n_processes)
+  for n_converted, jp2_path in enumerate(results, 1):
+    bytes_converted += page_sizes[jp2_path]
+
+    if verbosity_level > 0:
+      elapsed = max(time.time() - start, 1e-9)
+      print 'converted', n_converted, 'of', len(issue_images), 'pages',
+      print round(n_converted / elapsed, 2), 'pages/sec',
+      print round(bytes_converted / elapsed / 2 ** 20, 2), 'MB/sec', jp2_path
+
+  pool_one.close()
+  pool_one.join()
+
+  # count the pages that every worker wrote against the budget
+  cached_page_bytes = None
+  enforce_numpy_cache_budget('page_tiles' if page_store == 'tiles' else 'numpy_arrays')
 
 
 def get_issue_directories(directory_with_issue_directories):
@@ -56,47 +121,133 @@ def get_issue_directories(directory_with_issue_directories):
   Read in the path to a directory that contains a series of
   subdirectories, each of which should contain one or more files 
   for the images/pages in that issue of the paper. Return an array
-  of all of the issue subdirectories
+  of all of the issue subdirectories. If shard is set, only return the
+  issues assigned to this shard
   '''
-  return glob.glob(directory_with_issue_directories + '/*')[:max_files_to_process]
+  catalog = get_issue_catalog(directory_with_issue_directories)
+  return get_shard_issues(sorted(catalog['issues'].keys())[:max_files_to_process])
 
 
 def get_images_in_directory(path_to_directory):
   '''
   Read in a path to a directory and return an array of jp2
-  files in that directory
+  files in that directory, sorted by page number
   '''
-  return list( glob.glob(path_to_directory + '/*.jp2')[:max_files_to_process] )
+  return [os.path.join(path_to_directory, i)
+    for i in get_issue_pages(path_to_directory)][:max_files_to_process]
 
 
 def image_path_to_npy(path_to_jp2_image):
   '''
-  Read in the full path to a jp2 image, read that image into memory,
-  convert to a numpy array and save as a npy file
+  Read in the full path to a jp2 image, decode that image and
+  cache it as a npy file, and return the path to the image
+  '''
+  metrics = get_metrics()
+  metrics.take_counters()
+  start = time.time()
+  decode_jp2_file(path_to_jp2_image)
+  metrics.emit('convert_page', page=path_to_jp2_image,
+    seconds=round(time.time() - start, 6), **metrics.take_counters())
+  return path_to_jp2_image
+
+
+def is_cached_array_current(path_to_jp2_file):
+  '''
+  Read in the path to a jp2 image file and return a boolean indicating
+  whether the image's cached page is complete and was written after the
+  jp2 file last changed
+  '''
+  path_to_saved_numpy_array = get_cached_page_path(path_to_jp2_file)
+
+  try:
+    npy_mtime = os.stat(path_to_saved_numpy_array).st_mtime
+    if npy_mtime < os.stat(path_to_jp2_file).st_mtime:
+      return False
+
+    # reading the header fails for truncated files
+    if path_to_saved_numpy_array.endswith('.tiles'):
+      read_tiled_page_header(path_to_saved_numpy_array)
+    else:
+      np.load(path_to_saved_numpy_array, mmap_mode='r')
+    return True
+
+  except Exception:
+    return False
+
+
+def get_numpy_array_path(path_to_jp2_file):
+  '''
+  Read in the path to a jp2 image file and return the path to the
+  npy file in which that image's pixel array is cached
+  '''
+  jp2_issue_directory = path_to_jp2_file.split('/')[-2]
+  jp2_basename = os.path.basename(path_to_jp2_file)
+  return 'numpy_arrays/' + jp2_issue_directory + '/' + jp2_basename + '.npy'
+
+
+def get_cached_page_path(path_to_jp2_file):
+  '''
+  Read in the path to a jp2 image file and return the path to the
+  file in which the page store caches that image's pixel array: a npy
+  file if page_store == 'npy', or a tiled page file in page_tiles/
+  if page_store == 'tiles'
+  '''
+  if page_store == 'tiles':
+    jp2_issue_directory = path_to_jp2_file.split('/')[-2]
+    jp2_basename = os.path.basename(path_to_jp2_file)
+    return 'page_tiles/' + jp2_issue_directory + '/' + jp2_basename + '.tiles'
+
+  return get_numpy_array_path(path_to_jp2_file)
+
+
+def load_cached_page(path_to_cached_page):
+  '''
+  Read in the path to a cached page and return the page: a read-only
+  memory mapped array for npy files, or a TiledPage for tiled page
+  files, which decompresses only the tiles that are sliced
+  '''
+  if path_to_cached_page.endswith('.tiles'):
+    return TiledPage(path_to_cached_page)
+
+  return np.load(path_to_cached_page, mmap_mode='r')
+
+
+def close_cached_page(page):
+  '''
+  Read in a page returned by jp2_path_to_array and close its file if
+  it's a TiledPage; memory mapped arrays are closed when released
   '''
-  jp2_array =  jp2_path_to_array(path_to_jp2_image)
-  if jp2_array is not None:
-    write_jp2_array_to_disk(jp2_array, path_to_jp2_image)
+  if isinstance(page, TiledPage):
+    page.close()
 
 
 def jp2_path_to_array(path_to_jp2_file):
   '''
   Read in the path to a jp2 image file and return that
   file as a numpy array that represents the pixel values of 
-  that image
+  that image. Cached arrays are memory mapped read-only, so slices
+  of the returned array are views into the OS page cache, which is
+  shared by all of the worker processes. If page_store == 'tiles',
+  return a TiledPage that can be sliced like the array
   '''
 
-  # try to read the numpy array into memory from a npy file. 
+  # try to memory map the numpy array from a npy file.
   # if the image hasn't been converted yet, convert it and then write it 
   # at the end of this loop, to save on i/o the next time we process this file
+  metrics = get_metrics()
+
   try:
-    jp2_issue_directory = path_to_jp2_file.split('/')[-2]
-    jp2_basename = os.path.basename(path_to_jp2_file)
-    
-    path_to_saved_numpy_array =  './numpy_arrays/' + jp2_issue_directory 
-    path_to_saved_numpy_array += '/' + jp2_basename + '.npy'
+    path_to_saved_numpy_array = get_cached_page_path(path_to_jp2_file)
+
+    jp2_array = load_cached_page(path_to_saved_numpy_array)
 
-    jp2_array = np.load(path_to_saved_numpy_array)
+    # mark the npy file as recently used so it's evicted last
+    touch_cached_array(path_to_saved_numpy_array)
+
+    # tiled pages count the bytes of the tiles they read instead
+    metrics.count('npy_cache_hits')
+    if not isinstance(jp2_array, TiledPage):
+      metrics.count('bytes_read', jp2_array.nbytes)
 
     if verbosity_level > 0:
       print 'read the following image from disk', path_to_jp2_file
@@ -105,33 +256,325 @@ def jp2_path_to_array(path_to_jp2_file):
 
   # if an exception arises, then read the image from disk and write its npy file
   except Exception as exc:
-    try:
+    metrics.count('npy_cache_misses')
+    return decode_jp2_file(path_to_jp2_file)
+
+
+def decode_jp2_file(path_to_jp2_file):
+  '''
+  Read in the path to a jp2 image file, decode that file, write the
+  decoded array to its npy file and return the array. If the file
+  can't be decoded, log it and return None
+  '''
+  metrics = get_metrics()
+  start = time.time()
+
+  try:
+    with metrics.timer('decode_seconds'):
       jp2_array = io.imread(path_to_jp2_file, plugin='freeimage')
+    metrics.count('bytes_read', os.path.getsize(path_to_jp2_file))
+
+    with metrics.timer('npy_write_seconds'):
       write_jp2_array_to_disk(jp2_array, path_to_jp2_file)
-      return jp2_array
+    return jp2_array
 
-    except Exception:
-      with open('unprocessable-images.txt', 'a') as out:
-        out.write(path_to_jp2_file + '\n')
+  except Exception as exc:
+    log_unprocessable_image(path_to_jp2_file, exc, start)
 
 
 def write_jp2_array_to_disk(jp2_array, jp2_path):
   '''
   Read in a numpy array and the path to the jp2 file, and
   write that numpy array to disk in a directory with the same 
-  name as the issue subdirectory from which the image was read
+  name as the issue subdirectory from which the image was read,
+  as a npy file or as compressed tiles (if page_store == 'tiles')
   '''
 
-  jp2_filename = os.path.basename(jp2_path)
-  jp2_issue_directory = jp2_path.split('/')[-2]
-
-  out_directory = 'numpy_arrays/' + jp2_issue_directory + '/'
-  out_path = out_directory + jp2_filename + '.npy'
+  out_path = get_cached_page_path(jp2_path)
+  out_directory = os.path.dirname(out_path)
 
   if not os.path.exists(out_directory):
-    os.makedirs(out_directory)
+    try:
+      os.makedirs(out_directory)
+    except OSError:
+      pass
+
+  # write to a temporary file and rename it into place, so other
+  # processes never memory map a partially written array
+  tmp_path = out_path + '.' + str(os.getpid()) + '.tmp'
+  if page_store == 'tiles':
+    write_tiled_page(tmp_path, jp2_array, tile_size)
+  else:
+    with open(tmp_path, 'wb') as out:
+      np.save(out, jp2_array)
+  os.rename(tmp_path, out_path)
+
+  enforce_numpy_cache_budget(os.path.dirname(out_directory), os.path.getsize(out_path))
+
+
+def touch_cached_array(path_to_saved_numpy_array):
+  '''
+  Read in the path to a cached npy file and set its access time to now.
+  The cache uses access times to find the least recently used arrays,
+  as they're visible to all processes. The modification time is kept,
+  as is_cached_array_current compares it with the jp2 file's
+  '''
+  try:
+    npy_mtime = os.stat(path_to_saved_numpy_array).st_mtime
+    os.utime(path_to_saved_numpy_array, (time.time(), npy_mtime))
+  except OSError:
+    pass
+
+
+# the bytes in the page cache as of this process's last walk of the
+# cache, plus the bytes of the pages it has written since (None if
+# this process hasn't walked the cache yet)
+cached_page_bytes = None
+
+def enforce_numpy_cache_budget(cache_directory='numpy_arrays', written_bytes=0):
+  '''
+  Read in the cache directory and the size of the page just written to
+  it (if any). If the npy (or tiled page) files in the cache directory
+  take up more than npy_cache_budget bytes, delete the least recently
+  used files until the cache fits in the budget again. The cache is
+  only walked when the running total of its size goes over the budget;
+  pages written by other processes are counted at the next walk, and
+  the convert stage walks the cache once more at its end. Workers that
+  have already memory mapped an evicted file can keep reading it
+  '''
+  global cached_page_bytes
+
+  if not npy_cache_budget:
+    return
+
+  if cached_page_bytes is not None:
+    cached_page_bytes += written_bytes
+    if cached_page_bytes <= npy_cache_budget:
+      return
+
+  cached_arrays = []
+  for root, dirs, files in os.walk(cache_directory):
+    for filename in files:
+      if not filename.endswith('.npy') and not filename.endswith('.tiles'):
+        continue
+
+      path = os.path.join(root, filename)
+
+      # another process may have evicted the file in the meantime
+      try:
+        stat = os.stat(path)
+      except OSError:
+        continue
+
+      cached_arrays.append((stat.st_atime, stat.st_size, path))
+
+  cache_size = sum(i[1] for i in cached_arrays)
+
+  for atime, size, path in sorted(cached_arrays):
+    if cache_size <= npy_cache_budget:
+      break
+
+    try:
+      os.remove(path)
+    except OSError:
+      pass
+
+    cache_size -= size
+
+  cached_page_bytes = cache_size
+
+
+#################
+# Issue Catalog #
+#################
+
+# the issue directories, pages and xml files found in the current run,
+# d['issues'][issue_directory] = {'mtime': , 'files': {filename: [size, mtime]}}
+issue_catalog = None
+
+def get_issue_catalog(root_data_directory):
+  '''
+  Read in the path to a directory with issue subdirectories and return
+  the catalog of the files in those issues, scanning the directories
+  once per run. If catalog_path is set, the catalog is saved to disk and
+  the next run only lists the issue directories whose mtime changed
+  (i.e. those with files that were added, removed or renamed). The files
+  of the other issues are stat'ed again, as rewriting a file in place
+  doesn't change its directory's mtime
+  '''
+  global issue_catalog
+
+  if issue_catalog is not None and issue_catalog['root'] == root_data_directory:
+    return issue_catalog
+
+  previous_catalog = load_issue_catalog()
+  if previous_catalog.get('root') != root_data_directory:
+    previous_catalog = {}
+
+  issue_catalog = scan_issue_catalog(root_data_directory, previous_catalog.get('issues', {}))
+
+  if catalog_path:
+    save_issue_catalog(issue_catalog)
+
+  return issue_catalog
+
+
+def scan_issue_catalog(root_data_directory, previous_issues):
+  '''
+  Read in the path to a directory with issue subdirectories and the
+  issues of a previous catalog, and return a catalog of the issues in
+  that directory. Issues whose mtime matches the previous catalog keep
+  their list of files there, with each file stat'ed again; other issues
+  are listed again
+  '''
+  # build issue paths the way glob does, so they match the paths of earlier runs
+  root = os.path.split(os.path.join(root_data_directory, '*'))[0]
+  issues = {}
+
+  for name, is_directory, size, mtime in scan_directory(root):
+    if not is_directory or name.startswith('.'):
+      continue
+
+    issue_directory = os.path.join(root, name)
+    previous = previous_issues.get(issue_directory)
+
+    if previous and previous['mtime'] == mtime:
+      issues[issue_directory] = restat_issue_directory(issue_directory, previous)
+    else:
+      issues[issue_directory] = scan_issue_directory(issue_directory, mtime)
+
+  return {'root': root_data_directory, 'issues': issues}
+
+
+def restat_issue_directory(issue_directory, previous):
+  '''
+  Read in the path to an issue directory and its entry in a previous
+  catalog, and return the entry with the current size and mtime of each
+  of its files, without listing the directory. If a file has gone, list
+  the directory again
+  '''
+  files = {}
+  for name in previous['files']:
+    try:
+      stat = os.stat(os.path.join(issue_directory, name))
+    except OSError:
+      return scan_issue_directory(issue_directory)
+    files[name] = [stat.st_size, stat.st_mtime]
+
+  return {'mtime': previous['mtime'], 'files': files}
+
+
+def scan_issue_directory(issue_directory, mtime=None):
+  '''
+  Read in the path to an issue directory and return its catalog entry:
+  the directory's mtime and the size and mtime of each page image,
+  articles.xml file and index.cpd file in the directory
+  '''
+  if mtime is None:
+    mtime = os.stat(issue_directory).st_mtime
+
+  files = {}
+  for name, is_directory, size, file_mtime in scan_directory(issue_directory, stat_files=True):
+    if is_directory or name.startswith('.'):
+      continue
+
+    if name.endswith('.jp2') or name.endswith('.articles.xml') or name == 'index.cpd':
+      files[name] = [size, file_mtime]
+
+  return {'mtime': mtime, 'files': files}
+
+
+def scan_directory(path, stat_files=False):
+  '''
+  Read in the path to a directory and return a list of (name, is_directory,
+  size, mtime) tuples for its entries, with a single listing of the directory.
+  Subdirectories are always stat'ed (for their mtime); files only if
+  stat_files is True. Return an empty list if the directory can't be read
+  '''
+  entries = []
+
+  try:
+    if scandir is not None:
+      for entry in scandir(path):
+        is_directory = entry.is_dir()
+        if is_directory or stat_files:
+          stat = entry.stat()
+          entries.append((entry.name, is_directory, stat.st_size, stat.st_mtime))
+        else:
+          entries.append((entry.name, is_directory, None, None))
 
-  np.save(out_path, jp2_array)
+    else:
+      for name in os.listdir(path):
+        stat = os.stat(os.path.join(path, name))
+        entries.append((name, os.path.isdir(os.path.join(path, name)),
+          stat.st_size, stat.st_mtime))
+
+  except OSError:
+    return []
+
+  return entries
+
+
+def get_catalog_issue(issue_directory):
+  '''
+  Read in the path to an issue directory and return its catalog entry,
+  scanning the directory if it isn't in the catalog yet
+  '''
+  global issue_catalog
+
+  if issue_catalog is None:
+    issue_catalog = {'root': None, 'issues': {}}
+
+  if issue_directory not in issue_catalog['issues']:
+    issue_catalog['issues'][issue_directory] = scan_issue_directory(issue_directory) \
+      if os.path.isdir(issue_directory) else {'mtime': None, 'files': {}}
+
+  return issue_catalog['issues'][issue_directory]
+
+
+def get_issue_pages(issue_directory):
+  '''
+  Read in the path to an issue directory and return the filenames of
+  the jp2 images in that issue, sorted numerically (1.jp2, 5.jp2, 12.jp2...)
+  '''
+  files = get_catalog_issue(issue_directory)['files']
+  return sorted((i for i in files if i.endswith('.jp2')), key=get_page_sort_key)
+
+
+def get_page_sort_key(image_filename):
+  '''
+  Read in the filename of a page image and return a key that sorts
+  page images numerically, with non-numeric filenames last
+  '''
+  stem = image_filename[:-len('.jp2')]
+  try:
+    return (0, int(stem), image_filename)
+  except ValueError:
+    return (1, 0, image_filename)
+
+
+def load_issue_catalog():
+  '''
+  Read the issue catalog of the last run from disk
+  '''
+  if not catalog_path or not os.path.exists(catalog_path):
+    return {}
+
+  try:
+    with open(catalog_path) as f:
+      return json.load(f)
+  except ValueError:
+    return {}
+
+
+def save_issue_catalog(catalog):
+  '''
+  Write the issue catalog to disk
+  '''
+  tmp_path = catalog_path + '.' + str(os.getpid()) + '.tmp'
+  with open(tmp_path, 'w') as out:
+    json.dump(catalog, out)
+  os.rename(tmp_path, catalog_path)
 
 
 ######################
@@ -189,25 +632,13 @@ def get_page_mappings(issue_directory):
   page_file_to_page_id = {}
   page_id_to_page_file = {}
 
-  images = glob.glob(issue_directory + '/*.jp2')
-  image_numbers = []
-  for i in images:
-    basename = os.path.basename(i)
-    image_number = int(basename.replace('.jp2',''))
-    image_numbers.append(image_number)
-
-  image_numbers.sort()
-
-  page_number = 1
-  for i in image_numbers:
-    for j in images:
-      image_filename = os.path.basename(j)
-      if str(i) + '.jp2' == image_filename:
-
-        # store the 1-based index position of this page image
-        page_file_to_page_id[image_filename] = page_number
-        page_id_to_page_file[page_number] = image_filename
-        page_number += 1
+  # the catalog lists the images sorted numerically
+  for page_number, image_filename in enumerate(get_issue_pages(issue_directory), 1):
+
+    # store the 1-based index position of this page image
+    page_file_to_page_id[image_filename] = page_number
+    page_id_to_page_file[page_number] = image_filename
+
   return page_id_to_page_file, page_file_to_page_id
 
 
@@ -216,90 +647,82 @@ def get_article_xml_files(issue_directory):
   Read in the path to a directory with files for a single issue and
   return an array of article xml files within that directory's issue
   '''
-  return glob.glob(issue_directory + '/*.articles.xml')
-
-
-def read_xml_file(xml_file_path):
-  '''
-  Read in the path to an xml file and return that
-  xml file content in string form
-  '''
-  with codecs.open(xml_file_path, 'r', 'utf-8') as f:
-    return f.read()
+  files = get_catalog_issue(issue_directory)['files']
+  return sorted(os.path.join(issue_directory, i)
+    for i in files if i.endswith('.articles.xml'))
 
 
-def get_xml_articles(xml_content):
-  '''
-  Read in a string containing XML content and return an array
-  of the articles in that XML document
-  '''
-  articles = []
-  
-  for i in xml_content.split('<article')[1:]:
-    article_start = '>'.join(i.split('>')[1:])
-    article_content = article_start.split('</article')[0]
-    articles.append(article_content)
-
-  return articles
+# one rectangle from an articles.xml file: the index positions of the
+# article, clip and coord that describe it, the page id in the coord's
+# inpage attribute, and the [x_offset, y_offset, width, height] coordinates
+ClipCoord = namedtuple('ClipCoord', [
+  'article_index',
+  'clip_index',
+  'coord_index',
+  'inpage',
+  'coords'
+])
 
 
-def get_article_clips(article, restrict_to_uc=1):
+def iter_clip_coords(xml_file_path, restrict_to_uc=1):
   '''
-  Read in the xml content from an article and return an array of
-  the clips in that article. If restrict_to_uc == 1, only return
-  clips if they have type 'uc'
+  Read in the path to an articles.xml file and yield a ClipCoord for
+  each <coord> element in that file, in document order. If
+  restrict_to_uc == 1, only yield coords in clips with type 'uc'.
+  The file is parsed in a single streaming pass of end events, and each
+  clip and article is cleared once it's been parsed, so the parsed tree
+  never holds more than one clip's coords (plus the empty elements of
+  the articles before it). Raise a ValueError if a coord can't be parsed
   '''
-  
-  article_clips = []
-  
-  for i in article.split('<clip')[1:]:
 
-    if restrict_to_uc == 1:
-      if 'type="uc"' not in i:
-        continue
+  article_index = 0
+  clip_index = -1
 
-    clip_start = '>'.join(i.split('>')[1:])
-    clip_content = clip_start.split('</clip')[0]
-    article_clips.append(clip_content)
-  
-  return article_clips 
+  with open(xml_file_path, 'rb') as f:
+    for event, elem in iterparse(f):
 
+      # match the tag name with or without a namespace
+      tag = elem.tag
 
-def get_clip_coords(article_clip):
-  '''
-  Read in the clip content of a jp2 xml file and return an array of the
-  coord elements within that clip element
-  '''
+      # a clip's coords are complete once the clip has been parsed
+      if tag == 'clip' or tag.endswith('}clip'):
+        if restrict_to_uc != 1 or elem.get('type') == 'uc':
+          clip_index += 1
+          coord_index = 0
+          for coord_element in elem:
+            if coord_element.tag.rsplit('}', 1)[-1] != 'coord':
+              continue
 
-  clip_coords = []
+            inpage, coords = parse_coord_element(coord_element, xml_file_path)
+            yield ClipCoord(article_index, clip_index, coord_index, inpage, coords)
+            coord_index += 1
 
-  for i in article_clip.split('\n')[1:-1]:
-    clip_coords.append(i.replace('\r',''))
+        elem.clear()
 
-  return clip_coords
+      elif tag == 'article' or tag.endswith('}article'):
+        article_index += 1
+        clip_index = -1
+        elem.clear()
 
 
-def get_coordinate_array(coord_element):
+def parse_coord_element(coord_element, xml_file_path):
   '''
-  Read in a string denoting one <coord>...</coord>
-  element in the current jp2's associated xml file, and return
-  an array of integers that denote the element's x offset
-  y offset, width, and height (in that order), as well as
-  an integer that indicates the page in which that rectangle
-  is present
+  Read in one <coord inpage="1">425:619:210:20</coord> element and the
+  path to the file that contains it, and return the integer id of the
+  page on which that rectangle is present, as well as an array of
+  integers that denote the rectangle's x offset, y offset, width,
+  and height (in that order)
   '''
+  try:
+    inpage = int(coord_element.get('inpage'))
+    coords = [int(i) for i in coord_element.text.strip().split(':')]
+  except (TypeError, ValueError, AttributeError):
+    raise ValueError('could not parse coord in ' + xml_file_path)
 
-  page_with_rectangle = coord_element.split('inpage="')[1].split('"')[0]
-
-  coordinates_start = coord_element.split('<coord')[1]
-  coordinates_clean_start = '>'.join(coordinates_start.split('>')[1:])
-  clean_coordinates = coordinates_clean_start.split('</coord>')[0]
+  if len(coords) != 4:
+    raise ValueError('could not parse coord in ' + xml_file_path)
 
-  try:
-    return [int(i) for i in clean_coordinates.split(':')], page_with_rectangle
-  except:
-    print 'coordinate parsing failed; exiting'
-    sys.exit()
+  return inpage, coords
 
 
 ###############################
@@ -321,108 +744,55 @@ def generate_issue_page_rectangle_mapping(root_data_directory):
   (e.g. if we have a rectangle printed on page 2 that is continued
   from page 1, store an indicate that the rectangle belongs
   to an article with a particular index position on page 1).
-  Then write this mapping to disk
+  Then write this mapping to disk. If multiprocess is True, the
+  issues are mapped in a process pool. Each rect id is the number of
+  rects in the issues that sort before the rect's issue plus the rect's
+  index within its issue, so the ids are the same for any number of
+  processes. If shard is set, only this shard's issues are mapped, with
+  ids counted within the shard, and the mapping is written to the
+  shard's directory for merge_shard_mappings to combine
   '''
 
-  # unique identifier given to each rectangle created
-  rect_id = 0
-
   # d[issue_directory][article_xml_filename][article_index] = [{img_with_rect:, rect_coords:}]
-  rects_to_articles = defaultdict(lambda: defaultdict(lambda: defaultdict(list)))
+  rects_to_articles = {}
 
   # d[issue_directory][img_file] = [{rect_id: , rect_coords: }]
-  imgs_to_crop = defaultdict(lambda: defaultdict(list))
+  imgs_to_crop = {}
 
   # each issue_directory contains a single issue of the newspaper
   issue_directories = get_issue_directories(root_data_directory)
-  for issue_directory in issue_directories:
-    page_id_to_page_file, page_file_to_page_id = get_page_mappings(issue_directory)
-  
-    # each xml/jp2 file combination in the issue_directory 
-    # contains a single newspaper page
-    xml_pages = get_article_xml_files(issue_directory)
 
-    # iterate over each xml file and get all articles on that page
-    for page_index, xml_page in enumerate(xml_pages):
+  # results are returned in issue order, whichever process mapped them
+  if multiprocess:
+    pool = Pool(n_processes)
+    results = pool.imap(map_issue_rectangles, issue_directories)
+  else:
+    results = (map_issue_rectangles(i) for i in issue_directories)
+
+  # unique identifier given to the first rectangle in each issue
+  rect_id_offset = 0
 
-      # xml_content is a unicode string with the xml content
-      xml_content = read_xml_file(xml_page)
+  # d[issue_directory] = [rect_id_offset, n_rects]
+  issue_rect_ids = {}
 
-      # page_articles is an array of the article elements in the xml
-      xml_articles = get_xml_articles(xml_content)
+  for issue_directory, issue_imgs_to_crop, issue_rects_to_articles, n_rects in results:
+    offset_rect_ids(issue_imgs_to_crop, issue_rects_to_articles, rect_id_offset)
+    issue_rect_ids[issue_directory] = [rect_id_offset, n_rects]
+    rect_id_offset += n_rects
 
-      # loop over each article and get all 'clips' for that article
-      for article_index, xml_article in enumerate(xml_articles):
+    if issue_imgs_to_crop:
+      imgs_to_crop[issue_directory] = issue_imgs_to_crop
 
-        # store a boolean indicating whether this article includes rects from
-        # multiple images. This is used to prevent us from duplicating rects
-        # in articles with multiple pages (as the ALTO XML does)
-        rects_already_stored = False
-
-        # xml_clips is an array of the clips within the current article
-        xml_clips = get_article_clips(xml_article)
-
-        # each xml_clip contains a sequence of coordinates that define 
-        # a rectangle a user drew on a jp2 image
-        for clip_index, xml_clip in enumerate(xml_clips):
-
-          # xml_coords is an array of the coords in the current clip
-          xml_coords = get_clip_coords(xml_clip)
-
-          # each xml_coord is an array of 4 coordinates that describe the 
-          # x_offset, y_offset, width, height of a rectangle to be
-          # extracted from the jp2. This rectangle is described in xml
-          # units and must be converted into pixel units for extraction
-          # The coord_inpage_value indicates the integer used in the <coord
-          # inpage={int} value, which must be mapped to a proper file
-          for xml_coord_index, xml_coord in enumerate(xml_coords):
-
-            xml_coordinate_array, coord_inpage_value = get_coordinate_array(xml_coord)
-
-            # now use the coord_inpage_value to identify the file with the rectangle
-            try:
-              img_with_rect = page_id_to_page_file[int(coord_inpage_value)]
-
-            # handle case where issue references a page that doesn't exist
-            except KeyError:
-              with open('missing_page_articles.txt', 'a') as missing_out:
-                msg = issue_directory + ' ' + coord_inpage_value + '\n'
-                missing_out.write(msg)
-                continue
-
-            # also parse out the xml file that references the image
-            article_xml_filename = os.path.basename(xml_page)
-
-            # identify the image for the current xml file
-            current_img = os.path.basename(article_xml_filename)
-            current_img = current_img.replace('.articles.xml','.jp2')
-
-            # d[issue_directory][img_file] = [{rect_id: , rect_coords: }]
-            imgs_to_crop[issue_directory][img_with_rect].append({
-              'coords': xml_coordinate_array,
-              'rect_id': rect_id
-            })
-
-            # articles that appear on multiple pages have their XML coordinates
-            # expressed on each page where they occur--this is part of the ALTO
-            # XML schema. To ensure we don't create duplicate outputs for those
-            # articles, examine the first XML coordinate for the given rect.
-            # If the image for that coord set occurs on the current image, store
-            # the mapping, else continue
-            if xml_coord_index == 0:
-              if current_img != img_with_rect:
-                rects_already_stored = True
-
-            print article_index, xml_coord_index, img_with_rect, rect_id
-
-            if not rects_already_stored:
-              rects_to_articles[issue_directory][article_xml_filename][article_index].append({
-                'img_with_rect': img_with_rect,
-                'rect_coords': xml_coordinate_array,
-                'rect_id': rect_id
-              })
-
-            rect_id +=1
+    if issue_rects_to_articles:
+      rects_to_articles[issue_directory] = issue_rects_to_articles
+
+  if multiprocess:
+    pool.close()
+    pool.join()
+
+  if shard is not None:
+    write_shard_mapping(imgs_to_crop, rects_to_articles, issue_rect_ids)
+    return
 
   with open('rects_to_articles.json', 'w') as out:
     json.dump(rects_to_articles, out)
@@ -430,233 +800,2160 @@ def generate_issue_page_rectangle_mapping(root_data_directory):
   with open('imgs_to_crop.json', 'w') as out:
     json.dump(imgs_to_crop, out)
 
+  write_rect_index(imgs_to_crop, rects_to_articles)
 
-####################################
-# Store the titles of each article #
-####################################
 
-def store_article_titles():
+def map_issue_rectangles(issue_directory):
   '''
-  Persist to disk a mapping from the path to an article to the given
-  article's title
+  Read in the path to a single issue directory and map the rectangles
+  in that issue's xml files to the pages on which they're printed and
+  the articles to which they belong. Return the issue directory, the
+  imgs_to_crop and rects_to_articles mappings for that issue, and the
+  number of rects in the issue. Rect ids count up from 0 within the issue
   '''
-  article_to_title = {}
-
-  with open('rects_to_articles.json') as f:
-    rects_to_articles = json.load(f)
-
-  for issue in rects_to_articles.keys():
-    for page in rects_to_articles[issue].keys():
-      for article_index in rects_to_articles[issue][page]:
-        page_number = page.split('.')[0]
+  start = time.time()
 
-        first_image = rects_to_articles[issue][page][article_index][0]
-        article_path = os.path.join(issue, page_number, article_index)
-
-        # store the mapping from article path to first image path
-        first_image_name = str(first_image['rect_id']) + '.png'
-        path_to_first_image = os.path.join(article_path, first_image_name)
-        article_to_title[article_path] = path_to_first_image
+  # index position of each rectangle within the issue
+  rect_id = 0
 
-  with open('articles_to_titles.json', 'w') as out:
-    json.dump(article_to_title, out)
+  # d[article_xml_filename][article_index] = [{img_with_rect:, rect_coords:}]
+  rects_to_articles = defaultdict(lambda: defaultdict(list))
 
+  # d[img_file] = [{rect_id: , rect_coords: }]
+  imgs_to_crop = defaultdict(list)
 
-##################
-# Segment Images #
-##################
+  page_id_to_page_file, page_file_to_page_id = get_page_mappings(issue_directory)
 
-def segment_images(process_id):
-  '''
-  Read in a process id that will indicate which enumerated issues
-  the current process is responsible for. Then read into memory
-  the imgs_to_crop JSON, read in the
-  numpy array that corresponds to each image file identified in
-  that JSON file, pluck out the appropriate rectangles, and save
-  them to disk. To ensure equal division of labor among processors,
-  only allow the current process to work on an issue directory if
-  issue directory index position % total number of processes ==
-  process id
-  '''
+  # each xml/jp2 file combination in the issue_directory 
+  # contains a single newspaper page
+  xml_pages = get_article_xml_files(issue_directory)
 
-  with open('imgs_to_crop.json') as f:
-    rectangle_mappings = json.load(f)
+  # iterate over each xml file and get all rectangles on that page
+  for page_index, xml_page in enumerate(xml_pages):
 
-  for c, issue_directory in enumerate(rectangle_mappings.iterkeys()):
-    # to distribute work among available processors, enumerate the issue directories,
-    # take the current issue directory number modulo the total number of processes,
-    # and check if that value == the current process id; if not, continue
-    if c % n_processes != process_id:
-      continue
+    # parse out the xml file that references the images
+    article_xml_filename = os.path.basename(xml_page)
 
-    for page in rectangle_mappings[issue_directory].iterkeys():
+    # identify the image for the current xml file
+    current_img = article_xml_filename.replace('.articles.xml','.jp2')
 
-      # fetch the numpy array for cropping
-      jp2_array = jp2_path_to_array(issue_directory + '/' + page)
-      if jp2_array is None:
-        continue
+    article_index = None
 
-      for rect in rectangle_mappings[issue_directory][page]:
-        rect_id = rect['rect_id']
-        rect_coords = rect['coords']
-        jp2_coordinates = convert_coordinates(rect_coords, jp2_array, page)
+    # each clip_coord describes one rectangle a user drew on a jp2 image.
+    # The coords are the x_offset, y_offset, width, height of that
+    # rectangle in xml units, which must be converted into pixel units
+    # for extraction. The inpage value identifies the page with the
+    # rectangle, which must be mapped to a proper file
+    try:
+      for clip_coord in iter_clip_coords(xml_page):
 
-        if not jp2_coordinates:
-          print 'jp2_coordinates unavailable for', page
+        # store a boolean indicating whether this article includes rects from
+        # multiple images. This is used to prevent us from duplicating rects
+        # in articles with multiple pages (as the ALTO XML does)
+        if clip_coord.article_index != article_index:
+          article_index = clip_coord.article_index
+          rects_already_stored = False
+
+        xml_coordinate_array = clip_coord.coords
+        xml_coord_index = clip_coord.coord_index
+
+        # now use the inpage value to identify the file with the rectangle
+        try:
+          img_with_rect = page_id_to_page_file[clip_coord.inpage]
+
+        # handle case where issue references a page that doesn't exist
+        except KeyError as exc:
+          log_failure('missing_page_article', 'missing_page_articles.txt',
+            issue_directory + ' ' + str(clip_coord.inpage), issue=issue_directory,
+            exc=exc, xml_file=xml_page, inpage=clip_coord.inpage)
           continue
 
-        min_row, max_row, min_col, max_col = [int(i) for i in jp2_coordinates]
-
-        # apply the padding to each value
-        min_row -= padding
-        max_row += padding
-        min_col -= padding
-        max_col += padding
+        # d[img_file] = [{rect_id: , rect_coords: }]
+        imgs_to_crop[img_with_rect].append({
+          'coords': xml_coordinate_array,
+          'rect_id': rect_id
+        })
+
+        # articles that appear on multiple pages have their XML coordinates
+        # expressed on each page where they occur--this is part of the ALTO
+        # XML schema. To ensure we don't create duplicate outputs for those
+        # articles, examine the first XML coordinate for the given rect.
+        # If the image for that coord set occurs on the current image, store
+        # the mapping, else continue
+        if xml_coord_index == 0:
+          if current_img != img_with_rect:
+            rects_already_stored = True
 
         if verbosity_level > 1:
-          print issue_directory, page, article_index
-          print xml_coordinates
-          print min_row, max_row, min_col, max_col
+          print article_index, xml_coord_index, img_with_rect, rect_id
 
-        cropped = jp2_array[min_row:max_row, min_col:max_col]
+        if not rects_already_stored:
+          rects_to_articles[article_xml_filename][article_index].append({
+            'img_with_rect': img_with_rect,
+            'rect_coords': xml_coordinate_array,
+            'rect_id': rect_id
+          })
 
-        # write the cropped image to disk
-        out_path  = 'cropped_images/' + issue_directory + '/'
+        rect_id +=1
 
-        if not os.path.exists(out_path):
-          os.makedirs(out_path)
+    # handle malformed xml files and coords; rects parsed before
+    # the error are kept
+    except (ValueError, SyntaxError) as exc:
+      log_failure('unparseable_xml', 'unparseable-xml.txt', xml_page + ' ' + str(exc),
+        issue=issue_directory, exc=exc, xml_file=xml_page)
+
+  get_metrics().emit('map_issue', issue=issue_directory, xml_files=len(xml_pages),
+    rects=rect_id, seconds=round(time.time() - start, 6))
 
-        io.imsave(out_path + str(rect_id) + '.png', cropped)
-        
+  # convert the mappings to plain dicts so they can be sent between processes
+  rects_to_articles = {k: dict(v) for k, v in rects_to_articles.iteritems()}
+  return issue_directory, dict(imgs_to_crop), rects_to_articles, rect_id
 
-def convert_coordinates(xml_coordinate_array, jp2_array, page):
+
+def offset_rect_ids(imgs_to_crop, rects_to_articles, rect_id_offset):
+  '''
+  Read in the imgs_to_crop and rects_to_articles mappings for a single
+  issue and add rect_id_offset to the id of each rect in those mappings
   '''
-  Read in an array of four coordinates that describe a
-  single rectangle in XML type='uc' coordinates, a jp2 image pixel
-  array, and a page identifier, and return an array of the
-  min_row, max_row, min_col, max_col values
-  needed in jp2 pixels to describe the same rectangle
+  for rects in imgs_to_crop.itervalues():
+    for rect in rects:
+      rect['rect_id'] += rect_id_offset
+
+  for articles in rects_to_articles.itervalues():
+    for rects in articles.itervalues():
+      for rect in rects:
+        rect['rect_id'] += rect_id_offset
+
+
+###################
+# Rectangle Index #
+###################
+
+# one row per rect in the rect index. issue, page and xml_page are
+# positions in the index's string tables; article is the rect's article
+# index within xml_page, and in_article is False for the duplicate rects
+# of articles that span pages (these only appear in imgs_to_crop)
+rect_index_dtype = np.dtype([
+  ('issue', '<i4'),
+  ('page', '<i4'),
+  ('xml_page', '<i4'),
+  ('article', '<i4'),
+  ('rect_id', '<i8'),
+  ('coords', '<i4', (4,)),
+  ('in_article', '?')
+])
+
+# one row per page in the rect index, with the slice of rects on that page
+page_offsets_dtype = np.dtype([
+  ('issue', '<i4'),
+  ('page', '<i4'),
+  ('start', '<i8'),
+  ('stop', '<i8')
+])
+
+
+def write_rect_index(imgs_to_crop, rects_to_articles, index_directory='rect_index'):
   '''
+  Read in the imgs_to_crop and rects_to_articles mappings and write
+  them to disk as a columnar index that workers can memory map:
 
-  # magic number plucked from client side js in extant YDN app
-  # it's the largest 16 bit integer
-  multiplier = 65535
+  rects.npy         - rect_index_dtype rows sorted by issue, page and rect id
+  issue_offsets.npy - the rects of issue i are rects[offsets[i]:offsets[i+1]]
+  page_offsets.npy  - page_offsets_dtype rows with the rects of each page
+  strings.json      - the issue directory and page filename string tables
+  '''
+  issues = sorted(imgs_to_crop.keys())
+  page_names = set()
 
-  # scale is a positive integer that indicates zoom level in the app
-  scale = 100
+  for issue_directory in issues:
+    page_names.update(imgs_to_crop[issue_directory].keys())
+    page_names.update(rects_to_articles.get(issue_directory, {}).keys())
 
-  # array of uc coordinates from XML
-  left, top, width, height = xml_coordinate_array
+  page_names = sorted(page_names)
+  page_ids = {page: page_id for page_id, page in enumerate(page_names)}
 
-  if len(jp2_array.shape) != 2:
-    print 'could not process', page, jp2_array.shape
-    return None
+  rows = []
+  issue_offsets = [0]
+  page_offsets = []
 
-  # the height and width of the original image
-  img_height, img_width = jp2_array.shape
+  for issue_id, issue_directory in enumerate(issues):
 
-  new_left   = ((left / multiplier) * img_width) * scale / 100
-  new_top    = ((top / multiplier) * img_height) * scale / 100
-  new_width  = ((width / multiplier) * img_width) * scale / 100
-  new_height = ((height / multiplier) * img_height) * scale / 100
+    # find the article to which each rect belongs
+    rect_articles = {}
+    for xml_page, articles in rects_to_articles.get(issue_directory, {}).iteritems():
+      for article_index, rects in articles.iteritems():
+        for rect in rects:
+          rect_articles[rect['rect_id']] = (page_ids[xml_page], int(article_index))
 
-  # return these values in min_row, max_row, min_col, max_col form
-  return new_top, new_top+new_height, new_left, new_left+new_width
+    for page in sorted(imgs_to_crop[issue_directory].keys()):
+      page_start = len(rows)
 
-###########################################
-# Sort the segmented images into articles #
-###########################################
+      for rect in sorted(imgs_to_crop[issue_directory][page], key=lambda r: r['rect_id']):
+        xml_page, article_index = rect_articles.get(rect['rect_id'], (-1, -1))
+        rows.append((
+          issue_id,
+          page_ids[page],
+          xml_page,
+          article_index,
+          rect['rect_id'],
+          rect['coords'],
+          rect['rect_id'] in rect_articles
+        ))
 
-def sort_segmented_images():
-  '''
-  Once all the segmented images are on disk, sort them into their relevant
-  articles
-  '''
+      page_offsets.append((issue_id, page_ids[page], page_start, len(rows)))
 
-  # store a mapping from a path to a list of segmented image files at that path
-  # the images should be stored in the order in which they should be combined
-  segmented_image_paths = defaultdict(list)
+    issue_offsets.append(len(rows))
 
-  with open('rects_to_articles.json') as f:
-    rects_to_articles = json.load(f)
+  if not os.path.exists(index_directory):
+    os.makedirs(index_directory)
 
-  for issue in rects_to_articles.keys():
-    for page in rects_to_articles[issue].keys():
-      for article_index in rects_to_articles[issue][page]:
-        for rect_meta in rects_to_articles[issue][page][article_index]:
-          print('making', 'cropped_images' + issue + '/' + article_index + '/')
+  np.save(os.path.join(index_directory, 'rects.npy'),
+    np.array(rows, dtype=rect_index_dtype))
+  np.save(os.path.join(index_directory, 'issue_offsets.npy'),
+    np.array(issue_offsets, dtype='<i8'))
+  np.save(os.path.join(index_directory, 'page_offsets.npy'),
+    np.array(page_offsets, dtype=page_offsets_dtype))
 
-          page_number = page.split('.')[0]
-          img_filename = str(rect_meta['rect_id']) + '.png'
-          img_path = 'cropped_images' + issue + '/' + img_filename
-          out_path  = 'segmented_images' + issue + '/' + page_number + '/' + article_index + '/'
+  with open(os.path.join(index_directory, 'strings.json'), 'w') as out:
+    json.dump({'issues': issues, 'pages': page_names}, out)
 
-          if not os.path.exists(out_path):
-            os.makedirs(out_path)
-          try:
-            move(img_path, out_path)
 
-            # update the list of images stored at the given path
-            segmented_image_paths[out_path].append(img_filename)
+def load_rect_index(index_directory='rect_index'):
+  '''
+  Read in the path to a rect index directory and return a dictionary
+  with the index's memory mapped arrays and its string tables
+  '''
+  rect_index = {}
+  for name in ['rects', 'issue_offsets', 'page_offsets']:
+    path = os.path.join(index_directory, name + '.npy')
+    rect_index[name] = np.load(path, mmap_mode='r')
 
-          # handle the case of missing rects
-          except:
-            with open('missing_rects.txt', 'a') as missing_out:
-              missing_out.write(img_path + '\n')
+  with open(os.path.join(index_directory, 'strings.json')) as f:
+    rect_index.update(json.load(f))
 
-  # save the mapping from path to images so we can combine all images per article easily
-  with open('images_per_article.json', 'w') as out:
-    json.dump(segmented_image_paths, out)
+  return rect_index
 
-##############################
-# Stack the segmented images #
-##############################
 
-def stack_segmented_images():
+def read_index_rects(start, stop, index_directory='rect_index'):
   '''
-  Create one composite image for each article's images
+  Read in the bounds of a slice of the rect index and return the
+  rects in that slice as [{rect_id: , coords: }] without reading
+  the rest of the index
   '''
+  rects = np.load(os.path.join(index_directory, 'rects.npy'), mmap_mode='r')
+  return [{'rect_id': int(i['rect_id']), 'coords': i['coords'].tolist()}
+    for i in rects[start:stop]]
 
-  with open('images_per_article.json') as f:
-    images_per_article = json.load(f)
 
-  for article_id, article_path in enumerate(images_per_article.keys()):
-    heights = []
-    widths = []
-    vectors = []
+def get_rect_page(rect_index, issue_directory, rect_id):
+  '''
+  Read in a loaded rect index, an issue directory and the id of a rect
+  in that issue, and return the filename of the page image on which the
+  rect is printed, or None if the rect isn't in the index
+  '''
+  issue_id = rect_index['issues'].index(issue_directory)
+  start, stop = rect_index['issue_offsets'][issue_id:issue_id+2]
+  rects = rect_index['rects'][start:stop]
+  matches = np.flatnonzero(rects['rect_id'] == rect_id)
+  if not len(matches):
+    return None
+  return rect_index['pages'][rects['page'][matches[0]]]
 
-    # vertically stack all images in this article
-    for article_image in images_per_article[article_path]:
-      image_path = article_path + article_image
-      article_vector = io.imread(image_path)
-
-      h, w = article_vector.shape[:2]
-      heights.append(h)
-      widths.append(w)
-      vectors.append(article_vector)
-
-    # initialize an empty vector with the required shape
-    composite_image = np.zeros( (sum(heights), max(widths) ), np.uint8)
-
-    # make the background of the image #fff (these are unsigned 8 bit grayscale images)
-    composite_image.fill(255)
-
-    # add the individual elements to the composite image
-    height_sum = 0
-    for idx, i in enumerate(vectors):
-      _h = heights[idx]
-      _w = widths[idx]
-      _vector = vectors[idx] 
-      composite_image[height_sum:height_sum+_h, 0:_w] = _vector
-      height_sum += _h
-
-    # create an outdir for the composite image
-    composite_path = os.path.join('composite_images', article_path)
-    if not os.path.exists(composite_path):
-      os.makedirs(composite_path)
 
-    io.imsave(os.path.join(composite_path, str(article_id) + '.png'), composite_image)
+def iter_index_articles(rect_index, issue_id):
+  '''
+  Read in a loaded rect index and the position of an issue in its
+  issue table, and yield an (xml_page, article_index, rect_ids) tuple
+  for each article in that issue, with the article's rect ids in order
+  '''
+  start, stop = rect_index['issue_offsets'][issue_id:issue_id+2]
+  rects = rect_index['rects'][start:stop]
+  rects = rects[rects['in_article']]
 
+  if not len(rects):
+    return
+
+  order = np.lexsort((rects['rect_id'], rects['article'], rects['xml_page']))
+  rects = rects[order]
+
+  # find the positions at which a new article starts
+  article_keys = np.column_stack((rects['xml_page'], rects['article']))
+  boundaries = np.flatnonzero(np.any(np.diff(article_keys, axis=0) != 0, axis=1)) + 1
+  boundaries = [0] + boundaries.tolist() + [len(rects)]
+
+  for article_start, article_stop in zip(boundaries[:-1], boundaries[1:]):
+    article_rects = rects[article_start:article_stop]
+    yield (
+      rect_index['pages'][article_rects['xml_page'][0]],
+      int(article_rects['article'][0]),
+      article_rects['rect_id'].tolist()
+    )
+
+
+####################################
+# Store the titles of each article #
+####################################
+
+def store_article_titles():
+  '''
+  Persist to disk a mapping from the path to an article to the given
+  article's title
+  '''
+  article_to_title = {}
+
+  rect_index = load_rect_index()
+
+  for issue_id, issue in enumerate(rect_index['issues']):
+    for page, article_index, rect_ids in iter_index_articles(rect_index, issue_id):
+      page_number = page.split('.')[0]
+
+      article_path = os.path.join(issue, page_number, str(article_index))
+
+      # store the mapping from article path to first image path
+      first_image_name = str(rect_ids[0]) + '.png'
+      path_to_first_image = os.path.join(article_path, first_image_name)
+      article_to_title[article_path] = path_to_first_image
+
+  with open('articles_to_titles.json', 'w') as out:
+    json.dump(article_to_title, out)
+
+
+##################
+# Segment Images #
+##################
+
+def segment_images():
+  '''
+  Read in the page offsets of the rect index and split them into one
+  unit of work per page of each issue. Each unit is handed to the next idle
+  worker in a process pool, which reads in the rects and numpy array for that page,
+  plucks out the appropriate rectangles, and saves them to disk. If
+  order_by_cost is True, the most expensive pages are handed out first
+  so no worker is left with a large page at the end of the stage
+  '''
+
+  rect_index = load_rect_index()
+
+  # only crop the selected issues, if any are selected. Each unit
+  # holds the slice of the rect index with the rects on its page
+  page_units = []
+  for issue_id, page_id, start, stop in rect_index['page_offsets']:
+    issue_directory = rect_index['issues'][issue_id]
+    if selected_issues is not None and issue_directory not in selected_issues:
+      continue
+
+    page = rect_index['pages'][page_id]
+    page_units.append((issue_directory, page, int(start), int(stop)))
+
+  if order_by_cost:
+    page_units.sort(key=estimate_page_cost, reverse=True)
+
+  busy_seconds = defaultdict(float)
+  units_processed = defaultdict(int)
+  start = time.time()
+
+  # workers pull the next unit from the pool's task queue as they finish
+  if multiprocess:
+    pool = Pool(n_processes)
+    results = imap_within_budget(pool, segment_page_unit, page_units,
+      estimate_page_unit_memory, memory_budget, n_processes)
+  else:
+    results = (segment_page_unit(i) for i in page_units)
+
+  for worker_name, elapsed in results:
+    busy_seconds[worker_name] += elapsed
+    units_processed[worker_name] += 1
+
+  # workers write their queued images as they exit
+  if multiprocess:
+    pool.close()
+    pool.join()
+  else:
+    flush_image_writer()
+
+  wall_seconds = max(time.time() - start, 1e-9)
+
+  for worker_name in sorted(busy_seconds):
+    get_metrics().emit('crop_worker', crop_worker=worker_name,
+      pages=units_processed[worker_name],
+      busy_seconds=round(busy_seconds[worker_name], 6),
+      utilisation=round(busy_seconds[worker_name] / wall_seconds, 4))
+
+  if verbosity_level > 0:
+    for worker_name in sorted(busy_seconds):
+      print worker_name, units_processed[worker_name], 'pages',
+      print round(busy_seconds[worker_name], 2), 'seconds busy',
+      print round(100 * busy_seconds[worker_name] / wall_seconds, 1), '% utilisation'
+
+
+def segment_page_unit(page_unit):
+  '''
+  Read in an (issue_directory, page, start, stop) unit of work, crop
+  the rects in that slice of the rect index from that page, and return
+  the name of the worker that did the work and the number of seconds
+  it took
+  '''
+  metrics = get_metrics()
+  metrics.take_counters()
+
+  start = time.time()
+  issue_directory, page, rects_start, rects_stop = page_unit
+
+  # a page that fails is journalled, and the other pages carry on
+  try:
+    segment_page(issue_directory, page, read_index_rects(rects_start, rects_stop))
+  except Exception as exc:
+    log_failure('failed_page', issue=issue_directory, page=page, exc=exc,
+      seconds=time.time() - start)
+
+  elapsed = time.time() - start
+
+  metrics.emit('crop_page', issue=issue_directory, page=page,
+    rects=rects_stop - rects_start, seconds=round(elapsed, 6),
+    **metrics.take_counters())
+  return current_process().name, elapsed
+
+
+def estimate_page_cost(page_unit):
+  '''
+  Read in an (issue_directory, page, start, stop) unit of work and return
+  an estimate of the cost of cropping it: the page's pixel count times the
+  number of rects. Pixel counts come from the header of the page's jp2
+  file; for pages whose header can't be read, the jp2 file size in the
+  issue catalog stands in for the pixel count
+  '''
+  issue_directory, page, start, stop = page_unit
+  jp2_path = issue_directory + '/' + page
+
+  try:
+    image_size = read_image_size(jp2_path)
+    page_size = image_size.height * image_size.width * image_size.channels
+  except Exception:
+    page_size = get_catalog_issue(issue_directory)['files'].get(page, [0])[0]
+
+  return page_size * (stop - start)
+
+
+def estimate_page_unit_memory(page_unit):
+  '''
+  Read in an (issue_directory, page, start, stop) unit of work and return
+  the estimated peak memory in bytes of cropping it
+  '''
+  issue_directory, page, start, stop = page_unit
+  return estimate_page_memory(issue_directory + '/' + page)
+
+
+def segment_page(issue_directory, page, rects):
+  '''
+  Read in the path to an issue directory, the filename of a page
+  image in that issue, and the rects to crop from that page, and
+  write each of those rects to disk
+  '''
+  out_path  = 'cropped_images/' + issue_directory + '/'
+
+  if output_backend == 'files' and not os.path.exists(out_path):
+    os.makedirs(out_path)
+
+  image_writer = get_image_writer()
+  metrics = get_metrics()
+
+  for rect_id, cropped in crop_page(issue_directory, page, rects):
+    img_filename = str(rect_id) + '.png'
+    destination = get_output_destination(issue_directory,
+      out_path + img_filename, 'cropped/' + img_filename)
+
+    # time spent waiting for a free slot in the writer queue
+    with metrics.timer('write_wait_seconds'):
+      image_writer.submit(destination, cropped, (issue_directory, page))
+
+
+def crop_page(issue_directory, page, rects):
+  '''
+  Read in the path to an issue directory, the filename of a page
+  image in that issue, and the rects to crop from that page, and
+  yield a (rect_id, cropped) tuple for each of those rects. If
+  decode_mode == 'region', only decode the part of the jp2 covered
+  by the rects rather than the full page. If resolution_level > 0,
+  yield crops that are downsampled by a factor of 2 ** resolution_level
+  '''
+
+  jp2_path = issue_directory + '/' + page
+  jp2_array = None
+
+  # fetch the page dimensions (and the numpy array for cropping)
+  if decode_mode == 'region':
+    img_shape = get_jp2_shape(jp2_path)
+  else:
+    jp2_array = jp2_path_to_array(jp2_path)
+    if jp2_array is None:
+      return
+    img_shape = jp2_array.shape
+
+  if img_shape is None:
+    return
+
+  metrics = get_metrics()
+
+  # close the page even if the caller stops before the last crop
+  try:
+    # find the padded jp2 pixel box for each rect
+    with metrics.timer('crop_seconds'):
+      boxes = plan_page_crops(rects, img_shape, page)
+
+    if verbosity_level > 1:
+      print issue_directory, page
+      print boxes
+
+    if not len(boxes):
+      return
+
+    # decode only the region of the jp2 that contains the rects
+    step = 2 ** resolution_level
+    row_offset = 0
+    col_offset = 0
+
+    if decode_mode == 'region':
+      row_offset = int(boxes[:, 1].min())
+      col_offset = int(boxes[:, 3].min())
+      max_row = int(boxes[:, 2].max())
+      max_col = int(boxes[:, 4].max())
+
+      with metrics.timer('decode_seconds'):
+        jp2_array = read_jp2_region(jp2_path, row_offset, max_row,
+          col_offset, max_col, resolution_level)
+      if jp2_array is None:
+        return
+
+      metrics.count('bytes_read', jp2_array.nbytes)
+
+      # the region is already decoded at the requested resolution
+      region_step = step
+    else:
+      region_step = 1
+
+    # reduced resolution jp2 regions span pixels ceil(offset / step) onward
+    row_start = -(-row_offset // region_step)
+    col_start = -(-col_offset // region_step)
+
+    for rect_id, min_row, max_row, min_col, max_col in boxes.tolist():
+      crop_start = time.time()
+      cropped = jp2_array[
+        -(-min_row // region_step) - row_start : -(-max_row // region_step) - row_start,
+        -(-min_col // region_step) - col_start : -(-max_col // region_step) - col_start
+      ]
+
+      # downsample crops cut from a full resolution page
+      if step != region_step:
+        cropped = cropped[::step, ::step]
+
+      metrics.count('crop_seconds', time.time() - crop_start)
+      yield rect_id, cropped
+
+  finally:
+    # tiled pages only read the tiles that the rects overlap
+    if isinstance(jp2_array, TiledPage):
+      metrics.count('bytes_read', jp2_array.bytes_read)
+    close_cached_page(jp2_array)
+
+
+def get_jp2_shape(path_to_jp2_file):
+  '''
+  Read in the path to a jp2 image file and return the shape of
+  that image's pixel array. If glymur is available, only read the
+  jp2 header with glymur; else read the header's ihdr box, and only
+  fall back to the cached numpy array if the header can't be read
+  '''
+  if glymur is not None:
+    start = time.time()
+    try:
+      return glymur.Jp2k(path_to_jp2_file).shape
+    except Exception as exc:
+      log_unprocessable_image(path_to_jp2_file, exc, start)
+      return None
+
+  try:
+    image_size = read_image_size(path_to_jp2_file)
+    if image_size.channels == 1:
+      return image_size.height, image_size.width
+    return image_size.height, image_size.width, image_size.channels
+  except Exception:
+    pass
+
+  jp2_array = jp2_path_to_array(path_to_jp2_file)
+  if jp2_array is None:
+    return None
+  close_cached_page(jp2_array)
+  return jp2_array.shape
+
+
+def read_jp2_region(path_to_jp2_file, min_row, max_row, min_col, max_col,
+    resolution_level=0):
+  '''
+  Read in the path to a jp2 image file, the bounds of a region in
+  full resolution pixels and a resolution level, and return the pixels
+  in that region downsampled by a factor of 2 ** resolution_level.
+  Glymur uses the jp2 tile and resolution structure to decode only
+  the requested region; without glymur, crop the full page instead
+  '''
+  step = 2 ** resolution_level
+
+  if glymur is not None:
+    start = time.time()
+    try:
+      jp2 = glymur.Jp2k(path_to_jp2_file)
+      return jp2[min_row:max_row:step, min_col:max_col:step]
+    except Exception as exc:
+      log_unprocessable_image(path_to_jp2_file, exc, start)
+      return None
+
+  jp2_array = jp2_path_to_array(path_to_jp2_file)
+  if jp2_array is None:
+    return None
+  region = jp2_array[min_row:max_row:step, min_col:max_col:step]
+  close_cached_page(jp2_array)
+  return region
+
+
+def plan_page_crops(rects, img_shape, page):
+  '''
+  Read in the rects to crop from a page, each with an array of four
+  coordinates that describe a single rectangle in XML type='uc'
+  coordinates, the shape of that page's jp2 image pixel array, and a
+  page identifier. Return an integer array with one
+  rect_id, min_row, max_row, min_col, max_col row per rect, with
+  the values in padded jp2 pixels clipped to the bounds of the page.
+  Rects that are empty once clipped are dropped, and the rows are
+  sorted by min_row so the crops read the page from top to bottom
+  '''
+
+  # magic number plucked from client side js in extant YDN app
+  # it's the largest 16 bit integer
+  multiplier = 65535
+
+  # scale is a positive integer that indicates zoom level in the app
+  scale = 100
+
+  if len(img_shape) != 2:
+    print 'could not process', page, img_shape
+    return np.zeros((0, 5), np.int64)
+
+  # the height and width of the original image
+  img_height, img_width = img_shape
+
+  # one row of uc coordinates from XML per rect
+  rect_ids = np.array([r['rect_id'] for r in rects], np.int64)
+  coords = np.array([r['coords'] for r in rects], np.float64).reshape(-1, 4)
+  left, top, width, height = coords.T
+
+  new_left   = ((left / multiplier) * img_width) * scale / 100
+  new_top    = ((top / multiplier) * img_height) * scale / 100
+  new_width  = ((width / multiplier) * img_width) * scale / 100
+  new_height = ((height / multiplier) * img_height) * scale / 100
+
+  # min_row, max_row, min_col, max_col form, padded and clipped to the page
+  boxes = np.column_stack((
+    rect_ids,
+    np.clip(new_top.astype(np.int64) - padding, 0, img_height),
+    np.clip((new_top + new_height).astype(np.int64) + padding, 0, img_height),
+    np.clip(new_left.astype(np.int64) - padding, 0, img_width),
+    np.clip((new_left + new_width).astype(np.int64) + padding, 0, img_width)
+  ))
+
+  boxes = boxes[(boxes[:, 2] > boxes[:, 1]) & (boxes[:, 4] > boxes[:, 3])]
+  return boxes[np.argsort(boxes[:, 1], kind='mergesort')]
+
+
+###########################################
+# Sort the segmented images into articles #
+###########################################
+
+def sort_segmented_images(issues=None):
+  '''
+  Once all the segmented images are on disk, sort them into their relevant
+  articles. If a list of issues is given, only sort the images for those
+  issues, and keep the mappings of the other issues in images_per_article.json
+  '''
+
+  # store a mapping from a path to a list of segmented image files at that path
+  # the images should be stored in the order in which they should be combined
+  segmented_image_paths = defaultdict(list)
+
+  rect_index = load_rect_index()
+
+  if issues is not None:
+    segmented_image_paths.update(load_images_per_article(exclude_issues=issues))
+
+  metrics = get_metrics()
+
+  for issue_id, issue in enumerate(rect_index['issues']):
+    if issues is not None and issue not in issues:
+      continue
+
+    start = time.time()
+    metrics.take_counters()
+
+    if output_backend == 'shards':
+      segmented_image_paths.update(sort_shard_images(rect_index, issue_id))
+      metrics.emit('sort_issue', issue=issue, seconds=round(time.time() - start, 6))
+      continue
+
+    for page, article_index, rect_ids in iter_index_articles(rect_index, issue_id):
+      article_index = str(article_index)
+
+      for rect_id in rect_ids:
+        if verbosity_level > 1:
+          print('making', 'cropped_images' + issue + '/' + article_index + '/')
+
+        img_filename = str(rect_id) + '.png'
+        img_path = 'cropped_images' + issue + '/' + img_filename
+        out_path  = get_article_path(issue, page, article_index)
+
+        if not os.path.exists(out_path):
+          os.makedirs(out_path)
+        try:
+          move(img_path, out_path)
+
+          # update the list of images stored at the given path
+          segmented_image_paths[out_path].append(img_filename)
+          metrics.count('images_moved')
+
+        # handle the case of missing rects
+        except (IOError, OSError, Error) as exc:
+          metrics.count('images_missing')
+          log_failure('missing_rect', 'missing_rects.txt', img_path, issue=issue,
+            page=get_rect_page(rect_index, issue, rect_id), rect_id=rect_id, exc=exc,
+            article_index=int(article_index))
+
+    metrics.emit('sort_issue', issue=issue, seconds=round(time.time() - start, 6),
+      **metrics.take_counters())
+
+  # save the mapping from path to images so we can combine all images per article easily
+  with open(get_images_per_article_path(), 'w') as out:
+    json.dump(segmented_image_paths, out)
+
+
+def sort_shard_images(rect_index, issue_id):
+  '''
+  Read in a loaded rect index and the position of an issue in its
+  issue table, and store each cropped image in that issue's shard
+  under its article's key as well (without copying the image). Return
+  a mapping from each article path to its segmented images
+  '''
+  issue = rect_index['issues'][issue_id]
+  segmented_image_paths = defaultdict(list)
+  key_pairs = []
+
+  # d[cropped image key] = out_path of the rect's article
+  rect_articles = {}
+
+  for page, article_index, rect_ids in iter_index_articles(rect_index, issue_id):
+    out_path = get_article_path(issue, page, article_index)
+
+    for rect_id in rect_ids:
+      img_filename = str(rect_id) + '.png'
+      key_pairs.append(('cropped/' + img_filename, get_article_key(out_path) + img_filename))
+      segmented_image_paths[out_path].append(img_filename)
+      rect_articles['cropped/' + img_filename] = out_path
+
+  # handle the case of missing rects
+  missing_keys = link_shard_images(get_shard_path(issue), key_pairs)
+
+  for key in missing_keys:
+    img_filename = key.split('/')[-1]
+    out_path = rect_articles[key]
+    rect_id = int(img_filename.split('.')[0])
+    log_failure('missing_rect', 'missing_rects.txt', 'cropped_images' + issue + '/' + img_filename,
+      issue=issue, page=get_rect_page(rect_index, issue, rect_id), rect_id=rect_id)
+    segmented_image_paths[out_path].remove(img_filename)
+
+  return {k: v for k, v in segmented_image_paths.iteritems() if v}
+
+
+def get_article_path(issue_directory, page, article_index):
+  '''
+  Read in the path to an issue directory, the filename of an
+  articles.xml file in that issue and the index of an article in
+  that file, and return the directory for that article's images
+  '''
+  page_number = page.split('.')[0]
+  return 'segmented_images' + issue_directory + '/' + page_number + '/' + \
+    str(article_index) + '/'
+
+
+def split_article_path(article_path):
+  '''
+  Read in the directory for an article's images and return the
+  issue directory, page number and article index of that article
+  '''
+  return article_path[len('segmented_images'):].rstrip('/').rsplit('/', 2)
+
+
+def get_article_key(article_path):
+  '''
+  Read in the directory for an article's images and return the prefix
+  of the keys of that article's images in its issue's shard
+  '''
+  issue_directory, page_number, article_index = split_article_path(article_path)
+  return 'segmented/' + page_number + '/' + article_index + '/'
+
+
+def load_images_per_article(exclude_issues):
+  '''
+  Read the mapping from article path to segmented images from disk and
+  return the entries for all articles that don't belong to the given issues
+  '''
+  images_per_article_path = get_images_per_article_path()
+  if not os.path.exists(images_per_article_path):
+    return {}
+
+  with open(images_per_article_path) as f:
+    images_per_article = json.load(f)
+
+  return {article_path: images
+    for article_path, images in images_per_article.iteritems()
+    if not any(issue_owns_path(i, article_path) for i in exclude_issues)}
+
+##############################
+# Stack the segmented images #
+##############################
+
+def stack_segmented_images(issues=None):
+  '''
+  Create one composite image for each article's images. Articles are
+  numbered in sorted order of the paths of all articles in the rect index,
+  so each composite keeps its id when only a list of issues is given and
+  stacked, and when other articles lost all of their images
+  '''
+
+  with open(get_images_per_article_path()) as f:
+    images_per_article = json.load(f)
+
+  rect_index = load_rect_index()
+  article_ids = get_composite_ids(rect_index)
+
+  image_writer = get_image_writer()
+  shard_indexes = {}
+
+  metrics = get_metrics()
+  metrics.take_counters()
+  start = time.time()
+
+  for article_path in sorted(images_per_article.keys()):
+    if issues is not None:
+      if not any(issue_owns_path(i, article_path) for i in issues):
+        continue
+
+    article_id = article_ids[article_path]
+
+    # vertically stack all images in this article
+    vectors = []
+    with metrics.timer('read_seconds'):
+      for article_image in images_per_article[article_path]:
+        image_path = article_path + article_image
+        read_start = time.time()
+
+        # an image that can't be read is journalled and left out of the composite
+        try:
+          if output_backend == 'shards':
+            vectors.append(read_article_image_from_shard(article_path, article_image, shard_indexes))
+          else:
+            vectors.append(io.imread(image_path))
+        except Exception as exc:
+          issue_directory = split_article_path(article_path)[0]
+          rect_id = int(article_image.split('.')[0])
+          log_failure('unreadable_image', 'unreadable-images.txt', image_path,
+            issue=issue_directory, page=get_rect_page(rect_index, issue_directory, rect_id),
+            rect_id=rect_id, exc=exc, seconds=time.time() - read_start)
+
+    if not vectors:
+      continue
+
+    with metrics.timer('stack_seconds'):
+      composite_image = build_composite_image(vectors)
+
+    with metrics.timer('write_wait_seconds'):
+      write_composite_image(article_path, article_id, composite_image, image_writer)
+
+    metrics.count('articles')
+    metrics.count('images', len(vectors))
+    metrics.count('bytes_read', sum(i.nbytes for i in vectors))
+
+  flush_image_writer()
+
+  metrics.emit('stack', seconds=round(time.time() - start, 6), **metrics.take_counters())
+
+
+def read_article_image_from_shard(article_path, article_image, shard_indexes):
+  '''
+  Read in the directory for an article's images, the filename of one
+  of those images and a dictionary in which to keep the index of the
+  last shard read, and return that image from the article's issue shard
+  '''
+  issue_directory = split_article_path(article_path)[0]
+  shard_path = get_shard_path(issue_directory)
+
+  if shard_path not in shard_indexes:
+    shard_indexes.clear()
+    shard_indexes[shard_path] = read_shard_index(shard_path)
+
+  key = get_article_key(article_path) + article_image
+  return read_shard_image(shard_path, key, shard_indexes[shard_path])
+
+
+def write_composite_image(article_path, article_id, composite_image, image_writer):
+  '''
+  Read in the directory for an article's images, the article's composite
+  id and composite image, and the image writer pool, and queue the
+  composite image to be written
+  '''
+  composite_path = os.path.join('composite_images', article_path)
+  composite_name = str(article_id) + '.png'
+
+  # create an outdir for the composite image
+  if output_backend == 'files' and not os.path.exists(composite_path):
+    os.makedirs(composite_path)
+
+  issue_directory, page_number, article_index = split_article_path(article_path)
+  key = 'composite/' + page_number + '/' + article_index + '/' + composite_name
+  destination = get_output_destination(issue_directory,
+    os.path.join(composite_path, composite_name), key)
+  image_writer.submit(destination, composite_image, (issue_directory, None))
+
+
+def build_composite_image(vectors):
+  '''
+  Read in a list of image arrays and return one composite image
+  with those images stacked vertically, in order
+  '''
+  heights = []
+  widths = []
+
+  for article_vector in vectors:
+    h, w = article_vector.shape[:2]
+    heights.append(h)
+    widths.append(w)
+
+  # initialize an empty vector with the required shape
+  composite_image = np.zeros( (sum(heights), max(widths) ), np.uint8)
+
+  # make the background of the image #fff (these are unsigned 8 bit grayscale images)
+  composite_image.fill(255)
+
+  # add the individual elements to the composite image
+  height_sum = 0
+  for idx, i in enumerate(vectors):
+    _h = heights[idx]
+    _w = widths[idx]
+    _vector = vectors[idx] 
+    composite_image[height_sum:height_sum+_h, 0:_w] = _vector
+    height_sum += _h
+
+  return composite_image
+
+
+#########################################
+# Fused crop, sort and stack processing #
+#########################################
+
+def segment_articles():
+  '''
+  Crop the rects of each article directly into that article's
+  directory in segmented_images, and build each article's composite
+  image from those crops while they're still in memory. This produces
+  the same outputs as segment_images, sort_segmented_images and
+  stack_segmented_images without writing, moving and reading back
+  every crop. Each issue is one unit of work, as articles can span
+  the pages of an issue
+  '''
+
+  rect_index = load_rect_index()
+  page_offsets = rect_index['page_offsets']
+
+  issue_units = []
+
+  for issue_id, issue_directory in enumerate(rect_index['issues']):
+    if selected_issues is not None and issue_directory not in selected_issues:
+      continue
+
+    articles = list(iter_index_articles(rect_index, issue_id))
+
+    # find the slice of the rect index with the rects on each page
+    first, last = np.searchsorted(page_offsets['issue'], [issue_id, issue_id + 1])
+    pages = [(rect_index['pages'][page_id], int(start), int(stop))
+      for _, page_id, start, stop in page_offsets[first:last]]
+
+    issue_units.append((issue_directory, pages, articles))
+
+  composite_ids = get_composite_ids(rect_index)
+
+  segmented_image_paths = {}
+  if selected_issues is not None:
+    segmented_image_paths.update(load_images_per_article(exclude_issues=selected_issues))
+
+  issue_units = [i + (composite_ids,) for i in issue_units]
+
+  if multiprocess:
+    pool = Pool(n_processes)
+    results = imap_within_budget(pool, segment_issue_articles, issue_units,
+      estimate_issue_unit_memory, memory_budget, n_processes)
+  else:
+    results = (segment_issue_articles(i) for i in issue_units)
+
+  for issue_image_paths in results:
+    segmented_image_paths.update(issue_image_paths)
+
+  # workers write their queued images as they exit
+  if multiprocess:
+    pool.close()
+    pool.join()
+  else:
+    flush_image_writer()
+
+  # save the mapping from path to images, as sort_segmented_images does
+  with open(get_images_per_article_path(), 'w') as out:
+    json.dump(segmented_image_paths, out)
+
+
+def get_composite_ids(rect_index):
+  '''
+  Read in a loaded rect index and return a dict that maps the path of
+  each article in the index to the id of its composite image. Composites
+  are numbered in sorted order of their article paths, just like
+  stack_segmented_images numbers them
+  '''
+  article_paths = []
+  for issue_id, issue_directory in enumerate(rect_index['issues']):
+    article_paths += [get_article_path(issue_directory, page, article_index)
+      for page, article_index, rect_ids in iter_index_articles(rect_index, issue_id)]
+
+  return {path: i for i, path in enumerate(sorted(article_paths))}
+
+
+def estimate_issue_unit_memory(issue_unit):
+  '''
+  Read in an issue unit of work and return the estimated peak memory
+  in bytes of segmenting it: that of its largest page, as its pages are
+  cropped one after another, plus the decoded size of each page that
+  isn't read from an up to date cached page, as copies of that page's
+  crops are kept until the issue's composites are built
+  '''
+  issue_directory, pages = issue_unit[:2]
+  jp2_paths = [issue_directory + '/' + page for page, start, stop in pages]
+
+  crop_bytes = 0
+  for jp2_path in jp2_paths:
+    if decode_mode == 'region' or not is_cached_array_current(jp2_path):
+      try:
+        crop_bytes += get_decoded_bytes(read_image_size(jp2_path))
+      except Exception:
+        pass
+
+  return max([estimate_page_memory(i) for i in jp2_paths] or [0]) + crop_bytes
+
+
+def segment_issue_articles(issue_unit):
+  '''
+  Read in an (issue_directory, pages, articles, composite_ids) unit of
+  work, where pages lists the (page, start, stop) slice of the rect index
+  for each page in the issue and articles lists the (xml_page,
+  article_index, rect_ids) of each article in the issue. Crop each
+  article's rects into its directory, write its composite image, and
+  return a mapping from each article path to its segmented images
+  '''
+  issue_directory, pages, articles, composite_ids = issue_unit
+
+  metrics = get_metrics()
+  metrics.take_counters()
+  issue_start = time.time()
+
+  # only crop rects that belong to an article
+  article_rect_ids = set()
+  for page, article_index, rect_ids in articles:
+    article_rect_ids.update(rect_ids)
+
+  # crops are views into the memory mapped page arrays (or copies, for
+  # pages that were decoded)
+  crops = {}
+
+  # d[rect_id] = the page image on which the rect is printed
+  rect_pages = {}
+
+  for page, start, stop in pages:
+    rects = [i for i in read_index_rects(start, stop) if i['rect_id'] in article_rect_ids]
+    if not rects:
+      continue
+
+    for rect in rects:
+      rect_pages[rect['rect_id']] = page
+
+    # a page that fails is journalled, and its rects are missing from the articles
+    page_start = time.time()
+    try:
+      for rect_id, cropped in crop_page(issue_directory, page, rects):
+
+        # a view into a decoded page would keep the whole page in memory
+        # until the issue is done, so copy the crop out of it
+        if not isinstance(cropped, np.memmap):
+          cropped = np.array(cropped)
+        crops[rect_id] = cropped
+    except Exception as exc:
+      log_failure('failed_page', issue=issue_directory, page=page, exc=exc,
+        seconds=time.time() - page_start)
+
+  segmented_image_paths = {}
+  image_writer = get_image_writer()
+
+  for page, article_index, rect_ids in articles:
+    article_path = get_article_path(issue_directory, page, article_index)
+
+    if output_backend == 'files' and not os.path.exists(article_path):
+      os.makedirs(article_path)
+
+    vectors = []
+    for rect_id in rect_ids:
+      img_filename = str(rect_id) + '.png'
+
+      # handle the case of missing rects
+      if rect_id not in crops:
+        log_failure('missing_rect', 'missing_rects.txt',
+          'cropped_images' + issue_directory + '/' + img_filename,
+          issue=issue_directory, page=rect_pages.get(rect_id), rect_id=rect_id,
+          article_index=article_index)
+        continue
+
+      destination = get_output_destination(issue_directory,
+        article_path + img_filename, get_article_key(article_path) + img_filename)
+      with metrics.timer('write_wait_seconds'):
+        image_writer.submit(destination, crops[rect_id], (issue_directory, rect_pages[rect_id]))
+      vectors.append(crops[rect_id])
+      segmented_image_paths.setdefault(article_path, []).append(img_filename)
+
+    if not vectors:
+      continue
+
+    with metrics.timer('stack_seconds'):
+      composite_image = build_composite_image(vectors)
+
+    with metrics.timer('write_wait_seconds'):
+      write_composite_image(article_path, composite_ids[article_path],
+        composite_image, image_writer)
+
+  metrics.emit('segment_issue', issue=issue_directory, pages=len(pages),
+    articles=len(articles), seconds=round(time.time() - issue_start, 6),
+    **metrics.take_counters())
+  return segmented_image_paths
+
+
+#################
+# Image writers #
+#################
+
+# the pool of image writer threads for the current process
+image_writer = None
+
+def get_image_writer():
+  '''
+  Return the pool of threads that write images to disk for the current
+  process, starting the pool if needed. Threads don't survive a fork,
+  so each worker process starts its own pool, which writes its queued
+  images when the worker exits at the end of the stage
+  '''
+  global image_writer
+
+  if image_writer is None or image_writer.pid != os.getpid():
+    image_writer = ImageWriterPool(n_writer_threads, max_queued_writes,
+      save_output_image)
+    Finalize(None, close_image_writer, exitpriority=10)
+
+  return image_writer
+
+
+def close_image_writer():
+  '''
+  Write all of the current process's queued images and stop its
+  image writer threads
+  '''
+  global image_writer
+
+  if image_writer is not None and image_writer.pid == os.getpid():
+    flush_image_writer()
+    image_writer.close()
+
+  image_writer = None
+
+
+def get_shard_path(issue_directory):
+  '''
+  Read in the path to an issue directory and return the path (without
+  extension) of the shard that holds that issue's output images. Shards
+  are named after the issue directory and a hash of its full path, as
+  issues under different parent directories can share a name
+  '''
+  issue_directory = os.path.normpath(issue_directory)
+  path_hash = hashlib.md5(issue_directory.encode('utf-8')).hexdigest()[:8]
+  return os.path.join('shards', os.path.basename(issue_directory) + '-' + path_hash)
+
+
+def get_output_destination(issue_directory, path, key):
+  '''
+  Read in the path to an issue directory, and the file path and shard
+  key for an output image of that issue. Return the file path if
+  output_backend == 'files', or the issue's shard and the key if
+  output_backend == 'shards'
+  '''
+  if output_backend == 'shards':
+    return get_shard_path(issue_directory), key
+  return path
+
+
+def save_output_image(destination, image):
+  '''
+  Read in a destination from get_output_destination and an image
+  array, and write the image to that destination. This runs on the
+  image writer threads, so the writes are counted in the background
+  counters, which flush_image_writer emits
+  '''
+  metrics = get_metrics()
+
+  with metrics.timer('write_seconds', background=True):
+    if output_backend == 'shards':
+      shard_path, key = destination
+      n_bytes = append_to_shard(shard_path, key, image)
+    else:
+      io.imsave(destination, image)
+      n_bytes = os.path.getsize(destination)
+
+  metrics.count('images_written', background=True)
+  metrics.count('bytes_written', n_bytes, background=True)
+
+
+def flush_image_writer():
+  '''
+  Wait until the current process has written all of its queued images,
+  emit the time and bytes its writers spent on them since the last
+  flush as a write_images event, and log the images that could not be
+  written, along with the (issue_directory, page) they were queued with
+  '''
+  errors = get_image_writer().flush()
+
+  metrics = get_metrics()
+  write_counters = metrics.take_counters(background=True)
+  if write_counters:
+    metrics.emit('write_images', stage=current_stage, **write_counters)
+
+  for writer_name, path, exc, (issue_directory, page) in errors:
+    log_failure('unwritable_image', 'unwritable-images.txt',
+      ' '.join([current_process().name, writer_name, str(path), repr(exc)]),
+      issue=issue_directory, page=page, exc=exc, path=str(path))
+
+
+#################
+# Memory budget #
+#################
+
+def estimate_decode_memory(path_to_jp2_file):
+  '''
+  Read in the path to a jp2 image file and return the estimated peak
+  memory in bytes of decoding it: the size of the decoded page, from
+  the jp2 header, times decode_memory_factor. Return 0 for files whose
+  header can't be read (they fail as soon as they're decoded)
+  '''
+  try:
+    return get_decoded_bytes(read_image_size(path_to_jp2_file)) * decode_memory_factor
+  except Exception:
+    return 0
+
+
+def estimate_page_memory(path_to_jp2_file):
+  '''
+  Read in the path to a jp2 image file and return the estimated peak
+  memory in bytes of cropping it: the size of the page if it's read from
+  an up to date cached page, else the memory needed to decode it
+  '''
+  if decode_mode != 'region' and is_cached_array_current(path_to_jp2_file):
+    try:
+      return get_decoded_bytes(read_image_size(path_to_jp2_file))
+    except Exception:
+      return 0
+  return estimate_decode_memory(path_to_jp2_file)
+
+
+def imap_within_budget(pool, function, tasks, estimate_memory, memory_budget, max_running):
+  '''
+  Read in a process pool, a function, a list of tasks, a function that
+  estimates the peak memory in bytes of a task, the memory budget in
+  bytes and the most tasks to run at once, and yield function(task) for
+  each task as it finishes. If memory_budget is None, tasks run as
+  workers free up; else a task only starts while the estimated memory
+  of the running tasks plus its own fits in the budget. Tasks start in
+  order, except that while the first pending task doesn't fit, a later
+  task that fits may start ahead of it, at most max_running times in a
+  row; after that, the first task waits for room. A task larger than
+  the whole budget runs by itself. If a task raises an exception,
+  terminate the pool and raise it
+  '''
+  if memory_budget is None:
+    for result in pool.imap_unordered(function, tasks):
+      yield result
+    return
+
+  memories = [estimate_memory(task) for task in tasks]
+
+  # the indices of the pending tasks in order, and in buckets of tasks
+  # with the same bit length of their estimate, so a task that fits can
+  # be found without scanning every pending task. Started tasks are
+  # dropped from the fronts of these queues as they're reached
+  pending = deque(range(len(tasks)))
+  buckets = defaultdict(deque)
+  for index, memory in enumerate(memories):
+    buckets[int(memory).bit_length()].append(index)
+  started = [False] * len(tasks)
+
+  finished = Queue.Queue()
+  running_memory = 0
+  n_running = 0
+  n_started = 0
+
+  # the number of tasks started ahead of the first pending task
+  n_skipped = 0
+
+  while n_started < len(tasks) or n_running:
+
+    # start the first pending tasks that fit in the budget
+    while n_started < len(tasks) and n_running < max_running:
+      while started[pending[0]]:
+        pending.popleft()
+
+      index = pending[0]
+      if not n_running or running_memory + memories[index] <= memory_budget:
+        n_skipped = 0
+      elif n_skipped < max_running:
+        index = find_task_within(memory_budget - running_memory, buckets, memories, started)
+        if index is None:
+          break
+        n_skipped += 1
+      else:
+        break
+
+      started[index] = True
+      n_started += 1
+      running_memory += memories[index]
+      n_running += 1
+      pool.apply_async(call_task, ((function, tasks[index]),),
+        callback=lambda result, memory=memories[index]: finished.put((result, memory)))
+
+    (succeeded, result), memory = finished.get()
+    running_memory -= memory
+    n_running -= 1
+
+    # stop the tasks that are still running or queued
+    if not succeeded:
+      pool.terminate()
+      raise result
+    yield result
+
+
+def find_task_within(free_memory, buckets, memories, started):
+  '''
+  Read in the free memory in bytes, the buckets of pending task indices
+  by bit length of their estimate, the estimate of each task and whether
+  each task has started, and return the index of the earliest pending
+  task in the largest bucket whose first task fits in the free memory,
+  or None if no bucket's first task fits
+  '''
+  for bit_length in sorted(buckets, reverse=True):
+    bucket = buckets[bit_length]
+    while bucket and started[bucket[0]]:
+      bucket.popleft()
+    if bucket and memories[bucket[0]] <= free_memory:
+      return bucket[0]
+  return None
+
+
+def call_task(job):
+  '''
+  Read in a (function, task) tuple and return (True, function(task)), or
+  (False, exception) if the call raised an exception, so that
+  imap_within_budget hears about every task that finishes
+  '''
+  function, task = job
+  try:
+    return True, function(task)
+  except Exception as exc:
+    return False, exc
+
+
+def count_issue_rects(issue_directory):
+  '''
+  Read in the path to a single issue directory and return the number of
+  rects map_issue_rectangles finds in that issue, without logging the
+  missing pages and unparseable xml files it would log
+  '''
+  page_id_to_page_file = get_page_mappings(issue_directory)[0]
+  n_rects = 0
+
+  for xml_page in get_article_xml_files(issue_directory):
+    try:
+      for clip_coord in iter_clip_coords(xml_page):
+        if clip_coord.inpage in page_id_to_page_file:
+          n_rects += 1
+
+    # rects parsed before the error are counted
+    except (ValueError, SyntaxError):
+      pass
+
+  return n_rects
+
+
+def estimate_issue_costs(root_data_directory, out_path='issue_costs.json'):
+  '''
+  Read in the path to a directory with issue subdirectories and, without
+  decoding any pages, estimate the cost of each issue from its jp2
+  headers and xml files: the number of pages, pixels and rects, the bytes
+  of the decoded pages, and the peak memory of decoding its largest page.
+  Write the estimates to out_path and return them, along with the
+  estimated peak memory of the convert stage
+  '''
+  issues = []
+
+  for issue_directory in get_issue_directories(root_data_directory):
+    pixels = 0
+    decoded_bytes = 0
+    peak_memory = 0
+    unreadable_pages = 0
+
+    for jp2_path in get_images_in_directory(issue_directory):
+      try:
+        image_size = read_image_size(jp2_path)
+      except Exception:
+        unreadable_pages += 1
+        continue
+
+      pixels += image_size.height * image_size.width
+      decoded_bytes += get_decoded_bytes(image_size)
+      peak_memory = max(peak_memory, estimate_decode_memory(jp2_path))
+
+    n_rects = count_issue_rects(issue_directory)
+
+    issues.append({
+      'issue': issue_directory,
+      'pages': len(get_images_in_directory(issue_directory)),
+      'unreadable_pages': unreadable_pages,
+      'pixels': pixels,
+      'decoded_bytes': decoded_bytes,
+      'peak_decode_bytes': peak_memory,
+      'rects': n_rects
+    })
+
+  # the convert stage decodes n_processes pages at once, largest first
+  largest_decodes = sorted([estimate_decode_memory(jp2_path)
+    for i in issues for jp2_path in get_images_in_directory(i['issue'])], reverse=True)
+  convert_memory = sum(largest_decodes[:n_processes])
+  if memory_budget is not None and largest_decodes:
+    convert_memory = min(convert_memory, max(memory_budget, largest_decodes[0]))
+
+  costs = {
+    'issues': issues,
+    'pages': sum(i['pages'] for i in issues),
+    'pixels': sum(i['pixels'] for i in issues),
+    'rects': sum(i['rects'] for i in issues),
+    'decoded_bytes': sum(i['decoded_bytes'] for i in issues),
+    'peak_convert_bytes': convert_memory
+  }
+
+  with open(out_path, 'w') as out:
+    json.dump(costs, out, indent=2)
+
+  if verbosity_level > 0:
+    for i in issues:
+      print i['issue'], i['pages'], 'pages', i['pixels'], 'pixels', i['rects'], 'rects',
+      print round(i['peak_decode_bytes'] / 2 ** 20, 1), 'MB peak decode'
+    print costs['pages'], 'pages', costs['pixels'], 'pixels', costs['rects'], 'rects,',
+    print round(convert_memory / 2 ** 20, 1), 'MB estimated peak memory to convert'
+
+  return costs
+
+###########
+# Metrics #
+###########
+
+# the metrics log for the current process
+metrics_log = None
+
+def get_metrics():
+  '''
+  Return the metrics log for the current process, starting the log if
+  needed. Each worker process keeps its own counters and log file handle
+  '''
+  global metrics_log
+
+  if metrics_log is None or metrics_log.pid != os.getpid():
+    metrics_log = MetricsLog(metrics_path)
+
+  return metrics_log
+
+
+def run_stage(stage_name, stage, *args):
+  '''
+  Read in the name of a pipeline stage, the function that runs the
+  stage and its arguments, run the stage, and log its wall time along
+  with the peak memory of this process and its finished children (in kB)
+  '''
+  global current_stage
+  current_stage = stage_name
+
+  start = time.time()
+  result = stage(*args)
+
+  get_metrics().emit('stage', stage=stage_name,
+    seconds=round(time.time() - start, 6),
+    max_rss_kb=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    max_child_rss_kb=resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+  return result
+
+
+###################
+# Failure journal #
+###################
+
+# the failure journal for the current process, and the stage being run
+# (worker processes inherit the stage from the process that forked them)
+failure_journal = None
+current_stage = None
+
+def get_journal():
+  '''
+  Return the failure journal, starting it if needed
+  '''
+  global failure_journal
+
+  if failure_journal is None or failure_journal.path != journal_path:
+    failure_journal = FailureJournal(journal_path)
+
+  return failure_journal
+
+
+def log_failure(kind, text_path=None, text=None, **fields):
+  '''
+  Read in the kind of a failure, the plain text error file (if any) and
+  the line in it that describe the failure, and the issue, page, rect_id,
+  exc and seconds of the failure, and record the failure in the failure
+  journal under the stage being run
+  '''
+  get_journal().record(current_stage, kind, text_path=text_path, text=text, **fields)
+
+
+def log_unprocessable_image(path_to_jp2_file, exc, start):
+  '''
+  Read in the path to a jp2 image file that couldn't be decoded, the
+  exception raised and the time at which decoding started, and record
+  the failure
+  '''
+  log_failure('unprocessable_image', 'unprocessable-images.txt', path_to_jp2_file,
+    issue=os.path.dirname(path_to_jp2_file), page=os.path.basename(path_to_jp2_file),
+    exc=exc, seconds=time.time() - start)
+
+
+def get_replay_units(failures):
+  '''
+  Read in a list of failure records and return the jp2 files to decode
+  again, the issues to crop again, and the failures that can't be
+  replayed. Failures in the mapping stage come from an issue's xml
+  files, which have to be fixed first, and they need a new mapping, so
+  they need a new run (with incremental = True, only the issues whose
+  mapping changed are cropped again)
+  '''
+  jp2_paths = set()
+  issues = set()
+  unreplayable = []
+
+  for failure in failures:
+    if failure['stage'] == 'mapping' or not failure.get('issue'):
+      unreplayable.append(failure)
+    elif failure['stage'] == 'convert':
+      jp2_paths.add(failure['issue'] + '/' + failure['page'])
+    else:
+      issues.add(failure['issue'])
+
+  return sorted(jp2_paths), sorted(issues), unreplayable
+
+
+def replay_failures():
+  '''
+  Read in the failure journal, decode the jp2 files that failed to
+  convert again, clear the outputs of the issues that had failures in
+  the crop, sort or stack stages, and return those issues so that only
+  they are cropped again. The journal is kept as journal_path + '.replayed',
+  and the journal is started afresh (with the failures that can't be
+  replayed) to record the failures of the replay
+  '''
+  jp2_paths, issues, unreplayable = get_replay_units(read_failures(journal_path))
+
+  if os.path.exists(journal_path):
+    os.rename(journal_path, journal_path + '.replayed')
+  for failure in unreplayable:
+    append_locked(journal_path, json.dumps(failure, sort_keys=True) + '\n')
+
+  if verbosity_level > 0:
+    print 'replaying', len(jp2_paths), 'pages and', len(issues), 'issues,',
+    print len(unreplayable), 'failures need a new mapping'
+
+  if decode_mode != 'region':
+    run_stage('convert', convert_pages, jp2_paths)
+
+  for issue_directory in issues:
+    remove_issue_outputs(issue_directory)
+
+  return issues
+
+
+def convert_pages(jp2_paths):
+  '''
+  Read in a list of paths to jp2 image files, and decode each image and
+  cache it as a npy file
+  '''
+  for jp2_path in jp2_paths:
+    image_path_to_npy(jp2_path)
+
+##########################
+# Incremental processing #
+##########################
+
+def get_issue_output_directories(issue_directory):
+  '''
+  Read in the path to an issue directory and return the cropped,
+  segmented and composite output directories for that issue
+  '''
+  segmented_directory = 'segmented_images' + issue_directory
+  return [
+    'cropped_images/' + issue_directory,
+    segmented_directory,
+    os.path.join('composite_images', segmented_directory)
+  ]
+
+
+def issue_owns_path(issue_directory, article_path):
+  '''
+  Read in the path to an issue directory and the path to an article in
+  segmented_images and return a boolean indicating whether that article
+  belongs to the issue
+  '''
+  return article_path.startswith('segmented_images' + issue_directory + '/')
+
+
+def load_manifest(manifest_path='manifest.json'):
+  '''
+  Read the manifest of processed issues from disk. The manifest maps
+  each issue directory to the size, mtime and sha1 of each of its input
+  files, a digest of its rect mappings, and the stages that are done
+  '''
+  if not os.path.exists(manifest_path):
+    return {}
+
+  with open(manifest_path) as f:
+    return json.load(f)
+
+
+def save_manifest(manifest, manifest_path='manifest.json'):
+  '''
+  Write the manifest of processed issues to disk
+  '''
+  tmp_path = manifest_path + '.tmp'
+  with open(tmp_path, 'w') as out:
+    json.dump(manifest, out)
+  os.rename(tmp_path, manifest_path)
+
+
+def get_file_fingerprint(path, previous_fingerprint=None):
+  '''
+  Read in the path to a file and return a dictionary with the file's
+  size, mtime and sha1 digest. If the file's size and mtime match the
+  previous fingerprint, reuse its digest instead of hashing the file again
+  '''
+  stat = os.stat(path)
+  fingerprint = {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+  if previous_fingerprint and \
+      previous_fingerprint['size'] == stat.st_size and \
+      previous_fingerprint['mtime'] == stat.st_mtime:
+    fingerprint['sha1'] = previous_fingerprint['sha1']
+    return fingerprint
+
+  sha1 = hashlib.sha1()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(2 ** 20), b''):
+      sha1.update(chunk)
+  fingerprint['sha1'] = sha1.hexdigest()
+  return fingerprint
+
+
+def get_issue_inputs(issue_directory, previous_inputs=None):
+  '''
+  Read in the path to an issue directory and return a mapping from
+  the filename of each input file in that issue to its fingerprint
+  '''
+  previous_inputs = previous_inputs or {}
+  paths = get_images_in_directory(issue_directory)
+  paths += get_article_xml_files(issue_directory)
+
+  if 'index.cpd' in get_catalog_issue(issue_directory)['files']:
+    paths.append(os.path.join(issue_directory, 'index.cpd'))
+
+  inputs = {}
+  for path in paths:
+    filename = os.path.basename(path)
+    inputs[filename] = get_file_fingerprint(path, previous_inputs.get(filename))
+  return inputs
+
+
+def get_issue_rect_offset(issue_imgs_to_crop):
+  '''
+  Read in the imgs_to_crop mapping for a single issue and return the
+  id of the issue's first rect (0 for issues without rects)
+  '''
+  rect_ids = [rect['rect_id'] for rects in issue_imgs_to_crop.itervalues() for rect in rects]
+  return min(rect_ids) if rect_ids else 0
+
+
+def get_mapping_digest(issue_directory, imgs_to_crop, rects_to_articles):
+  '''
+  Read in the path to an issue directory and the rect mappings, and
+  return a digest of the rects for that issue. Rect ids are counted from
+  the issue's first rect, so the digest doesn't change when rects are
+  added to or removed from other issues
+  '''
+  issue_imgs_to_crop = imgs_to_crop.get(issue_directory, {})
+
+  # copy the issue's mappings before renumbering their rects
+  issue_mappings = json.loads(json.dumps([
+    issue_imgs_to_crop,
+    rects_to_articles.get(issue_directory, {})
+  ]))
+  offset_rect_ids(issue_mappings[0], issue_mappings[1],
+    -get_issue_rect_offset(issue_imgs_to_crop))
+
+  return hashlib.sha1(json.dumps(issue_mappings, sort_keys=True)).hexdigest()
+
+
+def get_issue_offsets(issue_directories, imgs_to_crop, composite_ids):
+  '''
+  Read in the issue directories to process, the imgs_to_crop mapping and
+  the composite id of each article path, and return a dict that maps each
+  issue to the id of its first rect and of its first composite. An issue's
+  composites have consecutive ids, as its article paths share a prefix
+  '''
+  composite_offsets = {}
+  for article_path, composite_id in composite_ids.iteritems():
+    issue_directory = split_article_path(article_path)[0]
+    composite_offsets[issue_directory] = min(composite_id,
+      composite_offsets.get(issue_directory, composite_id))
+
+  return {issue_directory: {
+    'rect': get_issue_rect_offset(imgs_to_crop.get(issue_directory, {})),
+    'composite': composite_offsets.get(issue_directory)
+  } for issue_directory in issue_directories}
+
+
+def get_stale_issues(manifest, issue_directories, imgs_to_crop, rects_to_articles, offsets):
+  '''
+  Read in the manifest, the issue directories to process, the rect
+  mappings and the offsets of each issue's rect and composite ids, and
+  return the issues that need to be processed again: those with new or
+  changed input files or rects, those with unfinished stages, and those
+  whose outputs are missing. Update the manifest with the current inputs
+  and offsets of each stale issue and reset its stages
+  '''
+  stale_issues = []
+
+  # forget issues that are no longer part of the corpus
+  for issue_directory in list(manifest.keys()):
+    if issue_directory not in issue_directories:
+      del manifest[issue_directory]
+
+  for issue_directory in issue_directories:
+    previous = manifest.get(issue_directory, {})
+    inputs = get_issue_inputs(issue_directory, previous.get('inputs'))
+    mapping_digest = get_mapping_digest(issue_directory, imgs_to_crop, rects_to_articles)
+
+    is_stale = inputs != previous.get('inputs') or \
+      mapping_digest != previous.get('mapping') or \
+      'offsets' not in previous or \
+      set(previous.get('stages', [])) != set(['crop', 'sort', 'stack'])
+
+    # issues with articles must have segmented and composite images
+    if not is_stale and rects_to_articles.get(issue_directory):
+      if output_backend == 'shards':
+        output_paths = [get_shard_path(issue_directory) + '.idx']
+      else:
+        output_paths = get_issue_output_directories(issue_directory)[1:]
+
+      for output_path in output_paths:
+        if not os.path.exists(output_path):
+          is_stale = True
+
+    if is_stale:
+      stale_issues.append(issue_directory)
+      manifest[issue_directory] = {
+        'inputs': inputs,
+        'mapping': mapping_digest,
+        'offsets': offsets[issue_directory],
+        'stages': []
+      }
+
+  return stale_issues
+
+
+def renumber_shifted_issues(manifest, issue_directories, offsets, composite_ids):
+  '''
+  Read in the manifest, the issue directories that don't need to be
+  processed again, the current offsets of each issue's rect and composite
+  ids and the composite id of each article path. Rects added to or
+  removed from earlier issues shift the ids of an unchanged issue's rects
+  and composites, so rename the images of each such issue to the ids a
+  clean run would give them, instead of cropping the issue again. Update
+  images_per_article.json and the manifest, and return the renamed issues
+  '''
+  shifted_issues = [i for i in issue_directories
+    if manifest[i].get('offsets') != offsets[i]]
+
+  if not shifted_issues:
+    return shifted_issues
+
+  if os.path.exists('images_per_article.json'):
+    with open('images_per_article.json') as f:
+      images_per_article = json.load(f)
+  else:
+    images_per_article = {}
+
+  for issue_directory in shifted_issues:
+    rect_id_shift = offsets[issue_directory]['rect'] - manifest[issue_directory]['offsets']['rect']
+    renumber_issue_outputs(issue_directory, rect_id_shift, composite_ids)
+
+    for article_path, images in images_per_article.iteritems():
+      if issue_owns_path(issue_directory, article_path):
+        images_per_article[article_path] = [shift_image_name(i, rect_id_shift) for i in images]
+
+    manifest[issue_directory]['offsets'] = offsets[issue_directory]
+
+  with open('images_per_article.json', 'w') as out:
+    json.dump(images_per_article, out)
+
+  return shifted_issues
+
+
+def renumber_issue_outputs(issue_directory, rect_id_shift, composite_ids):
+  '''
+  Read in the path to an issue directory, the number to add to the id of
+  each of its rects and the composite id of each article path, and rename
+  the issue's cropped, segmented and composite images to their new ids
+  '''
+  if output_backend == 'shards':
+    def rename_key(key):
+      parts = key.split('/')
+      if parts[0] == 'composite':
+        article_path = 'segmented_images' + issue_directory + '/' + '/'.join(parts[1:3]) + '/'
+        parts[-1] = str(composite_ids[article_path]) + '.png'
+      else:
+        parts[-1] = shift_image_name(parts[-1], rect_id_shift)
+      return '/'.join(parts)
+
+    rename_shard_keys(get_shard_path(issue_directory), rename_key)
+    return
+
+  cropped_directory, segmented_directory, composite_directory = \
+    get_issue_output_directories(issue_directory)
+
+  # the sort stage leaves the crops of rects that belong to no article
+  # (those of articles stored on another page) here
+  if os.path.isdir(cropped_directory):
+    rename_images(cropped_directory, {i: shift_image_name(i, rect_id_shift)
+      for i in os.listdir(cropped_directory)})
+
+  for directory, subdirectories, files in os.walk(segmented_directory):
+    article_path = directory.rstrip('/') + '/'
+    rename_images(directory, {i: shift_image_name(i, rect_id_shift) for i in files})
+
+    # each article has one composite image
+    composite_path = os.path.join('composite_images', article_path)
+    if article_path in composite_ids and os.path.isdir(composite_path):
+      rename_images(composite_path, {i: str(composite_ids[article_path]) + '.png'
+        for i in os.listdir(composite_path)})
+
+
+def shift_image_name(image_name, rect_id_shift):
+  '''
+  Read in the filename of a segmented image (its rect id with a .png
+  extension) and the number to add to its rect id, and return its new name
+  '''
+  return str(int(image_name.split('.')[0]) + rect_id_shift) + '.png'
+
+
+def rename_images(directory, new_names):
+  '''
+  Read in a directory and a mapping from the names of images in that
+  directory to their new names, and rename the images. Images are moved
+  aside first, so a new name can be the old name of another image
+  '''
+  for name in new_names:
+    os.rename(os.path.join(directory, name), os.path.join(directory, name + '.renumber'))
+
+  for name, new_name in new_names.iteritems():
+    os.rename(os.path.join(directory, name + '.renumber'), os.path.join(directory, new_name))
+
+
+def remove_issue_outputs(issue_directory):
+  '''
+  Read in the path to an issue directory and remove all of the
+  cropped, segmented and composite images for that issue
+  '''
+  for output_directory in get_issue_output_directories(issue_directory):
+    try:
+      rmtree(output_directory)
+    except OSError:
+      pass
+
+  for extension in ['.bin', '.idx']:
+    try:
+      os.remove(get_shard_path(issue_directory) + extension)
+    except OSError:
+      pass
+
+
+def mark_stage_done(manifest, issue_directories, stage):
+  '''
+  Record in the manifest that the given stage is done for each of the
+  given issues, and write the manifest to disk
+  '''
+  for issue_directory in issue_directories:
+    manifest[issue_directory]['stages'].append(stage)
+  save_manifest(manifest)
+
+
+############
+# Sharding #
+############
+
+def get_issue_shard(issue_directory, n_shards):
+  '''
+  Read in the path to an issue directory and the number of shards, and
+  return the shard the issue belongs to. Shards are assigned from a hash
+  of the issue directory's name, so every node assigns each issue to the
+  same shard, wherever the data is mounted
+  '''
+  name = os.path.basename(os.path.normpath(issue_directory))
+  return int(hashlib.md5(name.encode('utf-8')).hexdigest(), 16) % n_shards
+
+
+def get_shard_issues(issue_directories):
+  '''
+  Read in a list of issue directories and return those that belong to
+  this shard (all of them if shard is None)
+  '''
+  if shard is None:
+    return issue_directories
+
+  shard_index, n_shards = shard
+  return [i for i in issue_directories if get_issue_shard(i, n_shards) == shard_index]
+
+
+def get_shard_directory(shard_index, n_shards):
+  '''
+  Read in the index of a shard and the number of shards, and return the
+  directory in which that shard's mappings are kept
+  '''
+  return os.path.join(shard_directory, 'shard-%d-of-%d' % (shard_index, n_shards))
+
+
+def get_images_per_article_path():
+  '''
+  Return the path to the mapping from article path to segmented images:
+  images_per_article.json, or the copy in this shard's directory if
+  shard is set, so shards that share a working directory don't overwrite
+  each other's mappings
+  '''
+  if shard is None:
+    return 'images_per_article.json'
+  return os.path.join(get_shard_directory(*shard), 'images_per_article.json')
+
+
+def write_shard_mapping(imgs_to_crop, rects_to_articles, issue_rect_ids):
+  '''
+  Read in the imgs_to_crop and rects_to_articles mappings of this shard's
+  issues, with rect ids counted within the shard, and the [rect id offset,
+  number of rects] of each issue, and write them to the shard's directory
+  along with a manifest of the shard's issues. Remove the
+  images_per_article.json of the shard's previous crop, which no longer
+  matches the new mapping
+  '''
+  shard_index, n_shards = shard
+  out_directory = get_shard_directory(shard_index, n_shards)
+  if not os.path.exists(out_directory):
+    os.makedirs(out_directory)
+
+  # merge treats a shard with this file as cropped
+  try:
+    os.remove(get_images_per_article_path())
+  except OSError:
+    pass
+
+  with open(os.path.join(out_directory, 'rects_to_articles.json'), 'w') as out:
+    json.dump(rects_to_articles, out)
+
+  with open(os.path.join(out_directory, 'imgs_to_crop.json'), 'w') as out:
+    json.dump(imgs_to_crop, out)
+
+  # write the manifest last, as it marks the shard's mapping as complete
+  manifest_path = os.path.join(out_directory, 'shard_manifest.json')
+  with open(manifest_path + '.tmp', 'w') as out:
+    json.dump({
+      'shard': shard_index,
+      'n_shards': n_shards,
+      'issues': issue_rect_ids
+    }, out)
+  os.rename(manifest_path + '.tmp', manifest_path)
+
+
+def load_shard_mapping(shard_index, n_shards):
+  '''
+  Read in the index of a shard and the number of shards, and return
+  that shard's manifest, imgs_to_crop and rects_to_articles mappings.
+  Raise a ValueError if the shard hasn't finished mapping its issues
+  '''
+  shard_path = get_shard_directory(shard_index, n_shards)
+
+  try:
+    with open(os.path.join(shard_path, 'shard_manifest.json')) as f:
+      manifest = json.load(f)
+  except IOError:
+    raise ValueError('shard %d of %d has no manifest in %s' % (shard_index, n_shards, shard_path))
+
+  with open(os.path.join(shard_path, 'imgs_to_crop.json')) as f:
+    imgs_to_crop = json.load(f)
+
+  with open(os.path.join(shard_path, 'rects_to_articles.json')) as f:
+    rects_to_articles = json.load(f)
+
+  return manifest, imgs_to_crop, rects_to_articles
+
+
+def merge_shard_mappings(n_shards):
+  '''
+  Read in the number of shards and combine the mappings of all of the
+  shards into the imgs_to_crop.json, rects_to_articles.json, rect index
+  and articles_to_titles.json that a single run would write. Rect ids
+  are renumbered in sorted issue order, just as
+  generate_issue_page_rectangle_mapping numbers them, so the merged
+  mappings are the same as those of a single run. If every shard has
+  cropped its issues, their images_per_article.json files are combined too
+  '''
+  imgs_to_crop = {}
+  rects_to_articles = {}
+
+  # d[issue_directory] = (shard_index, shard rect id offset, n_rects)
+  issue_rect_ids = {}
+  shard_mappings = []
+
+  for shard_index in range(n_shards):
+    manifest, shard_imgs_to_crop, shard_rects_to_articles = load_shard_mapping(shard_index, n_shards)
+    shard_mappings.append((shard_imgs_to_crop, shard_rects_to_articles))
+
+    for issue_directory, (rect_id_offset, n_rects) in manifest['issues'].iteritems():
+      if issue_directory in issue_rect_ids:
+        raise ValueError('issue %s was mapped by shards %d and %d' %
+          (issue_directory, issue_rect_ids[issue_directory][0], shard_index))
+      issue_rect_ids[issue_directory] = (shard_index, rect_id_offset, n_rects)
+
+  rect_id_offset = 0
+
+  for issue_directory in sorted(issue_rect_ids):
+    shard_index, shard_rect_id_offset, n_rects = issue_rect_ids[issue_directory]
+    shard_imgs_to_crop, shard_rects_to_articles = shard_mappings[shard_index]
+
+    issue_imgs_to_crop = shard_imgs_to_crop.get(issue_directory, {})
+    issue_rects_to_articles = shard_rects_to_articles.get(issue_directory, {})
+    offset_rect_ids(issue_imgs_to_crop, issue_rects_to_articles,
+      rect_id_offset - shard_rect_id_offset)
+    rect_id_offset += n_rects
+
+    if issue_imgs_to_crop:
+      imgs_to_crop[issue_directory] = issue_imgs_to_crop
+
+    if issue_rects_to_articles:
+      rects_to_articles[issue_directory] = issue_rects_to_articles
+
+  with open('rects_to_articles.json', 'w') as out:
+    json.dump(rects_to_articles, out)
+
+  with open('imgs_to_crop.json', 'w') as out:
+    json.dump(imgs_to_crop, out)
+
+  write_rect_index(imgs_to_crop, rects_to_articles)
+  store_article_titles()
+
+  # combine the shards' images_per_article.json files once all have been cropped
+  images_per_article = {}
+  uncropped_shards = []
+  for shard_index in range(n_shards):
+    shard_path = os.path.join(get_shard_directory(shard_index, n_shards), 'images_per_article.json')
+    if not os.path.exists(shard_path):
+      uncropped_shards.append('%d/%d' % (shard_index, n_shards))
+      continue
+    with open(shard_path) as f:
+      images_per_article.update(json.load(f))
+
+  if uncropped_shards:
+    print 'not merging images_per_article.json, as shards', ', '.join(uncropped_shards),
+    print 'have not cropped their issues yet'
+  else:
+    with open('images_per_article.json', 'w') as out:
+      json.dump(images_per_article, out)
+
+  if verbosity_level > 0:
+    print 'merged', len(issue_rect_ids), 'issues and', rect_id_offset, 'rects from', n_shards, 'shards'
+
+
+def parse_shard(value):
+  '''
+  Read in a shard given on the command line as i/N and return the
+  tuple (i, N)
+  '''
+  try:
+    shard_index, n_shards = [int(i) for i in value.split('/')]
+  except ValueError:
+    raise argparse.ArgumentTypeError('shards are given as i/N, e.g. 0/4')
+
+  if not 0 <= shard_index < n_shards:
+    raise argparse.ArgumentTypeError('shard index must be between 0 and N - 1')
+
+  return shard_index, n_shards
+
+
+def parse_args(argv=None):
+  '''
+  Parse the command line arguments. With no command, the whole pipeline
+  runs on all issues. To spread a run over several nodes (or processes
+  on one node), each node runs map with its --shard, one node runs merge
+  once all shards are mapped, then each node runs crop with its --shard,
+  and a last merge combines the shards' images_per_article.json files
+  '''
+  parser = argparse.ArgumentParser(description='Segment YDN pages into article images')
+  parser.add_argument('command', nargs='?', default='all',
+    choices=['all', 'map', 'merge', 'crop', 'replay'],
+    help='all: run every stage; map: convert and map one shard of the issues; '
+      'merge: combine the shard mappings; crop: crop, sort and stack one shard; '
+      'replay: run the units of work in the failure journal again')
+  parser.add_argument('--shard', type=parse_shard, help='the shard to process, as i/N')
+  parser.add_argument('--shards', type=int, help='merge: the number of shards')
+  args = parser.parse_args(argv)
+
+  if args.command in ('map', 'crop') and args.shard is None:
+    parser.error(args.command + ' needs --shard i/N')
+  if args.command == 'merge' and not args.shards:
+    parser.error('merge needs --shards N')
+  if args.command in ('all', 'replay') and args.shard is not None:
+    parser.error('--shard is only used with map and crop')
+
+  return args
 
 ##############
 # Main Block #
@@ -664,32 +2961,15 @@ def stack_segmented_images():
 
 if __name__ == '__main__':
 
+  args = parse_args()
+
+  # the (index, number of shards) of the shard to process, or None for all issues
+  shard = args.shard
+
   ###
   # Global params 
   ###
 
-  # clear all extant error files
-  for i in [
-    'missing_rects.txt',
-    'missing_page_articles.txt',
-    'unprocessable-images.txt'
-  ]:
-    try:
-      os.remove(i)
-    except:
-      pass
-
-  # clean all output dirs
-  for i in [
-    './cropped_images',
-    './segmented_images',
-    './composite_images'
-  ]:
-    try:
-      rmtree(i)
-    except:
-      pass
-
   # Define the directory that contains subdirectories for each paper issue
   root_data_directory = '/Users/doug/Desktop/ydn-sample/'
 
@@ -705,35 +2985,234 @@ if __name__ == '__main__':
   # allow users to toggle multiprocessing on/off
   multiprocess = False
 
+  # hand out the most expensive pages (pixels x rects) to workers first
+  order_by_cost = True
+
+  # specify how many threads per process write images to disk, and how
+  # many images may wait to be written before cropping pauses
+  n_writer_threads = 4
+  max_queued_writes = 64
+
   # specify how much padding to add to cropped images
   padding = 5
 
-  # Convert jp2 images into numpy arrays (must only be run once)
-  convert_jp2_images_to_numpy_arrays(root_data_directory)
+  # specify the maximum number of bytes of npy files to keep in numpy_arrays/
+  # (least recently used arrays are evicted first; None disables eviction)
+  npy_cache_budget = None
+
+  # specify how to cache decoded pages: 'npy' writes each page to
+  # numpy_arrays/ as a raw npy file, 'tiles' writes each page to page_tiles/
+  # as zlib compressed tiles of tile_size x tile_size pixels, which take
+  # less disk space, and crops only decompress the tiles they overlap
+  page_store = 'npy'
+  tile_size = 512
+
+  # specify how to decode pages for cropping: 'full' crops from full pages
+  # cached in numpy_arrays/, 'region' decodes only the part of each jp2
+  # that contains rects (requires glymur)
+  decode_mode = 'full'
+
+  # specify the resolution at which to write crops; each level halves
+  # the width and height of the crops (0 writes full resolution crops)
+  resolution_level = 0
+
+  # allow users to only process issues that changed since the last run
+  # (as recorded in manifest.json) instead of reprocessing all issues
+  incremental = False
+
+  # restrict cropping to these issue directories (None crops all issues)
+  selected_issues = None
+
+  # crop straight into segmented_images/ and build composites in memory,
+  # instead of writing, moving and reading back each crop
+  fused = False
+
+  # specify how to store output images: 'files' writes one PNG file per
+  # image, 'shards' packs the images of each issue into shards/<issue>-<hash>.bin
+  # with an index of each image's offset in shards/<issue>.idx
+  output_backend = 'files'
+
+  # specify the file in which to keep the catalog of issue directories
+  # between runs, so only changed issue directories are listed again
+  # (None lists every issue directory on each run)
+  catalog_path = 'issue_catalog.json'
+
+  # specify the file to which timings, bytes read and written, cache hits
+  # and worker ids are appended as JSON lines (None disables the log)
+  metrics_path = 'metrics.jsonl'
+
+  # specify the most memory in bytes that the pages being decoded or
+  # cropped at once may use, as estimated from their jp2 headers. Tasks
+  # wait for memory to free up before they start, so n_processes can be
+  # set for the typical page rather than the largest (None starts a task
+  # on every idle process)
+  memory_budget = None
+
+  # decoding a jp2 takes about this many times the bytes of the decoded page
+  decode_memory_factor = 6
+
+  # only estimate the pages, pixels, rects and peak memory of each issue
+  # from the jp2 headers and xml files, write them to issue_costs.json,
+  # and stop before anything is decoded or cleaned
+  dry_run = False
+
+  # specify the directory in which each shard keeps its mappings
+  shard_directory = 'shard_outputs'
+
+  # specify the file to which each failed decode, missing page or rect,
+  # unparseable xml file and unreadable or unwritable image is appended
+  # as a JSON line with its stage, issue, page, rect_id and exception
+  # (None only writes the plain text error files). `replay` runs the
+  # journalled units again
+  journal_path = 'failures.jsonl'
+
+  # only track finished stages in manifest.json for whole runs
+  track_stages = incremental and args.command == 'all'
+
+  if dry_run:
+    estimate_issue_costs(root_data_directory)
+    get_metrics().close()
+    sys.exit()
+
+  # clear all extant error files (shards may share a working directory,
+  # so they only append to the files that a whole run starts afresh)
+  if args.command == 'all':
+    for i in [
+      'missing_rects.txt',
+      'missing_page_articles.txt',
+      'unprocessable-images.txt',
+      'unparseable-xml.txt',
+      'unwritable-images.txt',
+      'unreadable-images.txt',
+      journal_path,
+      metrics_path
+    ]:
+      if i is None:
+        continue
+
+      try:
+        os.remove(i)
+      except:
+        pass
+
+  # Combine the mappings of all shards into the global mappings
+  if args.command == 'merge':
+    run_stage('merge', merge_shard_mappings, args.shards)
+    get_metrics().close()
+    sys.exit()
 
-  # Generate master XML mapping
-  generate_issue_page_rectangle_mapping(root_data_directory)
+  # Run only the units of work in the failure journal again
+  if args.command == 'replay':
+    selected_issues = run_stage('replay', replay_failures)
+
+  # clean all output dirs (shards and replays only clean the outputs of their issues)
+  if not incremental and args.command == 'all':
+    for i in [
+      './cropped_images',
+      './segmented_images',
+      './composite_images',
+      './shards',
+      'manifest.json'
+    ]:
+      try:
+        if os.path.isdir(i):
+          rmtree(i)
+        else:
+          os.remove(i)
+      except:
+        pass
+
+  if output_backend == 'shards' and not os.path.exists('shards'):
+    os.makedirs('shards')
+
+  if args.command in ('all', 'map'):
+
+    # Convert jp2 images into numpy arrays (must only be run once)
+    if decode_mode != 'region':
+      run_stage('convert', convert_jp2_images_to_numpy_arrays, root_data_directory)
+
+    # Generate master XML mapping
+    run_stage('mapping', generate_issue_page_rectangle_mapping, root_data_directory)
+
+  # Shards stop once they're mapped, until the mappings are merged
+  if args.command == 'map':
+    get_metrics().close()
+    sys.exit()
 
-  # Generate array of process ids
-  process_ids = list(xrange(n_processes))
+  # Crop only this shard's issues, from the merged mappings
+  if args.command == 'crop':
+    selected_issues = get_shard_issues(load_rect_index()['issues'])
+    for issue_directory in selected_issues:
+      remove_issue_outputs(issue_directory)
 
-  # Generate a pool to manage processes for image segmentation
-  pool_two = Pool(n_processes)
+  # Find the issues that changed since the last run and clear their outputs
+  if track_stages:
+    with open('imgs_to_crop.json') as f:
+      imgs_to_crop = json.load(f)
 
-  # Segment the images
-  if multiprocess:
-    for result in pool_two.imap(segment_images, process_ids):
-      pass
+    with open('rects_to_articles.json') as f:
+      rects_to_articles = json.load(f)
+
+    manifest = load_manifest()
+    issue_directories = get_issue_directories(root_data_directory)
+    composite_ids = get_composite_ids(load_rect_index())
+    offsets = get_issue_offsets(issue_directories, imgs_to_crop, composite_ids)
+    selected_issues = get_stale_issues(manifest, issue_directories,
+      imgs_to_crop, rects_to_articles, offsets)
+
+    for issue_directory in selected_issues:
+      remove_issue_outputs(issue_directory)
+
+    # rename the outputs of unchanged issues whose ids were shifted
+    stale_issues = set(selected_issues)
+    shifted_issues = renumber_shifted_issues(manifest,
+      [i for i in issue_directories if i not in stale_issues], offsets, composite_ids)
+
+    save_manifest(manifest)
+
+    if verbosity_level > 0:
+      print 'processing', len(selected_issues), 'new or changed issues,',
+      print 'renumbering', len(shifted_issues), 'unchanged issues'
+
+  if fused:
+
+    # Crop the images into /issue/page/article subdirs and stack them
+    run_stage('fused', segment_articles)
+
+    if track_stages:
+      for stage in ['crop', 'sort', 'stack']:
+        mark_stage_done(manifest, selected_issues, stage)
+
+    # Store a mapping from each article to that article's title
+    # (merge stores the titles of a sharded run)
+    if shard is None:
+      run_stage('titles', store_article_titles)
 
   else:
-    for i in process_ids:
-      segment_images(i)
 
-  # Rearrange the segmented files into /issue/page/article subdirs
-  sort_segmented_images()
+    # Segment the images
+    run_stage('segment', segment_images)
 
-  # Store a mapping from each article to that article's title
-  store_article_titles()
+    if track_stages:
+      mark_stage_done(manifest, selected_issues, 'crop')
+
+    # Rearrange the segmented files into /issue/page/article subdirs
+    run_stage('sort', sort_segmented_images, selected_issues)
+
+    if track_stages:
+      mark_stage_done(manifest, selected_issues, 'sort')
+
+    # Store a mapping from each article to that article's title
+    # (merge stores the titles of a sharded run)
+    if shard is None:
+      run_stage('titles', store_article_titles)
+
+    # Combine the segmented images for each article into one composite image
+    run_stage('stack', stack_segmented_images, selected_issues)
+
+    if track_stages:
+      mark_stage_done(manifest, selected_issues, 'stack')
 
-  # Combine the segmented images for each article into one composite image
-  stack_segmented_images()
\ No newline at end of file
+  # Stop the image writer threads
+  close_image_writer()
+  get_metrics().close()
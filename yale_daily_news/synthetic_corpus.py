@@ -0,0 +1,213 @@
+from __future__ import division
+from skimage import io
+import numpy as np
+import argparse, os
+
+# glymur is optional; without it jp2 pages are written with freeimage
+try:
+  import glymur
+except ImportError:
+  glymur = None
+
+'''
+Write a synthetic corpus of newspaper issues with the same layout as
+the YDN data, so the pipeline can be benchmarked without the real data.
+Each issue directory has numbered N.jp2 pages, an N.articles.xml file
+per page with type="uc" clips, articles that continue onto the next
+page, and optionally an index.cpd file. Usage:
+
+python synthetic_corpus.py {{output directory}} --issues 20 --pages 8
+'''
+
+# the largest 16 bit integer, which maps uc units onto the page
+uc_units = 65535
+
+
+def write_synthetic_corpus(root_data_directory, n_issues, pages_per_issue=8,
+    articles_per_page=10, page_shape=(3000, 2200), multi_page_fraction=0.2,
+    write_cpd=True, seed=0):
+  '''
+  Write n_issues synthetic issue directories to root_data_directory
+  and return the number of pages and rects written. multi_page_fraction
+  of the articles on each page (but the last) continue on the next page
+  '''
+  rng = np.random.RandomState(seed)
+  n_pages = 0
+  n_rects = 0
+
+  for issue_index in range(n_issues):
+    issue_directory = os.path.join(root_data_directory, 'issue-%06d' % issue_index)
+    issue_pages, issue_rects = write_synthetic_issue(issue_directory, rng,
+      pages_per_issue, articles_per_page, page_shape, multi_page_fraction,
+      write_cpd)
+    n_pages += issue_pages
+    n_rects += issue_rects
+
+  return n_pages, n_rects
+
+
+def write_synthetic_issue(issue_directory, rng, pages_per_issue, articles_per_page,
+    page_shape, multi_page_fraction, write_cpd):
+  '''
+  Write the pages, articles.xml files and index.cpd of one synthetic
+  issue to issue_directory and return the number of pages and rects
+  '''
+  if not os.path.exists(issue_directory):
+    os.makedirs(issue_directory)
+
+  # page files are numbered with gaps, as in the real data (1, 5, 12...)
+  page_numbers = np.cumsum(rng.randint(1, 8, pages_per_issue)).tolist()
+
+  # articles[page_id] = [[(inpage, coords), ...], ...]
+  articles = {page_id: [] for page_id in range(1, pages_per_issue + 1)}
+  n_rects = 0
+
+  for page_id in range(1, pages_per_issue + 1):
+    for article_index in range(articles_per_page):
+      rects = [(page_id, coords) for coords in random_article_rects(rng)]
+
+      if page_id < pages_per_issue and rng.rand() < multi_page_fraction:
+        rects += [(page_id + 1, coords) for coords in random_article_rects(rng)]
+
+        # the ALTO XML repeats all of a continued article's rects on each
+        # of its pages, starting with the rects on its first page
+        articles[page_id + 1].append(rects)
+
+      articles[page_id].append(rects)
+
+  for page_id, page_number in enumerate(page_numbers, 1):
+    boxes = [coords for article in articles[page_id]
+      for inpage, coords in article if inpage == page_id]
+    page = synthetic_page(rng, page_shape, boxes)
+    write_page_image(os.path.join(issue_directory, str(page_number) + '.jp2'), page)
+
+    xml_path = os.path.join(issue_directory, str(page_number) + '.articles.xml')
+    with open(xml_path, 'w') as out:
+      out.write(articles_xml(page_id, page_shape, articles[page_id]))
+
+    n_rects += sum(len(article) for article in articles[page_id])
+
+  if write_cpd:
+    with open(os.path.join(issue_directory, 'index.cpd'), 'w') as out:
+      out.write(index_cpd(page_numbers))
+
+  return pages_per_issue, n_rects
+
+
+def random_article_rects(rng):
+  '''
+  Return a list of 1-4 [x_offset, y_offset, width, height] rects in
+  uc units, stacked down one column of the page
+  '''
+  n_rects = rng.randint(1, 5)
+  column_width = uc_units // 6
+  left = rng.randint(0, 5) * column_width
+  top = rng.randint(0, uc_units // 2)
+
+  rects = []
+  for _ in range(n_rects):
+    height = rng.randint(uc_units // 40, uc_units // 10)
+    if top + height >= uc_units:
+      break
+    rects.append([left, top, column_width, height])
+    top += height
+
+  return rects or [[left, 0, column_width, uc_units // 20]]
+
+
+def synthetic_page(rng, page_shape, boxes):
+  '''
+  Return a white greyscale page with rows of dark, text-like noise
+  in each of the given uc unit boxes
+  '''
+  page = np.full(page_shape, 255, np.uint8)
+  height, width = page_shape
+
+  for left, top, box_width, box_height in boxes:
+    min_row = int(top / uc_units * height)
+    max_row = int((top + box_height) / uc_units * height)
+    min_col = int(left / uc_units * width)
+    max_col = int((left + box_width) / uc_units * width)
+
+    block = page[min_row:max_row, min_col:max_col]
+    ink = rng.randint(0, 120, block.shape).astype(np.uint8)
+
+    # leave a gap between each line of "text"
+    ink[(np.arange(block.shape[0]) % 24) >= 16] = 255
+    block[:] = ink
+
+  return page
+
+
+def write_page_image(path, page):
+  '''
+  Write a page array to disk as a jp2 file (with glymur, else freeimage)
+  '''
+  if glymur is not None:
+    glymur.Jp2k(path, data=page)
+  else:
+    io.imsave(path, page, plugin='freeimage')
+
+
+def articles_xml(page_id, page_shape, articles):
+  '''
+  Return the content of the articles.xml file for one page
+  '''
+  lines = [
+    '<?xml version="1.0" encoding="UTF-8"?>',
+    '<page id="%d" width="%d" height="%d" unit="pixel">' % (page_id, page_shape[1], page_shape[0])
+  ]
+
+  for article_index, rects in enumerate(articles):
+    lines += [
+      '  <article>',
+      '    <id>DIVL%d</id>' % (article_index + 1),
+      '    <title></title>',
+      '    <type>ARTICLE</type>',
+      '    <clip type="normal">'
+    ]
+    lines += ['      <coord inpage="%d">1:1:1:1</coord>' % page_id]
+    lines += ['    </clip>', '    <clip type="uc">']
+    lines += ['      <coord inpage="%d">%s</coord>' % (inpage, ':'.join(str(i) for i in coords))
+      for inpage, coords in rects]
+    lines += ['    </clip>', '  </article>']
+
+  lines.append('</page>')
+  return '\n'.join(lines) + '\n'
+
+
+def index_cpd(page_numbers):
+  '''
+  Return the content of the index.cpd file that lists an issue's pages
+  '''
+  lines = ['<?xml version="1.0"?>', '<cpd>', '  <type>Document</type>']
+  for page_id, page_number in enumerate(page_numbers, 1):
+    lines += [
+      '  <page>',
+      '    <pagetitle>Page %d</pagetitle>' % page_id,
+      '    <pagefile>%d.jp2</pagefile>' % page_number,
+      '    <pageptr>+</pageptr>',
+      '  </page>'
+    ]
+  lines.append('</cpd>')
+  return '\n'.join(lines) + '\n'
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Write a synthetic YDN corpus')
+  parser.add_argument('root_data_directory')
+  parser.add_argument('--issues', type=int, default=20)
+  parser.add_argument('--pages', type=int, default=8, help='pages per issue')
+  parser.add_argument('--articles', type=int, default=10, help='articles per page')
+  parser.add_argument('--height', type=int, default=3000, help='page height in pixels')
+  parser.add_argument('--width', type=int, default=2200, help='page width in pixels')
+  parser.add_argument('--multi-page-fraction', type=float, default=0.2)
+  parser.add_argument('--no-cpd', action='store_true', help="don't write index.cpd files")
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+
+  n_pages, n_rects = write_synthetic_corpus(args.root_data_directory, args.issues,
+    args.pages, args.articles, (args.height, args.width), args.multi_page_fraction,
+    not args.no_cpd, args.seed)
+
+  print 'wrote', args.issues, 'issues', n_pages, 'pages', n_rects, 'rects'
@@ -0,0 +1,220 @@
+import numpy as np
+import json, os, struct, zlib
+
+'''
+Store page arrays as square tiles that are zlib compressed one by one,
+so a page takes a fraction of the space of a raw npy file and a region
+of the page can be read by decompressing only the tiles it overlaps.
+A tiled page file has this layout:
+
+  magic          - 8 bytes, b'YDNTILE1'
+  header length  - little endian uint64
+  header         - JSON with the page's shape, dtype, tile size and codec
+  tile offsets   - n_tiles + 1 little endian int64 values; tile i is
+                   data[offsets[i]:offsets[i + 1]]
+  data           - the compressed tiles, row by row
+
+Tiles hold the first two dimensions of the page (rows and columns),
+and any further dimensions (e.g. color channels) in full.
+'''
+
+magic = b'YDNTILE1'
+
+
+def write_tiled_page(path, page, tile_size=512, compression_level=1):
+  '''
+  Read in a path, a page array, the height and width of each tile, and
+  a zlib compression level, and write the page to path as compressed tiles
+  '''
+  page = np.asarray(page)
+  height, width = page.shape[:2]
+
+  tiles = []
+  for min_row in range(0, height, tile_size):
+    for min_col in range(0, width, tile_size):
+      tile = page[min_row:min_row + tile_size, min_col:min_col + tile_size]
+      tiles.append(zlib.compress(np.ascontiguousarray(tile).tobytes(), compression_level))
+
+  offsets = np.zeros(len(tiles) + 1, '<i8')
+  offsets[1:] = np.cumsum([len(i) for i in tiles])
+
+  header = json.dumps({
+    'shape': list(page.shape),
+    'dtype': page.dtype.str,
+    'tile_size': tile_size,
+    'codec': 'zlib'
+  }).encode('utf-8')
+
+  with open(path, 'wb') as out:
+    out.write(magic)
+    out.write(struct.pack('<Q', len(header)))
+    out.write(header)
+    out.write(offsets.tobytes())
+    for tile in tiles:
+      out.write(tile)
+
+
+def read_tiled_page_header(path):
+  '''
+  Read in the path to a tiled page file and return its header. Raise
+  a ValueError if the file isn't a complete tiled page file
+  '''
+  with open(path, 'rb') as f:
+    return TiledPage.read_header(f)
+
+
+class TiledPage(object):
+
+  def __init__(self, path):
+    '''
+    Open the tiled page file at path. Slicing the page, e.g.
+    page[10:200, 40:400], returns an array with the pixels in that
+    region, and only reads the tiles that overlap the region
+    '''
+    self.path = path
+    self.file = open(path, 'rb')
+    try:
+      header = self.read_header(self.file)
+    except Exception:
+      self.file.close()
+      raise
+
+    self.shape = tuple(header['shape'])
+    self.dtype = np.dtype(header['dtype'])
+    self.tile_size = header['tile_size']
+    self.offsets = header['offsets']
+    self.data_start = header['data_start']
+    self.ndim = len(self.shape)
+    self.size = int(np.prod(self.shape))
+    self.nbytes = self.size * self.dtype.itemsize
+
+    # number of tiles per row of tiles
+    self.n_tile_cols = -(-self.shape[1] // self.tile_size)
+
+    # decompressed tiles, as rects on a page often share tiles
+    self.tiles = {}
+
+    # bytes of compressed tile data read so far
+    self.bytes_read = 0
+
+
+  @staticmethod
+  def read_header(f):
+    '''
+    Read in an open tiled page file and return its header, with the
+    tile offsets and the position of the first tile added
+    '''
+    if f.read(len(magic)) != magic:
+      raise ValueError('not a tiled page file')
+
+    header_length, = struct.unpack('<Q', f.read(8))
+    header = json.loads(f.read(header_length).decode('utf-8'))
+
+    height, width = header['shape'][:2]
+    tile_size = header['tile_size']
+    n_tiles = -(-height // tile_size) * -(-width // tile_size)
+
+    offsets = np.frombuffer(f.read(8 * (n_tiles + 1)), '<i8')
+    if len(offsets) != n_tiles + 1:
+      raise ValueError('truncated tiled page file')
+
+    header['offsets'] = offsets
+    header['data_start'] = len(magic) + 8 + header_length + 8 * (n_tiles + 1)
+
+    # make sure all of the tiles were written
+    f.seek(0, 2)
+    if f.tell() < header['data_start'] + offsets[-1]:
+      raise ValueError('truncated tiled page file')
+
+    return header
+
+
+  def __getitem__(self, key):
+    '''
+    Return the pixels in a region of the page, given as a slice of rows
+    or a tuple with a slice of rows and a slice of columns
+    '''
+    if not isinstance(key, tuple):
+      key = (key,)
+
+    if len(key) > 2 or not all(isinstance(i, slice) for i in key):
+      raise TypeError('tiled pages can only be indexed with row and column slices')
+
+    key = key + (slice(None),) * (2 - len(key))
+    (min_row, max_row, row_step), (min_col, max_col, col_step) = [
+      i.indices(n) for i, n in zip(key, self.shape[:2])]
+
+    if row_step < 1 or col_step < 1:
+      raise ValueError('tiled pages can only be sliced with positive steps')
+
+    region = self.read_region(min_row, max(max_row, min_row), min_col, max(max_col, min_col))
+    return region[::row_step, ::col_step]
+
+
+  def read_region(self, min_row, max_row, min_col, max_col):
+    '''
+    Return a new array with the pixels in rows min_row:max_row and
+    columns min_col:max_col of the page
+    '''
+    region = np.empty((max_row - min_row, max_col - min_col) + self.shape[2:], self.dtype)
+    if not region.size:
+      return region
+
+    tile_size = self.tile_size
+    first_col = min_col // tile_size
+    last_col = (max_col - 1) // tile_size
+
+    for tile_row in range(min_row // tile_size, (max_row - 1) // tile_size + 1):
+      self.read_tiles(tile_row, first_col, last_col)
+
+      for tile_col in range(first_col, last_col + 1):
+        tile = self.tiles[(tile_row, tile_col)]
+        tile_min_row = tile_row * tile_size
+        tile_min_col = tile_col * tile_size
+
+        # the part of the region that this tile covers
+        r0 = max(min_row, tile_min_row)
+        r1 = min(max_row, tile_min_row + tile.shape[0])
+        c0 = max(min_col, tile_min_col)
+        c1 = min(max_col, tile_min_col + tile.shape[1])
+
+        region[r0 - min_row:r1 - min_row, c0 - min_col:c1 - min_col] = \
+          tile[r0 - tile_min_row:r1 - tile_min_row, c0 - tile_min_col:c1 - tile_min_col]
+
+    return region
+
+
+  def read_tiles(self, tile_row, first_col, last_col):
+    '''
+    Decompress the tiles in columns first_col to last_col of a row of
+    tiles, unless they've been decompressed already. The tiles in a row
+    are stored next to each other, so they're read with a single read
+    '''
+    missing = [i for i in range(first_col, last_col + 1) if (tile_row, i) not in self.tiles]
+    if not missing:
+      return
+
+    first_tile = tile_row * self.n_tile_cols + missing[0]
+    last_tile = tile_row * self.n_tile_cols + missing[-1]
+    start = self.offsets[first_tile]
+
+    self.file.seek(self.data_start + start)
+    data = self.file.read(self.offsets[last_tile + 1] - start)
+    self.bytes_read += len(data)
+
+    tile_height = min(self.tile_size, self.shape[0] - tile_row * self.tile_size)
+    for tile_col in missing:
+      tile_index = tile_row * self.n_tile_cols + tile_col
+      tile_data = data[self.offsets[tile_index] - start:self.offsets[tile_index + 1] - start]
+      tile_width = min(self.tile_size, self.shape[1] - tile_col * self.tile_size)
+
+      tile = np.frombuffer(zlib.decompress(tile_data), self.dtype)
+      self.tiles[(tile_row, tile_col)] = tile.reshape((tile_height, tile_width) + self.shape[2:])
+
+
+  def close(self):
+    '''
+    Close the tiled page file and drop the decompressed tiles
+    '''
+    self.file.close()
+    self.tiles = {}